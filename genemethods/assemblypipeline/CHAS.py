@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import dotter, GenObject, make_path, run_subprocess, \
     write_to_logfile
-from threading import Thread
-from queue import Queue
+from genemethods.assemblypipeline.epcr import ElectronicPCR, epcr_search
 from glob import glob
+import multiprocessing
 import threading
 import os
 __author__ = 'adamkoziol'
@@ -23,13 +23,9 @@ class CHAS(object):
         self.report()
 
     def primers(self):
-        """Setup and create threads for ePCR"""
-        # Create the threads for the ePCR analysis
-        for sample in self.metadata:
-            if sample.general.bestassemblyfile != 'NA':
-                threads = Thread(target=self.epcr, args=())
-                threads.setDaemon(True)
-                threads.start()
+        """Find the primer and probe files, and run the ePCR analyses"""
+        # Initialise a list to store the samples to process with ePCR
+        epcrsamples = list()
         for sample in self.metadata:
             if sample.general.bestassemblyfile != 'NA':
                 setattr(sample, self.analysistype, GenObject())
@@ -64,76 +60,45 @@ class CHAS(object):
                     sample[self.analysistype].reportdir = os.path.join(sample.general.outputdirectory,
                                                                        self.analysistype)
                     make_path(sample[self.analysistype].reportdir)
-                    # Set the base name of the output file
-                    outfile = sample[self.analysistype].reportdir + sample.name
-                    # Set the hashing and mapping commands
-                    sample.commands.famap = 'famap -b {}.famap {}.fasta'.format(outfile, sample.general.filenoext)
-                    sample.commands.fahash = 'fahash -b {}.hash {}.famap'.format(outfile, outfile)
-                    # re-PCR uses the subtyping primers list to search the contigs file using the following parameters
-                    # -S {hash file} (Perform STS lookup using hash-file), -r + (Enable/disable reverse STS lookup)
-                    # -m 10000 (Set variability for STS size for lookup),
-                    # -n 1 (Set max allowed mismatches per primer for lookup)
-                    # -g 0 (Set max allowed indels per primer for lookup),
-                    # -G (Print alignments in comments), -o {output file}
-                    sample.commands.epcr = 're-PCR -S {}.hash -r + -m 10000 -n 2 -g 0 -G -q -o {}.txt {}' \
-                        .format(outfile, outfile, sample[self.analysistype].primers)
-                    # Add the variables to the queue
-                    self.epcrqueue.put((sample, outfile))
-        self.epcrqueue.join()
+                    # Set the name of the output file
+                    sample[self.analysistype].output = '{}.txt'.format(sample[self.analysistype].reportdir +
+                                                                       sample.name)
+                    # Initialise a list to store the results
+                    sample[self.analysistype].epcrresults = list()
+                    # Hash each primer file once. The in-process ePCR uses the same parameters as the previous re-PCR
+                    # calls: -m 10000 (variability of STS size), -n 2 (max allowed mismatches per primer),
+                    # -g 0 (max allowed indels per primer)
+                    if sample[self.analysistype].primers not in self.engines:
+                        self.engines[sample[self.analysistype].primers] = \
+                            ElectronicPCR(primerfile=sample[self.analysistype].primers,
+                                          mismatches=2,
+                                          gaps=0,
+                                          margin=10000)
+                    epcrsamples.append(sample)
+        self.epcr(epcrsamples)
 
-    def epcr(self):
-        while True:
-            sample, linkfile = self.epcrqueue.get()
-            # Set the names of the output files
-            sample[self.analysistype].famap = '{}.famap'.format(linkfile)
-            sample[self.analysistype].hash = '{}.hash'.format(linkfile)
-            sample[self.analysistype].output = '{}.txt'.format(linkfile)
-            # Initialise a list to store the results
-            sample[self.analysistype].epcrresults = list()
-            # If the files created by the results do not exist, run the necessary system calls
-            threadlock = threading.Lock()
-            # Get our stdout and stderr strings set up.
-            outstr = ''
-            errstr = ''
-            sample, linkfile = self.epcrqueue.get()
-            if not os.path.isfile(sample[self.analysistype].famap):
-                # Run the subprocess, then get the stdout in outstr and stderr in errstr
-                out, err = run_subprocess(sample.commands.famap)
-                outstr += out
-                errstr += err
-            if not os.path.isfile(sample[self.analysistype].famap):
-                out, err = run_subprocess(sample.commands.fahash)
-                outstr += out
-                errstr += err
-            if not os.path.isfile(sample[self.analysistype].output):
-                out, err = run_subprocess(sample.commands.epcr)
-                outstr += out
-                errstr += err
-            # Once processes are finished running, get the threadlock, because now it's output writing time.
-            threadlock.acquire()
-            # Write stuff to the logfile.
-            write_to_logfile(sample.commands.famap, sample.commands.famap, self.logfile)
-            write_to_logfile(sample.commands.fahash, sample.commands.fahash, self.logfile)
-            write_to_logfile(sample.commands.epcr, sample.commands.epcr, self.logfile)
-            write_to_logfile(outstr, errstr, self.logfile)
-            threadlock.release()
-            # Read the results into a list
-            with open(sample[self.analysistype].output, 'r') as results:
-                for line in results:
-                    sample[self.analysistype].epcrresults.append(line.strip())
-            self.epcrqueue.task_done()
+    def epcr(self, epcrsamples):
+        """
+        Scan the assemblies for amplicons with the in-process ePCR, and read the results into the metadata
+        :param epcrsamples: list of metadata objects of the samples with primer files
+        """
+        p = multiprocessing.Pool(processes=self.threads)
+        results = p.starmap(epcr_search,
+                            [(self.engines[sample[self.analysistype].primers], sample.general.bestassemblyfile,
+                              sample[self.analysistype].output) for sample in epcrsamples])
+        p.close()
+        p.join()
+        for sample, epcrresults in zip(epcrsamples, results):
+            sample[self.analysistype].epcrresults = epcrresults
 
     def epcrparsethreads(self):
         """
-        Parse the ePCR results, and run BLAST on the parsed results
+        Parse the ePCR results, and run BLAST on the parsed results. The amplicons of all the samples are gathered
+        into a single multi-FASTA query for each probe database, so each database is searched by a single BLAST process
         """
         from Bio import SeqIO
-        # Create the threads for the BLAST analysis
-        for sample in self.metadata:
-            if sample.general.bestassemblyfile != 'NA':
-                threads = Thread(target=self.epcrparse, args=())
-                threads.setDaemon(True)
-                threads.start()
+        # Initialise a dictionary to store the amplicons for each probe database
+        queries = dict()
         for sample in self.metadata:
             if sample.general.bestassemblyfile != 'NA':
                 if sample[self.analysistype].primers != 'NA':
@@ -150,34 +115,49 @@ class CHAS(object):
                         # The data of interest is in the lines that do not start with a #
                         # TLH 2016-SEQ-0359_4_length_321195_cov_28.6354_ID_3773 + 227879 228086 0	0 208/1000-1000
                         if not line.startswith('#'):
-                            # Add the variables to the queue
-                            self.epcrparsequeue.put((sample, record, line))
-        self.epcrparsequeue.join()
+                            # Split the data on tabs
+                            gene, chromosome, strand, start, end, m_match, gaps, act_len_exp_len = line.split('\t')
+                            # Extract the gene sequence from the contigs. The record dictionary has the contig name,
+                            # and the sequence. Splice out the data using the start and end coordinates specified by
+                            # ePCR
+                            genesequence = record[chromosome][int(start) - 1:int(end)]
+                            # Add the amplicon to the query of the probe database. The position of the amplicon in
+                            # the query is used to route the BLAST results back to the sample and gene
+                            db = sample[self.analysistype].probes.split('.')[0]
+                            queries.setdefault(db, list()).append((sample, gene, genesequence))
+        for db, amplicons in queries.items():
+            self.epcrparse(db, amplicons)
 
-    def epcrparse(self):
+    def epcrparse(self, db, amplicons):
         """
-        Run BLAST, and record results to the object
+        Run BLAST on all the amplicons matching a probe database, and record results to the objects
+        :param db: Name of the BLAST database of the probes
+        :param amplicons: list of tuples of sample object, gene name, and amplicon sequence
         """
         from Bio.Blast.Applications import NcbiblastnCommandline
-        while True:
-            sample, record, line = self.epcrparsequeue.get()
-            # Split the data on tabs
-            gene, chromosome, strand, start, end, m_match, gaps, act_len_exp_len = line.split('\t')
-            # Extract the gene sequence from the contigs
-            # The record dictionary has the contig name, and the sequence. Splice out the data using the start and
-            # end coordinates specified by ePCR
-            genesequence = record[chromosome][int(start) - 1:int(end)]
-            # Set up BLASTn using blastn-short, as the probe sequences tend to be very short
-            blastn = NcbiblastnCommandline(db=sample[self.analysistype].probes.split('.')[0],
-                                           num_threads=12,
-                                           task='blastn-short',
-                                           num_alignments=1,
-                                           outfmt="'6 qseqid sseqid positive mismatch gaps "
-                                                  "evalue bitscore slen length'")
-            # Run the BLASTn, with the gene sequence as stdin
-            out, err = blastn(stdin=genesequence)
+        # Create the multi-FASTA query. The query ID is the index of the amplicon in the list
+        query = ''.join('>{index}\n{sequence}\n'.format(index=index, sequence=sequence)
+                        for index, (sample, gene, sequence) in enumerate(amplicons))
+        # Set up BLASTn using blastn-short, as the probe sequences tend to be very short
+        blastn = NcbiblastnCommandline(db=db,
+                                       num_threads=self.threads,
+                                       task='blastn-short',
+                                       num_alignments=1,
+                                       outfmt="'6 qseqid sseqid positive mismatch gaps "
+                                              "evalue bitscore slen length'")
+        # Run the BLASTn, with the amplicon sequences as stdin
+        out, err = blastn(stdin=query)
+        # Gather the hits of each amplicon
+        hits = dict()
+        for line in out.rstrip().split('\n'):
+            if line:
+                hits.setdefault(int(line.split('\t')[0]), list()).append(line)
+        for index, (sample, gene, sequence) in enumerate(amplicons):
+            # Amplicons without any hits to the probes are absent
+            if index not in hits:
+                continue
             # Split the output string on tabs
-            results = out.rstrip().split('\t')
+            results = '\n'.join(hits[index]).split('\t')
             # Populate the raw blast results
             sample[self.analysistype].rawblastresults[gene] = results
             # Create named variables from the list
@@ -198,7 +178,6 @@ class CHAS(object):
             }
             # Populate the metadata object with the dictionary
             sample[self.analysistype].blastresults[gene] = resultdict
-            self.epcrparsequeue.task_done()
 
     def makeblastdb(self, fastapath):
         """
@@ -262,8 +241,8 @@ class CHAS(object):
         self.threads = inputobject.threads
         self.reportdir = inputobject.reportdir
         self.analysistype = analysistype
-        self.epcrqueue = Queue(maxsize=self.threads)
-        self.epcrparsequeue = Queue(maxsize=self.threads)
+        # Dictionary of primer file: ElectronicPCR object with the hashed primers
+        self.engines = dict()
         # self.fnull = open(os.path.devnull, 'wb')
         self.logfile = inputobject.logfile
         # Run the analyses
@@ -3,8 +3,10 @@ from olctools.accessoryFunctions.accessoryFunctions import GenObject, logstr, ma
     run_subprocess, write_to_logfile
 from Bio.Sequencing.Applications import SamtoolsIndexCommandline
 from Bio.Application import ApplicationError
-from Bio import SeqIO
-from threading import Lock, Thread
+from threading import Condition, Lock, Thread
+from genemethods.assemblypipeline.coverage import filter_contigs, insert_statistics, read_coverage, \
+    read_insert_sizes, sample_coverage
+from genemethods.assemblypipeline.polish import balance, contig_lengths, heap_size, merge_pieces
 from argparse import ArgumentParser
 from click import progressbar
 from io import StringIO
@@ -14,7 +16,6 @@ from time import time
 import logging
 import shutil
 import os
-import re
 
 __author__ = 'adamkoziol'
 
@@ -34,7 +35,6 @@ class AssemblyEvaluation(object):
         self.parse_qualimap_report()
         self.clean_quast()
         self.extract_insert_size()
-        self.calculate_weighted_insert_size()
         self.pilon()
         self.filter()
         self.clear()
@@ -159,11 +159,10 @@ class AssemblyEvaluation(object):
                     else:
                         sample.quast.cmd = 'quast --single {single}'\
                             .format(single=sample.general.trimmedcorrectedfastqfiles[0])
-                    # Both paired and unpaired samples share the rest of the system call
-                    # --debug is specified, as certain temporary files are either used for downstream analyses
-                    # (BAM file), or parsed (insert size estimation)
+                    # Both paired and unpaired samples share the rest of the system call. The insert size statistics
+                    # are calculated from the sorted BAM file, so none of the temporary files of quast are required
                     sample.quast.cmd += ' --ref-bam {bam} -t {threads} --k-mer-stats --circos --rna-finding ' \
-                                        '--conserved-genes-finding -o {outputdir} --debug {assembly}'\
+                                        '--conserved-genes-finding -o {outputdir} {assembly}'\
                         .format(bam=sample.quast.sortedbam,
                                 threads=self.cpus,
                                 outputdir=sample.quast.outputdir,
@@ -212,214 +211,179 @@ class AssemblyEvaluation(object):
 
     def extract_insert_size(self):
         """
-        Parse the bwa index log information to extract insert size estimations
+        Calculate the insert size statistics of each sample from the histogram of the properly paired reads created in
+        the same pass over the sorted BAM file as the coverage statistics
         """
         logging.info('Calculating insert size')
         for sample in self.metadata:
-            sample.quast.reads_stats_file = os.path.join(sample.quast.outputdir, 'reads_stats', 'reads_stats.err')
-            if os.path.isfile(sample.quast.reads_stats_file):
-                # Initialise attributes for the insert size estimation
-                sample.quast.total_reads = 0
-                sample.quast.insert_mean = list()
-                sample.quast.insert_std = list()
-                sample.quast.read_blocks = list()
-                current_reads = 0
-                # Open the report
-                with open(sample.quast.reads_stats_file, 'r') as read_stats:
-                    for line in read_stats:
-                        # BWA estimates the insert size distribution per 256*1024 read pairs. Extract the number of
-                        # reads present in the current block being processed
-                        # e.g. # candidate unique pairs for (FF, FR, RF, RR): (46, 226102, 14, 28)
-                        if '# candidate unique pairs for' in line:
-                            # Using the example above, current_reads will be 226102
-                            current_reads = int(line.rstrip().replace(',', '').replace('(', '').replace(')', '')
-                                                .split()[-3])
-                            # Add current_reads to the total number of reads
-                            sample.quast.total_reads += current_reads
-                        # Continue parsing to find the FR section of the current block
-                        elif 'analyzing insert size distribution for orientation FR' in line:
-                            for sub_line in read_stats:
-                                # Extract the mean and standard deviation of the insert size for this block
-                                #  [M::mem_pestat] mean and std.dev: (487.88, 246.14)
-                                if '[M::mem_pestat] mean and std.dev:' in sub_line:
-                                    split_line = sub_line.rstrip().replace(',', '').replace('(', '').replace(')', '')\
-                                        .split()
-                                    mean = float(split_line[-2])
-                                    std = float(split_line[-1])
-                                    sample.quast.insert_mean.append(mean)
-                                    sample.quast.insert_std.append(std)
-                                    sample.quast.read_blocks.append(current_reads)
-                                    # Break out of this loop
-                                    break
-            else:
-                sample.quast.insert_mean = 'ND'
-                sample.quast.insert_std = 'ND'
-
-    def calculate_weighted_insert_size(self):
-        """
-         Calculate the weighted mean and standard deviation of the insert size from the extracted bwa blocks
-        """
-        for sample in self.metadata:
-            # Initialise attributes to store the calculated weighted mean and standard deviation of insert sizes
+            # Initialise the insert size attributes
             sample.quast.mean_insert = float()
             sample.quast.std_insert = float()
-            if sample.quast.insert_mean != 'ND':
-                # Iterate through all the read blocks present in the sample (read_block is the number of reads present
-                # in the current block)
-                for i, read_block in enumerate(sample.quast.read_blocks):
-                    # Calculate the weight of the current block by dividing it (current number of reads) by the total
-                    # number of reads in the sample
-                    weight = read_block / sample.quast.total_reads
-                    # Multiply the mean for this block to obtain the weighted mean, and add it to the total mean
-                    sample.quast.mean_insert += sample.quast.insert_mean[i] * weight
-                    # Same calculation, but for standard deviation
-                    sample.quast.std_insert += sample.quast.insert_std[i] * weight
-            # Set the attributes to floats with two decimal places
-            sample.quast.mean_insert = float('{:.2f}'.format(sample.quast.mean_insert))
-            sample.quast.std_insert = float('{:.2f}'.format(sample.quast.std_insert))
+            sample.quast.median_insert = float()
+            sample.quast.mad_insert = float()
+            if sample.general.bestassemblyfile != 'NA' and os.path.isfile(sample.quast.insert_histogram):
+                inserts = read_insert_sizes(sample.quast.insert_histogram)
+                stats = insert_statistics(inserts)
+                # Set the attributes to floats with two decimal places
+                sample.quast.mean_insert = float('{:.2f}'.format(stats['MeanInsertSize']))
+                sample.quast.std_insert = float('{:.2f}'.format(stats['StdInsertSize']))
+                sample.quast.median_insert = float(stats['MedianInsertSize'])
+                sample.quast.mad_insert = float('{:.2f}'.format(stats['MadInsertSize']))
+                sample.quast.insert_pairs = sum(inserts.values())
 
     def qualimapper(self):
         """
-        Create threads and commands for performing reference mapping for qualimap analyses
+        Calculate the coverage statistics of each sample from its sorted BAM file with the in-process coverage engine
         """
-        logging.info('Running qualimap on samples')
-        for i in range(self.cpus):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.qualimap, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
+        logging.info('Calculating coverage statistics of samples')
+        coveragesamples = list()
         for sample in self.metadata:
             # Create and populate the qualimap attribute
             sample.qualimap = GenObject()
             sample.qualimap.outputdir = os.path.join(sample.general.outputdirectory, 'qualimap')
             make_path(sample.qualimap.outputdir)
-            sample.qualimap.reportfile = os.path.join(sample.qualimap.outputdir, 'genome_results.txt')
+            sample.qualimap.reportfile = os.path.join(sample.qualimap.outputdir, 'coverage.tsv')
+            sample.qualimap.summaryfile = os.path.join(sample.qualimap.outputdir, 'coverage_summary.tsv')
+            # The insert size histogram is created in the same pass over the BAM file as the coverage statistics
+            sample.quast.insert_histogram = os.path.join(sample.qualimap.outputdir, 'insert_sizes.tsv')
             sample.qualimap.length = dict()
             sample.qualimap.bases = dict()
             sample.qualimap.coverage = dict()
             sample.qualimap.stddev = dict()
             if sample.general.bestassemblyfile != "NA":
-                self.qualimap_queue.put(sample)
-        self.qualimap_queue.join()
-
-    def qualimap(self):
-        """
-        Run qualimap
-        """
-        while True:
-            sample = self.qualimap_queue.get()
-            if sample.general.bestassemblyfile != "NA":
-
-                # Define the Qualimap call
-                qualimapcall = 'qualimap bamqc -bam {sorted_bam} -outdir {outdir}' \
-                    .format(sorted_bam=sample.quast.sortedbam,
-                            outdir=sample.qualimap.outputdir)
-                sample.commands.qualimap = qualimapcall
-                # If the report file doesn't exist, run Qualimap, and print logs to the log file
-                if not os.path.isfile(sample.qualimap.reportfile):
-                    out, err = run_subprocess(sample.commands.qualimap)
-                    write_to_logfile(out='{cmd}\n{out}'.format(cmd=sample.commands.qualimap,
-                                                               out=out),
-                                     err=err,
-                                     logfile=self.logfile,
-                                     samplelog=sample.general.logout,
-                                     sampleerr=sample.general.logerr,
-                                     analysislog=None,
-                                     analysiserr=None)
-            self.qualimap_queue.task_done()
+                # Samples without a sorted BAM file have no coverage statistics to calculate
+                if not os.path.isfile(sample.quast.sortedbam):
+                    logging.warning('Could not find the sorted BAM file of {sn}'.format(sn=sample.name))
+                    continue
+                coveragesamples.append((sample.quast.sortedbam, sample.qualimap.reportfile,
+                                        sample.qualimap.summaryfile, sample.quast.insert_histogram))
+        # Each BAM file is processed by a single process
+        p = multiprocessing.Pool(processes=self.cpus)
+        p.starmap(sample_coverage, coveragesamples)
+        p.close()
+        p.join()
 
     def parse_qualimap_report(self):
         """
-        Parse the qualimap report
+        Parse the coverage tables, and populate the metadata objects with the per-contig and summary statistics
         """
         for sample in self.metadata:
             if sample.general.bestassemblyfile != "NA":
-                # Initialise a dictionary to hold the Qualimap results
-                qdict = dict()
                 try:
-                    with open(sample.qualimap.reportfile) as report:
-                        # Read the report
-                        for line in report:
-                            # Sanitise the keys and values using self.analyze
-                            key, value = self.qualimap_analyze(line)
-                            # If the keys and values exist, enter them into the dictionary
-                            if (key, value) != (None, None):
-                                # Only keep two decimal places
-                                if type(value) is float:
-                                    value = float('{:.2f}'.format(value))
-                                qdict[key] = value
-                            if 'Coverage per contig' in line:
-                                for contigline in report:
-                                    try:
-                                        _, name, length, bases, coverage, stddev = contigline.rstrip().split('\t')
-                                        sample.qualimap.length.update({name: length})
-                                        sample.qualimap.bases.update({name: bases})
-                                        sample.qualimap.coverage.update({name: coverage})
-                                        sample.qualimap.stddev.update({name: stddev})
-                                    except ValueError:
-                                        pass
-
+                    table, summary = read_coverage(sample.qualimap.reportfile, sample.qualimap.summaryfile)
                 except (IOError, FileNotFoundError):
-                    pass
-                # If there are values in the dictionary
-                if qdict:
-                    # Make new category for Qualimap results and populate this category with the report data
-                    for attribute in qdict:
-                        # Remove the 'X' from the depth values e.g. 40.238X
-                        setattr(sample.qualimap, attribute, qdict[attribute].rstrip('X'))
+                    continue
+                sample.qualimap.length = dict(zip(table['contig'], table['length']))
+                sample.qualimap.bases = dict(zip(table['contig'], table['mappedbases']))
+                sample.qualimap.coverage = dict(zip(table['contig'], table['meandepth']))
+                sample.qualimap.stddev = dict(zip(table['contig'], table['stddepth']))
+                # Make new category for the summary statistics
+                for attribute, value in summary.items():
+                    setattr(sample.qualimap, attribute, value)
 
     def pilon(self):
         """
-        Run pilon to fix any misassemblies in the contigs - will look for SNPs and indels
+        Run pilon to fix any misassemblies in the contigs - will look for SNPs and indels. Each assembly is split into
+        groups of contigs balanced by length, and the groups of all the samples are polished in parallel, longest first,
+        within the CPU and memory budgets
         """
         logging.info('Improving quality of assembly with pilon')
-        for i in range(self.threads):
-            # Send the threads to the merge method. :args is empty
+        jobs = list()
+        for sample in self.metadata:
+            sample.pilon = GenObject()
+            if sample.general.bestassemblyfile != 'NA':
+                # Samples flagged as unsuitable for polishing e.g. contaminated samples are not polished
+                try:
+                    if not sample.general.polish:
+                        continue
+                except AttributeError:
+                    pass
+                sample.pilon.outdir = os.path.join(sample.quast.outputdir, 'pilon')
+                make_path(sample.pilon.outdir)
+                # Set the name of the polished assembly, and the merged change log
+                sample.pilon.contigsfile = os.path.join(sample.pilon.outdir, 'pilon.fasta')
+                sample.pilon.changes = os.path.join(sample.pilon.outdir, 'pilon.changes')
+                # Only perform analyses if the polished assembly doesn't already exist
+                if os.path.isfile(sample.pilon.contigsfile):
+                    continue
+                lengths = contig_lengths(sample.general.assemblyfile)
+                sample.pilon.groups = list()
+                sample.pilon.cmd = list()
+                for i, group in enumerate(balance(lengths)):
+                    prefix = os.path.join(sample.pilon.outdir, 'group_{i}'.format(i=i))
+                    # Write the names of the contigs in the group to a targets file
+                    with open(prefix + '_targets.txt', 'w') as targets:
+                        targets.write('\n'.join(group) + '\n')
+                    size = sum(lengths[contig] for contig in group)
+                    heap = min(heap_size(size), self.memory)
+                    # Create the command line command
+                    command = 'pilon -Xmx{heap}g --genome {raw_assembly} --bam {sorted_bam} --fix bases ' \
+                              '--threads {threads} --outdir {outdir} --output {output} --targets {targets} ' \
+                              '--changes --mindepth 0.25' \
+                        .format(heap=heap,
+                                raw_assembly=sample.general.assemblyfile,
+                                sorted_bam=sample.quast.sortedbam,
+                                threads=self.pilonjobthreads,
+                                outdir=sample.pilon.outdir,
+                                output=os.path.basename(prefix),
+                                targets=prefix + '_targets.txt')
+                    sample.pilon.groups.append(prefix)
+                    sample.pilon.cmd.append(command)
+                    jobs.append((size, sample, prefix, set(group), command, heap))
+        # Start as many workers as can run concurrently within the CPU budget
+        for i in range(max(1, min(len(jobs), self.cpus // self.pilonjobthreads))):
             threads = Thread(target=self.pilonthreads, args=())
             # Set the daemon to true - something to do with thread management
             threads.setDaemon(True)
             # Start the threading
             threads.start()
-        for sample in self.metadata:
-            sample.pilon = GenObject()
-            if sample.general.bestassemblyfile != 'NA':
-                # Set the name of the unfiltered assembly output file
-                sample.general.contigsfile = sample.general.assemblyfile
-                sample.pilon.outdir = os.path.join(sample.quast.outputdir, 'pilon')
-                make_path(sample.quast.outputdir)
-                # Create the command line command
-                sample.pilon.cmd = 'pilon --genome {raw_assembly} --bam {sorted_bam} --fix bases ' \
-                                   '--threads {threads} --outdir {outdir} --changes --mindepth 0.25' \
-                    .format(raw_assembly=sample.general.contigsfile,
-                            sorted_bam=sample.quast.sortedbam,
-                            threads=self.threads,
-                            outdir=sample.pilon.outdir)
-                self.pilonqueue.put(sample)
+        # Queue the longest groups first, so that the largest jobs do not set the wall time
+        for job in sorted(jobs, key=lambda entry: entry[0], reverse=True):
+            self.pilonqueue.put(job[1:])
         self.pilonqueue.join()
+        # Merge the polished groups of each sample. The jobs of each sample were created in group order
+        pieces = dict()
+        for size, sample, prefix, group, command, heap in jobs:
+            pieces.setdefault(sample.name, (sample, list()))[1].append((group, prefix))
+        for sample, samplepieces in pieces.values():
+            # Only merge the groups if every group was polished
+            if all(os.path.isfile(prefix + '.fasta') for group, prefix in samplepieces):
+                merge_pieces(pieces=samplepieces,
+                             order=list(contig_lengths(sample.general.assemblyfile)),
+                             fasta=sample.pilon.contigsfile,
+                             changes=sample.pilon.changes)
 
     def pilonthreads(self):
         while True:
-            sample = self.pilonqueue.get()
-            # Only perform analyses if the output file doesn't already exist
-            if not os.path.isfile(sample.general.contigsfile):
-                command = sample.quast.cmd
-                out, err = run_subprocess(command)
-                write_to_logfile(out=command,
-                                 err=command,
-                                 logfile=self.logfile,
-                                 samplelog=sample.general.logout,
-                                 sampleerr=sample.general.logerr,
-                                 analysislog=None,
-                                 analysiserr=None)
-                write_to_logfile(out=out,
-                                 err=err,
-                                 logfile=self.logfile,
-                                 samplelog=sample.general.logout,
-                                 sampleerr=sample.general.logerr,
-                                 analysislog=None,
-                                 analysiserr=None)
+            sample, prefix, group, command, heap = self.pilonqueue.get()
+            # Wait until enough memory is free to run this job
+            with self.budget:
+                self.budget.wait_for(lambda: self.available_memory >= heap)
+                self.available_memory -= heap
+            try:
+                # Only perform analyses if the output file doesn't already exist
+                if not os.path.isfile(prefix + '.fasta'):
+                    out, err = run_subprocess(command)
+                    with self.threadlock:
+                        write_to_logfile(out=command,
+                                         err=command,
+                                         logfile=self.logfile,
+                                         samplelog=sample.general.logout,
+                                         sampleerr=sample.general.logerr,
+                                         analysislog=None,
+                                         analysiserr=None)
+                        write_to_logfile(out=out,
+                                         err=err,
+                                         logfile=self.logfile,
+                                         samplelog=sample.general.logout,
+                                         sampleerr=sample.general.logerr,
+                                         analysislog=None,
+                                         analysiserr=None)
+            finally:
+                # Return the memory to the budget
+                with self.budget:
+                    self.available_memory += heap
+                    self.budget.notify_all()
             self.pilonqueue.task_done()
 
     def filter(self):
@@ -437,58 +401,77 @@ class AssemblyEvaluation(object):
         for sample in self.metadata:
             # Set the name of the unfiltered assembly output file
             if sample.general.bestassemblyfile != 'NA':
-                sample.general.contigsfile = sample.general.assemblyfile
+                # Use the polished assembly if it exists
+                try:
+                    sample.general.contigsfile = sample.pilon.contigsfile \
+                        if os.path.isfile(sample.pilon.contigsfile) else sample.general.assemblyfile
+                except AttributeError:
+                    sample.general.contigsfile = sample.general.assemblyfile
                 self.filterqueue.put(sample)
         self.filterqueue.join()
 
     def filterthreads(self):
         while True:
             sample = self.filterqueue.get()
-            # Only run on samples that have been assembled
-            if os.path.isfile(sample.general.contigsfile) and not os.path.isfile(sample.general.filteredfile):
-                # Create a list to store all the records of contigs that pass the minimum depth filtering
-                passdepth = list()
-                for record in SeqIO.parse(open(sample.general.contigsfile, "rU"), "fasta"):
-                    # Extract the values for the mean coverage depth
-                    coveragemean = float(sample.qualimap.sample.qualimap.coverage[record.id])
-                    coveragestd = float(sample.qualimap.stddev[record.id])
-                    # Remove the _pilon added to the contig name in order to allow the contig name to match the original
-                    # name used as the key in the sample.qualimap.coverage dictionary
-                    contig = record.id.split('_pilon')[0]
-                    # Only include contigs with a depth greater or equal to the mean coverage minus 1.5 times the
-                    # coverage standard deviation
-                    if float(sample.qualimap.coverage[contig]) > (coveragemean - coveragestd * 1.5) \
-                            and len(record.seq) > 500:
-                        # Replace 'NODE' in the fasta header with the sample name
-                        # >NODE_1_length_705814_cov_37.107_ID_4231
-                        newid = re.sub("Contig", sample.name, record.id)
-                        record.id = str(record.id).replace('Contig', sample.name)
-                        record.id = newid
-                        # Clear the name and description attributes of the record
-                        record.name = ''
-                        record.description = ''
-                        # Add this record to our list
-                        passdepth.append(record)
-                # Only create the file if there are contigs that pass the depth filter
-                if passdepth:
-                    # Open the filtered assembly file
-                    with open(sample.general.filteredfile, 'w') as formatted:
-                        # Write the records in the list to the file
-                        SeqIO.write(passdepth, formatted, 'fasta')
-            # If the filtered file was successfully created, copy it to the BestAssemblies folder
-            if os.path.isfile(sample.general.filteredfile):
-                # Set the assemblies path
-                sample.general.bestassembliespath = os.path.join(self.path, 'BestAssemblies')
-                # Set the name of the file in the best assemblies folder
-                bestassemblyfile = os.path.join(sample.general.bestassembliespath, '{sn}.fasta'.format(sn=sample.name))
-                # Add the name and path of the best assembly file to the metadata
-                sample.general.bestassemblyfile = bestassemblyfile
-                # Copy the filtered file to the BestAssemblies folder
-                if not os.path.isfile(bestassemblyfile):
-                    shutil.copyfile(sample.general.filteredfile, bestassemblyfile)
-            else:
+            try:
+                self.filter_sample(sample)
+            except Exception:
+                logging.exception('Could not filter the assembly of {sn}'.format(sn=sample.name))
                 sample.general.bestassemblyfile = 'NA'
-            self.filterqueue.task_done()
+            finally:
+                # Always mark the task as done, so that a failed sample cannot block the join of the queue
+                self.filterqueue.task_done()
+
+    def filter_sample(self, sample):
+        """
+        Filter the contigs of an assembly on depth and length, and link the filtered assembly into the BestAssemblies
+        folder
+        :param sample: metadata object of the sample
+        """
+        # Only run on samples that have been assembled
+        if os.path.isfile(sample.general.contigsfile) and not os.path.isfile(sample.general.filteredfile):
+            # Only include contigs with a depth greater than the mean coverage minus 1.5 times the coverage
+            # standard deviation, and that are longer than 500 bp
+            if GenObject.isattr(sample.qualimap, 'MeanCoveragedata') and \
+                    GenObject.isattr(sample.qualimap, 'StdCoveragedata'):
+                mindepth = float(sample.qualimap.MeanCoveragedata) - float(sample.qualimap.StdCoveragedata) * 1.5
+            else:
+                # Without coverage statistics, the contigs are only filtered on length
+                logging.warning('Could not find the coverage statistics of {sn}; the contigs will not be filtered '
+                                'on depth'.format(sn=sample.name))
+                mindepth = float('-inf')
+            filter_contigs(contigsfile=sample.general.contigsfile,
+                           filteredfile=sample.general.filteredfile,
+                           coverage=sample.qualimap.coverage,
+                           mindepth=mindepth,
+                           minlength=500,
+                           name=sample.name)
+        # If the filtered file was successfully created, copy it to the BestAssemblies folder
+        if os.path.isfile(sample.general.filteredfile):
+            # Set the assemblies path
+            sample.general.bestassembliespath = os.path.join(self.path, 'BestAssemblies')
+            # Set the name of the file in the best assemblies folder
+            bestassemblyfile = os.path.join(sample.general.bestassembliespath, '{sn}.fasta'.format(sn=sample.name))
+            # Add the name and path of the best assembly file to the metadata
+            sample.general.bestassemblyfile = bestassemblyfile
+            # Link the filtered file into the BestAssemblies folder
+            if not os.path.isfile(bestassemblyfile):
+                make_path(sample.general.bestassembliespath)
+                self.link(sample.general.filteredfile, bestassemblyfile)
+        else:
+            sample.general.bestassemblyfile = 'NA'
+
+    @staticmethod
+    def link(source, destination):
+        """
+        Hard link a file to a new location, or copy the file if the filesystem does not support hard links
+        :param source: Name and path of the file
+        :param destination: Name and path of the link to create
+        """
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
 
     def clear(self):
         """
@@ -503,20 +486,6 @@ class AssemblyEvaluation(object):
             except AttributeError:
                 pass
 
-    @staticmethod
-    def qualimap_analyze(line):
-        # Split on ' = '
-        if ' = ' in line:
-            key, value = line.split(' = ')
-            # Replace occurrences of
-            key = key.replace('number of ', "").replace("'", "").title().replace(" ", "")
-            # Should we keep comma separation?
-            value = value.replace(",", "").replace(" ", "").rstrip()
-        # Otherwise set the keys and values to None
-        else:
-            key, value = None, None
-        return key, value
-
     @staticmethod
     def analyze(line):
         key, value = line.rstrip().split('\t')
@@ -530,15 +499,19 @@ class AssemblyEvaluation(object):
         self.start = inputobject.starttime
         self.cpus = inputobject.cpus
         self.threadlock = Lock()
-        try:
-            self.threads = int(self.cpus / len(self.metadata)) if self.cpus / len(self.metadata) > 1 else 1
-        except TypeError:
-            self.threads = self.cpus
         self.logfile = inputobject.logfile
         self.path = inputobject.path
         # Initialise queues
-        self.qualimap_queue = Queue(maxsize=self.cpus)
-        self.pilonqueue = Queue(maxsize=self.cpus)
+        self.pilonqueue = Queue()
+        # Pilon does not scale well beyond a few threads, so polish several groups of contigs concurrently instead
+        self.pilonjobthreads = max(1, min(4, self.cpus))
+        # Memory budget (GB) for the pilon Java heaps - use 80% of the physical memory of the system
+        try:
+            self.memory = max(2, int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3 * 0.8))
+        except (ValueError, OSError, AttributeError):
+            self.memory = 8
+        self.available_memory = self.memory
+        self.budget = Condition()
         self.indexqueue = Queue(maxsize=self.cpus)
         self.filterqueue = Queue(maxsize=self.cpus)
 
@@ -1,13 +1,76 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import filer, MetadataObject, GenObject, make_path, relative_symlink
 from genemethods.assemblypipeline import metadataReader
+from functools import lru_cache
+from threading import Thread
+from queue import Queue
 from glob import glob
-import subprocess
 import logging
+import zlib
 import os
 
 __author__ = 'adamkoziol'
 
+# Size of the block read from the start of each FASTQ file
+BLOCKSIZE = 65536
+
+
+def fastq_stats(fastq, reads=250):
+    """
+    Collect the maximum read length, the quality encoding, and an estimate of the number of reads in a FASTQ file from
+    the first block of the file. Only the first block of gzipped files is decompressed
+    :param fastq: Path to the (optionally gzipped) FASTQ file
+    :param reads: Maximum number of reads to sample
+    :return: dictionary of 'length', 'encoding', and 'reads'
+    """
+    try:
+        stat = os.stat(fastq)
+    except (OSError, TypeError):
+        return dict(length=0, encoding='NA', reads=0)
+    return _fastq_stats(fastq, stat.st_size, stat.st_mtime, reads)
+
+
+@lru_cache(maxsize=None)
+def _fastq_stats(fastq, size, mtime, reads):
+    """
+    Cached implementation of fastq_stats. The file size and modification time are part of the cache key, so
+    modified files are sampled again
+    """
+    stats = dict(length=0, encoding='NA', reads=0)
+    with open(fastq, 'rb') as handle:
+        block = handle.read(BLOCKSIZE)
+    consumed = len(block)
+    if fastq.endswith('.gz'):
+        # Automatically detect the gzip header
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        try:
+            block = decompressor.decompress(block)
+        except zlib.error:
+            return stats
+        # Do not count any trailing data (e.g. from concatenated gzip members) as consumed
+        consumed -= len(decompressor.unused_data)
+    # Only use complete lines - drop any partial line at the end of the block, unless the whole file was read
+    lines = block.split(b'\n')
+    last = lines.pop()
+    if last and consumed >= size:
+        lines.append(last)
+    records = min(len(lines) // 4, reads)
+    if not records:
+        return stats
+    # The sequence and quality lines occur every four lines (1, 5, 9, etc. and 3, 7, 11, etc.)
+    stats['length'] = max(len(lines[i * 4 + 1].rstrip()) for i in range(records))
+    lowest = min(min(lines[i * 4 + 3].rstrip() or b'~') for i in range(records))
+    # Phred+33 qualities start at '!' (33), while Phred+64 qualities start at '@' (64). Scores below ';' (59) can
+    # only be Phred+33
+    stats['encoding'] = 'phred33' if lowest < 59 else 'phred64' if lowest >= 64 else 'NA'
+    # Extrapolate the number of reads from the number of (compressed) bytes used by the complete records
+    complete = sum(len(line) + 1 for line in lines[:(len(lines) // 4) * 4])
+    if consumed >= size:
+        stats['reads'] = len(lines) // 4
+    else:
+        stats['reads'] = int(len(lines) // 4 * (len(block) / complete) * (size / consumed))
+    return stats
+
 
 class Basic(object):
 
@@ -55,6 +118,14 @@ class Basic(object):
         """Calculates the read length of the fastq files. Short reads will not be able to be assembled properly with the
         default parameters used for spades."""
         logging.info('Estimating read lengths of FASTQ files')
+        # Create and start threads
+        for i in range(min(self.cpus, len(self.samples)) or 1):
+            # Send the threads to the appropriate destination function
+            threads = Thread(target=self.samplereads, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
         # Iterate through the samples
         for sample in self.samples:
             sample.run.Date = 'NA'
@@ -68,66 +139,33 @@ class Basic(object):
                 # Initialise the .header attribute for each sample
                 sample.header = GenObject()
                 sample.commands = GenObject()
-                # Set /dev/null
-                devnull = open(os.devnull, 'wb')
                 # Only process the samples if the file type is a list
                 if type(sample.general.fastqfiles) is list:
-                    # Set the forward fastq to be the first entry in the list
-                    forwardfastq = sorted(sample.general.fastqfiles)[0]
-                    # If the files are gzipped, then zcat must be used instead of cat
-                    if '.gz' in forwardfastq:
-                        command = 'zcat'
-                    else:
-                        command = 'cat'
-                    # Read in the output of the (z)cat of the fastq file piped through head to read only the first 1000
-                    # lines. Will make a string of the first 1000 lines in the file
-                    forwardreads = subprocess.Popen("{} {} | head -n 1000".format(command, forwardfastq),
-                                                    shell=True,
-                                                    stdout=subprocess.PIPE,
-                                                    stderr=devnull).communicate()[0].rstrip()
-                    # Set the length of the reads as follows: the highest value (max) of the length of the sequence. The
-                    # sequence was extracted from the rest of the lines in the fastq file. Example of first four lines:
-                    """
-                    @M02466:126:000000000-AKF4P:1:1101:11875:1838 1:N:0:1
-                    TCATAACGCAGTGAAACGCTTTAACAAAAGCGGAGACACGCCACTATTTGTCAATATTTCGTATGATACATTTTTAGAAAATCAAGAAGAGTTGCACGA
-                    +
-                    AA,B89C,@++B,,,,C,:BFF9,C,,,,,6+++++:,C,8C+BE,EFF9FC,6E,EFGF@F<F@9F9E<FFGGGC8,,,,CC<,,,,,,6CE,C<C,,
-                    """
-                    # The line with the sequence information occurs every four lines (1, 5, 9, etc). This can be
-                    # represented by linenumber % 4 == 1
-                    try:
-                        # Added due to weird 2to3 conversion issues, was coming
-                        forwardreads = forwardreads.decode('utf-8')
-                    except UnicodeDecodeError:
-                        sample.run.forwardlength = 0
-                    # up as a bytes object when we need it as a string.
-                    try:
-                        forwardlength = max([len(sequence) for iterator, sequence in enumerate(forwardreads.split('\n'))
-                                             if iterator % 4 == 1])
-                        sample.run.forwardlength = forwardlength
-                    except (ValueError, TypeError):
-                        sample.run.forwardlength = 0
-                    # For paired end analyses, also calculate the length of the reverse reads
-                    if len(sample.general.fastqfiles) == 2:
-                        reversefastq = sorted(sample.general.fastqfiles)[1]
-                        reversereads = subprocess.Popen("{} {} | head -n 1000".format(command, reversefastq),
-                                                        shell=True,
-                                                        stdout=subprocess.PIPE,
-                                                        stderr=devnull).communicate()[0].rstrip()
-                        try:
-                            reversereads = reversereads.decode('utf-8')
-                        except UnicodeDecodeError:
-                            sample.run.reverselength = 0
-                        try:
-                            sample.run.reverselength = max([len(sequence) for iterator, sequence in
-                                                            enumerate(reversereads.split('\n')) if iterator % 4 == 1])
-                        except (ValueError, TypeError):
-                            sample.run.reverselength = 0
-                    # Populate metadata of single end reads with 'NA'
-                    else:
-                        sample.run.reverselength = 0
+                    self.queue.put(sample)
+        self.queue.join()
+
+    def samplereads(self):
+        while True:
+            sample = self.queue.get()
+            # Set the forward fastq to be the first entry in the list
+            forward = fastq_stats(sorted(sample.general.fastqfiles)[0])
+            sample.run.forwardlength = forward['length']
+            sample.run.forwardreads = forward['reads']
+            sample.run.qualityencoding = forward['encoding']
+            # For paired end analyses, also calculate the length of the reverse reads
+            if len(sample.general.fastqfiles) == 2:
+                reverse = fastq_stats(sorted(sample.general.fastqfiles)[1])
+                sample.run.reverselength = reverse['length']
+                sample.run.reversereads = reverse['reads']
+            # Populate metadata of single end reads with 0
+            else:
+                sample.run.reverselength = 0
+                sample.run.reversereads = 0
+            self.queue.task_done()
 
     def __init__(self, inputobject):
         self.samples = list()
         self.path = inputobject.path
+        self.cpus = inputobject.cpus
+        self.queue = Queue()
         self.basic()
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import run_subprocess
+from threading import Thread, Lock
+from queue import Queue
 import logging
 import shutil
+import lzma
+import gzip
 import os
 import re
 __author__ = 'adamkoziol'
 
+# Files to remove are matched with a single pattern compiled from all the removal rules
+REMOVE = re.compile(r'.fastq$|.fastq.gz$|.bam$|.bt2$|.tab$|^before|^baitedtargets|_combined.csv$|^scaffolds|'
+                    r'.fastg$|.gfa$|.bai$|_blastn_cgmlst.tsv$')
+# Every file within these folders is removed
+REMOVE_FOLDER = re.compile(r'coregenome|prophages|busco_stats')
+# Keep the baitedtargets.fa, core genome, and merged metagenome files
+KEEP = re.compile(r'^baitedtargets\.fa$|coregenome|paired|cgmlst')
+
 
 class Compress(object):
 
@@ -12,25 +25,20 @@ class Compress(object):
         """Removes unnecessary temporary files generated by the pipeline"""
         logging.info('Removing large and/or temporary files')
         removefolder = list()
+        # Create and start threads
+        for i in range(self.cpus):
+            # Send the threads to the appropriate destination function
+            threads = Thread(target=self.clean, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
         for sample in self.metadata:
-            # Use os.walk to iterate through all the files in the sample output directory
-            for path, dirs, files in os.walk(sample.general.outputdirectory):
-                for item in files:
-                    # Use regex to find files to remove
-                    if re.search(".fastq$", item) or re.search(".fastq.gz$", item) or re.search(".bam$", item) \
-                            or re.search(".bt2$", item) or re.search(".tab$", item) or re.search("^before", item) \
-                            or re.search("^baitedtargets", item) or re.search("_combined.csv$", item) \
-                            or re.search("^scaffolds", item) or re.search(".fastg$", item) or re.search(".gfa$", item) \
-                            or re.search(".bai$", item) or re.search("_blastn_cgmlst.tsv$", item) or 'coregenome' \
-                            in path or 'prophages' in path or 'busco_stats' in path:
-                        # Keep the baitedtargets.fa, core genome, and merged metagenome files
-                        if item != 'baitedtargets.fa' and not re.search("coregenome", item) \
-                                and not re.search("paired", item) and not re.search("cgmlst", item):
-                            # Remove the unnecessary files
-                            try:
-                                os.remove(os.path.join(path, item))
-                            except IOError:
-                                pass
+            self.queue.put(sample)
+        self.queue.join()
+        # Write the manifest of all the files that were (or would be) removed or compressed
+        if self.manifest:
+            self.write_manifest()
         # Clear out the folders
         for folder in removefolder:
             try:
@@ -38,6 +46,126 @@ class Compress(object):
             except (OSError, TypeError):
                 pass
 
-    def __init__(self, inputobject):
+    def clean(self):
+        while True:
+            sample = self.queue.get()
+            # Scan the sample output directory for files to remove
+            for path, size in self.scan(sample.general.outputdirectory):
+                if self.dryrun:
+                    action = 'compress' if self.compress and self.compressible(path) else 'remove'
+                else:
+                    action = self.process(path)
+                if action:
+                    with self.lock:
+                        self.removed.append((sample.name, action, size, path))
+            self.queue.task_done()
+
+    def scan(self, directory):
+        """
+        Recursively scan a directory with os.scandir, and yield the path and size of every file that matches the
+        removal rules
+        :param directory: Path of the directory to scan
+        """
+        try:
+            entries = list(os.scandir(directory))
+        except (OSError, TypeError):
+            return
+        # Files in folders such as coregenome are always candidates for removal
+        folder = REMOVE_FOLDER.search(directory)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from self.scan(entry.path)
+            elif (folder or REMOVE.search(entry.name)) and not KEEP.search(entry.name):
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    size = 0
+                yield entry.path, size
+
+    def process(self, path):
+        """
+        Remove (or compress) a file
+        :param path: Path of the file
+        :return: The action that was performed on the file, or None if the file could not be processed
+        """
+        if self.compress and self.compressible(path):
+            try:
+                self.compress_file(path)
+                return 'compress'
+            except (OSError, EOFError):
+                # Fall back to removing the file if compression failed
+                pass
+        try:
+            os.remove(path)
+            return 'remove'
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def compressible(path):
+        """
+        Determine whether a file can be compressed rather than removed. Symlinks (e.g. the links to the original
+        FASTQ files) are never compressed
+        :param path: Path of the file
+        """
+        return not os.path.islink(path) and path.endswith(('.bam', '.fastq', '.fastq.gz'))
+
+    def compress_file(self, path):
+        """
+        Compress a file with a higher ratio format: BAM files are converted to CRAM with samtools, and FASTQ files are
+        recompressed with xz. The original file is removed following successful compression
+        :param path: Path of the file to compress
+        """
+        if path.endswith('.bam'):
+            cram = os.path.splitext(path)[0] + '.cram'
+            # The reference sequence is not available for every BAM file, so store the read sequences in the CRAM file
+            command = 'samtools view -@ {threads} -C --output-fmt-option no_ref=1 -o {cram} {bam}' \
+                .format(threads=self.threads,
+                        cram=cram,
+                        bam=path)
+            out, err = run_subprocess(command)
+            if not os.path.isfile(cram) or not os.path.getsize(cram):
+                raise OSError(err)
+        else:
+            xz = re.sub(r'\.gz$', '', path) + '.xz'
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rb') as fastq, lzma.open(xz, 'wb', preset=9) as compressed:
+                shutil.copyfileobj(fastq, compressed)
+        os.remove(path)
+
+    def write_manifest(self):
+        """
+        Write a tab-delimited manifest of all the files that were (or would be) removed or compressed, and the total
+        number of bytes reclaimed
+        """
+        total = sum(size for name, action, size, path in self.removed)
+        with open(self.manifest, 'w') as manifest:
+            manifest.write('Sample\tAction\tBytes\tPath\n')
+            for name, action, size, path in sorted(self.removed):
+                manifest.write('{name}\t{action}\t{size}\t{path}\n'
+                               .format(name=name,
+                                       action=action,
+                                       size=size,
+                                       path=path))
+            manifest.write('Total\t\t{total}\t\n'.format(total=total))
+        logging.info('{action} {total} bytes in {count} files'
+                     .format(action='Would reclaim' if self.dryrun else 'Reclaimed',
+                             total=total,
+                             count=len(self.removed)))
+
+    def __init__(self, inputobject, dryrun=False, compress=False, manifest=None):
         self.metadata = inputobject.runmetadata.samples
+        self.cpus = inputobject.cpus
+        # Split the available threads between the sample threads for samtools
+        self.threads = max(1, self.cpus // max(1, len(self.metadata)))
+        # Report the files that would be removed rather than removing them
+        self.dryrun = dryrun
+        # Compress intermediate files (BAM -> CRAM, FASTQ -> xz) rather than deleting them
+        self.compress = compress
+        # A dry run always produces a manifest
+        self.manifest = manifest if manifest or not dryrun \
+            else os.path.join(inputobject.path, 'cleanup_manifest.tsv')
+        self.removed = list()
+        self.lock = Lock()
+        self.queue = Queue()
         self.remove()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+from collections import Counter
+from array import array
+import pandas as pd
+import numpy as np
+import logging
+import pysam
+import os
+
+__author__ = 'adamkoziol'
+
+# Columns of the per-contig coverage table
+COLUMNS = ['contig', 'length', 'mappedbases', 'coveredbases', 'meandepth', 'stddepth', 'gc']
+
+
+def contig_depth(length, starts, ends):
+    """
+    Calculate the per-base depth of a contig from the starts and ends of the aligned blocks of its reads
+    :param length: Length of the contig
+    :param starts: array of the (0-based) start positions of the aligned blocks
+    :param ends: array of the (exclusive) end positions of the aligned blocks
+    :return: numpy array of the depth at each position of the contig
+    """
+    changes = np.bincount(np.frombuffer(starts, dtype=np.int64), minlength=length + 1) - \
+        np.bincount(np.frombuffer(ends, dtype=np.int64), minlength=length + 1)
+    return np.cumsum(changes[:length])
+
+
+def bam_coverage(bamfile):
+    """
+    Stream a sorted BAM file once, and calculate the depth, GC, and insert size statistics of the mapped reads. Only the
+    depth array of the contig currently being read is held in memory
+    :param bamfile: Name and path of the sorted BAM file
+    :return: pandas DataFrame of the per-contig statistics, dictionary of the summary statistics, Counter of insert
+    size: number of templates
+    """
+    rows = list()
+    inserts = Counter()
+    reads = mapped = gc = sequenced = 0
+    # Sums of the depths and squared depths across all the contigs for the genome-wide mean and standard deviation
+    depthsum = squaresum = 0
+    with pysam.AlignmentFile(bamfile, 'rb') as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        contigs = {contig: [array('q'), array('q'), 0, 0] for contig in bam.references}
+        current = None
+
+        def close(contig):
+            """
+            Reduce the aligned blocks of a contig to its depth statistics, and release the blocks
+            """
+            nonlocal depthsum, squaresum
+            starts, ends, contiggc, contigbases = contigs.pop(contig)
+            depth = contig_depth(lengths[contig], starts, ends)
+            total = int(depth.sum())
+            depthsum += total
+            squaresum += int(np.dot(depth, depth))
+            rows.append((contig, lengths[contig], total, int(np.count_nonzero(depth)),
+                         depth.mean() if lengths[contig] else 0, depth.std() if lengths[contig] else 0,
+                         contiggc / contigbases * 100 if contigbases else 0))
+
+        for read in bam.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            reads += 1
+            if read.is_unmapped:
+                continue
+            mapped += 1
+            contig = read.reference_name
+            # The BAM file is sorted, so every read of the previous contig has been seen
+            if contig != current:
+                if current is not None:
+                    close(current)
+                current = contig
+            entry = contigs[contig]
+            for start, end in read.get_blocks():
+                entry[0].append(start)
+                entry[1].append(end)
+            sequence = read.query_sequence
+            if sequence:
+                readgc = sequence.count('G') + sequence.count('C')
+                entry[2] += readgc
+                entry[3] += len(sequence)
+                gc += readgc
+                sequenced += len(sequence)
+            # Use the first read of each properly paired template for the insert size distribution
+            if read.is_proper_pair and read.is_read1 and read.template_length:
+                inserts[abs(read.template_length)] += 1
+        # Contigs without any mapped reads have a depth of zero
+        for contig in list(contigs):
+            close(contig)
+    table = pd.DataFrame(rows, columns=COLUMNS)
+    # Restore the order of the contigs in the BAM header
+    table = table.set_index('contig').reindex(list(lengths)).reset_index()
+    genomesize = sum(lengths.values())
+    mean = depthsum / genomesize if genomesize else 0
+    summary = {
+        'Reads': reads,
+        'MappedReads': mapped,
+        'MappedBases': depthsum,
+        'CoveredBases': int(table['coveredbases'].sum()),
+        'GenomeSize': genomesize,
+        'MeanCoveragedata': mean,
+        'StdCoveragedata': max(squaresum / genomesize - mean ** 2, 0) ** 0.5 if genomesize else 0,
+        'GcPercentage': gc / sequenced * 100 if sequenced else 0
+    }
+    summary.update(insert_statistics(inserts))
+    return table, summary, inserts
+
+
+def weighted_median(values, counts):
+    """
+    Find the median of a histogram
+    :param values: numpy array of the sorted values of the histogram
+    :param counts: numpy array of the number of observations of each value
+    :return: median value
+    """
+    return values[np.searchsorted(np.cumsum(counts), counts.sum() / 2)]
+
+
+def insert_statistics(inserts):
+    """
+    Calculate the mean, standard deviation, median, and median absolute deviation of an insert size histogram
+    :param inserts: Counter of insert size: number of templates
+    :return: dictionary of the insert size statistics
+    """
+    templates = sum(inserts.values())
+    if not templates:
+        return {'MeanInsertSize': 0, 'StdInsertSize': 0, 'MedianInsertSize': 0, 'MadInsertSize': 0}
+    sizes = np.array(sorted(inserts), dtype=np.float64)
+    counts = np.array([inserts[size] for size in sorted(inserts)], dtype=np.float64)
+    mean = float(np.dot(sizes, counts) / templates)
+    std = float(np.dot((sizes - mean) ** 2, counts) / templates) ** 0.5
+    median = weighted_median(sizes, counts)
+    deviations = np.abs(sizes - median)
+    order = np.argsort(deviations, kind='stable')
+    mad = weighted_median(deviations[order], counts[order])
+    return {'MeanInsertSize': mean, 'StdInsertSize': std, 'MedianInsertSize': int(median), 'MadInsertSize': float(mad)}
+
+
+def write_insert_sizes(inserts, histogramfile):
+    """
+    Write an insert size histogram to file
+    :param inserts: Counter of insert size: number of templates
+    :param histogramfile: Name and path of the tab-separated insert size: count histogram to create
+    """
+    with open(histogramfile, 'w') as histogram:
+        histogram.write('insert_size\tcount\n')
+        for size in sorted(inserts):
+            histogram.write('{size}\t{count}\n'.format(size=size,
+                                                       count=inserts[size]))
+
+
+def read_insert_sizes(histogramfile):
+    """
+    Read an insert size histogram created by sample_coverage
+    :param histogramfile: Name and path of the tab-separated insert size: count histogram
+    :return: Counter of insert size: number of templates
+    """
+    with open(histogramfile, 'r') as histogram:
+        next(histogram)
+        return Counter({int(size): int(count) for size, count in (line.split('\t') for line in histogram)})
+
+
+def sample_coverage(bamfile, coveragefile, summaryfile, histogramfile):
+    """
+    Calculate the coverage statistics of a sample, and write the per-contig table, the summary, and the insert size
+    histogram to file. Samples with existing outputs are not re-processed. Errors reading the BAM file are logged
+    rather than raised, so that a single sample cannot stop the coverage calculations of the remaining samples
+    :param bamfile: Name and path of the sorted BAM file
+    :param coveragefile: Name and path of the per-contig coverage table to create
+    :param summaryfile: Name and path of the summary statistics file to create
+    :param histogramfile: Name and path of the insert size histogram to create
+    """
+    if os.path.isfile(coveragefile) and os.path.isfile(summaryfile) and os.path.isfile(histogramfile):
+        return
+    try:
+        table, summary, inserts = bam_coverage(bamfile)
+    except (OSError, ValueError) as exc:
+        logging.warning('Could not calculate the coverage statistics of {bam}: {ex}'.format(bam=bamfile,
+                                                                                          ex=exc))
+        return
+    write_insert_sizes(inserts, histogramfile)
+    table.to_csv(coveragefile, sep='\t', index=False, float_format='%.2f')
+    with open(summaryfile, 'w') as output:
+        for key, value in summary.items():
+            output.write('{key}\t{value}\n'.format(key=key,
+                                                   value='{:.2f}'.format(value) if type(value) is float else value))
+
+
+def read_coverage(coveragefile, summaryfile):
+    """
+    Read the outputs of sample_coverage
+    :param coveragefile: Name and path of the per-contig coverage table
+    :param summaryfile: Name and path of the summary statistics file
+    :return: pandas DataFrame of the per-contig statistics, dictionary of the summary statistics (as strings)
+    """
+    table = pd.read_csv(coveragefile, sep='\t', dtype={'contig': str})
+    with open(summaryfile, 'r') as summary:
+        return table, dict(line.rstrip('\n').split('\t') for line in summary if line.strip())
+
+
+def filter_contigs(contigsfile, filteredfile, coverage, mindepth, minlength, name):
+    """
+    Stream an assembly, and write the contigs that pass the depth and length thresholds to the filtered assembly. Only
+    the sequence of the current contig is held in memory. The filtered file is only created if at least one contig
+    passes the filters
+    :param contigsfile: Name and path of the assembly to filter
+    :param filteredfile: Name and path of the filtered assembly to create
+    :param coverage: Dictionary of contig name: mean depth from the per-contig coverage table
+    :param mindepth: Contigs must have a mean depth greater than this value
+    :param minlength: Contigs must be longer than this value
+    :param name: Name of the sample, which replaces 'Contig' in the contig names
+    :return: Number of contigs written to the filtered assembly
+    """
+    partial = filteredfile + '.tmp'
+    passed = 0
+
+    def flush(header, lines):
+        """
+        Apply the filters to a contig, and write it to the filtered assembly if it passes
+        """
+        nonlocal passed
+        if header is None:
+            return
+        sequence = ''.join(lines)
+        contig = header.split()[0] if header.strip() else str()
+        # Remove the _pilon added to the contig name in order to allow the contig name to match the original
+        # name used as the key in the coverage table
+        if float(coverage.get(contig.split('_pilon')[0], 0)) > mindepth and len(sequence) > minlength:
+            # Replace 'Contig' in the fasta header with the sample name, and drop the description
+            filtered.write('>{id}\n'.format(id=contig.replace('Contig', name)))
+            for i in range(0, len(sequence), 60):
+                filtered.write(sequence[i:i + 60] + '\n')
+            passed += 1
+
+    with open(contigsfile, 'r') as contigs, open(partial, 'w') as filtered:
+        header = None
+        lines = list()
+        for line in contigs:
+            if line.startswith('>'):
+                flush(header, lines)
+                header = line[1:].rstrip()
+                lines = list()
+            elif header is not None:
+                lines.append(line.strip().replace(' ', ''))
+        flush(header, lines)
+    if passed:
+        os.replace(partial, filteredfile)
+    else:
+        os.remove(partial)
+    return passed
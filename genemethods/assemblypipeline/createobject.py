@@ -1,33 +1,64 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import filer, GenObject, make_path, MetadataObject, relative_symlink
-from glob import glob
+from bisect import bisect_left
 import logging
 import os
 __author__ = 'adamkoziol'
 
 
+def scan(path):
+    """
+    List the contents of a directory once. Hidden entries are ignored, as they are by glob
+    :param path: Directory to list
+    :return: sorted list of (entry name, entry path)
+    """
+    with os.scandir(path) as entries:
+        return sorted((entry.name, entry.path) for entry in entries if not entry.name.startswith('.'))
+
+
+def prefixed(entries, prefix):
+    """
+    Find the entries of a sorted directory listing with names starting with a prefix
+    :param entries: sorted list of (entry name, entry path)
+    :param prefix: Prefix of the entry names
+    :return: list of (entry name, entry path)
+    """
+    start = bisect_left(entries, (prefix,))
+    matches = list()
+    for name, path in entries[start:]:
+        if not name.startswith(prefix):
+            break
+        matches.append((name, path))
+    return matches
+
+
 class ObjectCreation(object):
 
     def createobject(self):
         logging.info('Finding sequence files')
+        # List the sequence path (and the data path) once, rather than once per sample
+        entries = scan(self.sequencepath)
+        self.dataentries = scan(self.datapath) if self.datapath else list()
         # Find all the .fastq files in the sequence path
-        filelist = glob(os.path.join(self.sequencepath, '*.fastq*'))
+        filelist = [path for name, path in entries if '.fastq' in name]
         if filelist:
             self.extension = 'fastq'
             self.filehandler(filelist)
         else:
-            filelist = glob(os.path.join(self.sequencepath, '*.fa*'))
+            filelist = [path for name, path in entries if '.fa' in name]
             self.extension = 'fasta'
             self.filehandler(filelist)
 
     def filehandler(self, filelist):
-        # Extract the base name of the globbed name + path provided
+        # Group the files by the sample name extracted from the file name
         if self.extension == 'fastq':
-            names = map(lambda x: os.path.split(x)[1], filer(filelist))
+            groups = {os.path.split(name)[1]: files for name, files in filer(filelist, returndict=True).items()}
         else:
-            names = map(lambda x: os.path.split(x)[1].split('.')[0], filelist)
-        # Iterate through the names of the fastq files
-        for name in sorted(names):
+            groups = dict()
+            for path in filelist:
+                groups.setdefault(os.path.split(path)[1].split('.')[0], list()).append(path)
+        # Iterate through the names of the samples
+        for name in sorted(groups):
             # Set the name
             metadata = MetadataObject()
             metadata.name = name
@@ -36,7 +67,7 @@ class ObjectCreation(object):
             # Make the destination folder
             make_path(outputdir)
             # Get the files specific to the sequence name
-            specific = glob(os.path.join(self.sequencepath, '{}*{}*'.format(name, self.extension)))
+            specific = [path for path in groups[name] if self.extension in os.path.basename(path)[len(name):]]
             # Initialise the general and commands GenObjects
             metadata.general = GenObject()
             metadata.commands = GenObject()
@@ -59,7 +90,8 @@ class ObjectCreation(object):
             metadata.general.logerr = os.path.join(outputdir, 'err')
             if self.datapath:
                 # Find the data files corresponding to the sample
-                datafiles = glob(os.path.join(self.datapath, '{}*.csv'.format(metadata.name)))
+                datafiles = [path for entry, path in prefixed(self.dataentries, metadata.name)
+                             if entry.endswith('.csv')]
                 # Assign attributes to the files depending on whether they are abundance files or not
                 for datafile in datafiles:
                     if 'abundance' in datafile:
@@ -82,4 +114,5 @@ class ObjectCreation(object):
                 .format(self.datapath)
         self.start = inputobject.start
         self.extension = ''
+        self.dataentries = list()
         self.createobject()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from itertools import product
+from bisect import bisect_left
+import os
+
+__author__ = 'adamkoziol'
+
+# Dictionary of degenerate IUPAC codes
+IUPAC = {
+    'R': 'AG',
+    'Y': 'CT',
+    'S': 'CG',
+    'W': 'AT',
+    'K': 'GT',
+    'M': 'AC',
+    'B': 'CGT',
+    'D': 'AGT',
+    'H': 'ACT',
+    'V': 'ACG',
+    'N': 'ACGT',
+    'A': 'A',
+    'C': 'C',
+    'G': 'G',
+    'T': 'T'
+}
+COMPLEMENT = str.maketrans('ACGTRYSWKMBDHVN', 'TGCAYRSWMKVHDBN')
+
+
+def reverse_complement(sequence):
+    """
+    Reverse complement a (possibly degenerate) nucleotide sequence
+    :param sequence: string of the sequence
+    :return: string of the reverse complemented sequence
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+class ElectronicPCR(object):
+    """
+    In-process replacement for the famap -> fahash -> re-PCR pipeline. The primer set is hashed once, and every
+    assembly is scanned with that shared index. The same mismatch and gap tolerances as re-PCR are supported, and the
+    hits are returned as re-PCR-formatted, tab-separated records:
+    <STS name> <contig> <strand> <start> <end> <mismatches> <gaps> <actual length>/<expected length>
+    """
+
+    def read_primers(self, primerfile):
+        """
+        Read in a re-PCR-formatted primer file: name, forward primer, reverse primer, and optionally either the expected
+        amplicon size, or the minimum and maximum amplicon sizes
+        :param primerfile: Name and path of the primer file
+        """
+        with open(primerfile, 'r') as primers:
+            for line in primers:
+                data = line.split()
+                if len(data) < 3 or line.startswith('#'):
+                    continue
+                name, forward, reverse = data[0], data[1].upper(), data[2].upper()
+                # Set the expected amplicon size range. A single size is expanded by the margin
+                if len(data) >= 5:
+                    minimum, maximum = int(data[3]), int(data[4])
+                    expected = '{min}-{max}'.format(min=minimum, max=maximum)
+                    lower, upper = minimum - self.margin, maximum + self.margin
+                elif len(data) == 4:
+                    if '-' in data[3]:
+                        minimum, maximum = [int(size) for size in data[3].split('-')]
+                    else:
+                        minimum = maximum = int(data[3])
+                    expected = '{min}-{max}'.format(min=minimum, max=maximum)
+                    lower, upper = minimum - self.margin, maximum + self.margin
+                else:
+                    lower, upper = self.sizerange
+                    expected = '{min}-{max}'.format(min=lower, max=upper)
+                self.sts.append((name, forward, reverse, max(lower, 0), upper, expected))
+
+    def index_primers(self):
+        """
+        Hash the primers. Each primer is split into mismatches + gaps + 1 segments: any site within the tolerances
+        must match at least one of these segments exactly, so the segments are used as seeds. The primers are
+        indexed as they appear on the forward strand of the template: the forward primer, and the reverse complement
+        of the reverse primer
+        """
+        for index, (name, forward, reverse, lower, upper, expected) in enumerate(self.sts):
+            for role, primer in (('F', forward), ('RC', reverse_complement(reverse)),
+                                 ('R', reverse), ('FC', reverse_complement(forward))):
+                segments = self.mismatches + self.gaps + 1
+                length = max(len(primer) // segments, 1)
+                for segment in range(segments):
+                    offset = segment * length
+                    # The final segment includes any remaining bases
+                    seed = primer[offset:] if segment == segments - 1 else primer[offset:offset + length]
+                    # Expand any degenerate bases in the seed
+                    for variant in product(*[IUPAC.get(base, base) for base in seed]):
+                        self.seeds.setdefault(''.join(variant), set()).add((index, role, offset))
+
+    def match(self, primer, sequence, start):
+        """
+        Determine whether a primer matches a template at a position within the allowed tolerances
+        :param primer: string of the primer sequence, as it appears on the forward strand of the template
+        :param sequence: string of the template sequence
+        :param start: position on the template of the first base of the primer
+        :return: tuple of the number of mismatches, the number of gaps, and the end position of the site on the
+        template, or None if the primer does not match
+        """
+        if not self.gaps:
+            end = start + len(primer)
+            if start < 0 or end > len(sequence):
+                return None
+            mismatches = 0
+            for base, template in zip(primer, sequence[start:end]):
+                if template not in IUPAC.get(base, base):
+                    mismatches += 1
+                    if mismatches > self.mismatches:
+                        return None
+            return mismatches, 0, end
+        return self.gapped_match(primer, sequence, start)
+
+    def gapped_match(self, primer, sequence, start):
+        """
+        Align a primer to a template allowing up to self.gaps insertions or deletions. The 5' end of the primer is
+        anchored at the start position, and the alignment with the fewest mismatches, then the fewest gaps, is kept
+        :param primer: string of the primer sequence
+        :param sequence: string of the template sequence
+        :param start: position on the template of the first base of the primer
+        :return: tuple of the number of mismatches, the number of gaps, and the end position of the site on the
+        template, or None if the primer does not match
+        """
+        if start < 0:
+            return None
+        window = sequence[start:start + len(primer) + self.gaps]
+        best = None
+        # Store the fewest mismatches of the alignments of the primer prefix to the template prefix with each number of
+        # gaps: (primer position, template position, gaps): mismatches
+        states = {(0, 0, 0): 0}
+        for i in range(len(primer) + 1):
+            for j in range(max(0, i - self.gaps), min(len(window), i + self.gaps) + 1):
+                for gaps in range(self.gaps + 1):
+                    mismatches = states.get((i, j, gaps))
+                    if mismatches is None:
+                        continue
+                    if i == len(primer):
+                        if best is None or (mismatches, gaps) < best[:2]:
+                            best = (mismatches, gaps, start + j)
+                        continue
+                    # Match or mismatch
+                    if j < len(window):
+                        cost = mismatches + (window[j] not in IUPAC.get(primer[i], primer[i]))
+                        if cost <= self.mismatches and cost < states.get((i + 1, j + 1, gaps), cost + 1):
+                            states[(i + 1, j + 1, gaps)] = cost
+                    if gaps < self.gaps:
+                        # Deletion from the template
+                        if mismatches < states.get((i + 1, j, gaps + 1), mismatches + 1):
+                            states[(i + 1, j, gaps + 1)] = mismatches
+                        # Insertion in the template
+                        if j < len(window) and mismatches < states.get((i, j + 1, gaps + 1), mismatches + 1):
+                            states[(i, j + 1, gaps + 1)] = mismatches
+        return best
+
+    def sites(self, sequence):
+        """
+        Find all the primer binding sites on a contig using the seed index
+        :param sequence: string of the contig sequence
+        :return: dictionary of (STS index, role): set of (start, end, mismatches, gaps)
+        """
+        found = dict()
+        for seed, placements in self.seeds.items():
+            position = sequence.find(seed)
+            while position != -1:
+                for index, role, offset in placements:
+                    primer = self.primers[(index, role)]
+                    # Indels upstream of the seed shift the start of the primer. Keep the best of the shifted sites
+                    best = None
+                    for shift in range(-self.gaps, self.gaps + 1):
+                        start = position - offset + shift
+                        result = self.match(primer, sequence, start)
+                        if result and (best is None or result[:2] < best[2:]):
+                            best = (start, result[2], result[0], result[1])
+                    if best:
+                        found.setdefault((index, role), set()).add(best)
+                position = sequence.find(seed, position + 1)
+        return found
+
+    def search(self, assembly):
+        """
+        Scan an assembly for amplicons
+        :param assembly: Name and path of the FASTA-formatted assembly
+        :return: list of re-PCR-formatted, tab-separated hit records
+        """
+        results = list()
+        with open(assembly, 'r') as fasta:
+            for header, sequence in SimpleFastaParser(fasta):
+                contig = header.split()[0]
+                sequence = sequence.upper()
+                found = self.sites(sequence)
+                for index, (name, forward, reverse, lower, upper, expected) in enumerate(self.sts):
+                    # Plus strand amplicons start with the forward primer, and end with the reverse complement of the
+                    # reverse primer. Minus strand amplicons start with the reverse primer
+                    for strand, left, right in (('+', 'F', 'RC'), ('-', 'R', 'FC')):
+                        lefts = sorted(found.get((index, left), set()))
+                        rights = sorted(found.get((index, right), set()), key=lambda site: site[1])
+                        ends = [site[1] for site in rights]
+                        amplicons = dict()
+                        for start, leftend, leftmismatches, leftgaps in lefts:
+                            # Only pair the sites that produce an amplicon within the allowed size range
+                            for rightstart, end, rightmismatches, rightgaps in \
+                                    rights[bisect_left(ends, start + max(lower, 1)):]:
+                                if end - start > upper:
+                                    break
+                                if rightstart < start:
+                                    continue
+                                score = (leftmismatches + rightmismatches, leftgaps + rightgaps)
+                                if (start, end) not in amplicons or score < amplicons[(start, end)]:
+                                    amplicons[(start, end)] = score
+                        for (start, end), (mismatches, gaps) in sorted(amplicons.items()):
+                            results.append('\t'.join([name, contig, strand, str(start + 1), str(end), str(mismatches),
+                                                      str(gaps), '{actual}/{expected}'.format(actual=end - start,
+                                                                                              expected=expected)]))
+        return results
+
+    def write(self, results, outputfile):
+        """
+        Write the hit records to file
+        :param results: list of re-PCR-formatted hit records
+        :param outputfile: Name and path of the output file
+        """
+        os.makedirs(os.path.dirname(outputfile) or '.', exist_ok=True)
+        with open(outputfile, 'w') as output:
+            output.write(''.join('{result}\n'.format(result=result) for result in results))
+
+    def __init__(self, primerfile, mismatches=0, gaps=0, margin=50, sizerange=(100, 350)):
+        """
+        :param primerfile: Name and path of the re-PCR-formatted primer file
+        :param mismatches: Maximum number of mismatches allowed per primer (re-PCR -n)
+        :param gaps: Maximum number of indels allowed per primer (re-PCR -g)
+        :param margin: Allowed variability of the size of amplicons with an expected size (re-PCR -m)
+        :param sizerange: Minimum and maximum size of amplicons without an expected size (re-PCR -d)
+        """
+        self.primerfile = primerfile
+        self.mismatches = mismatches
+        self.gaps = gaps
+        self.margin = margin
+        self.sizerange = sizerange
+        self.sts = list()
+        self.seeds = dict()
+        self.read_primers(self.primerfile)
+        # Store the primer sequences as they appear on the forward strand of the template
+        self.primers = dict()
+        for index, (name, forward, reverse, lower, upper, expected) in enumerate(self.sts):
+            self.primers[(index, 'F')] = forward
+            self.primers[(index, 'RC')] = reverse_complement(reverse)
+            self.primers[(index, 'R')] = reverse
+            self.primers[(index, 'FC')] = reverse_complement(forward)
+        self.index_primers()
+
+
+def epcr_search(engine, assembly, outputfile):
+    """
+    Scan an assembly for amplicons, and write the hit records to file. If the output file already exists, the
+    previously calculated records are read from the file instead
+    :param engine: ElectronicPCR object with the hashed primers
+    :param assembly: Name and path of the FASTA-formatted assembly
+    :param outputfile: Name and path of the output file
+    :return: list of re-PCR-formatted hit records
+    """
+    if os.path.isfile(outputfile):
+        with open(outputfile, 'r') as output:
+            return [line.rstrip('\n') for line in output if line.strip()]
+    results = engine.search(assembly)
+    engine.write(results, outputfile)
+    return results
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import xml.etree.ElementTree as ElementTree
+import pandas as pd
+import numpy as np
+import os
+
+__author__ = 'adamkoziol'
+
+"""
+Readers for the Illumina InterOp binary files. Each file starts with a one byte version and a one byte record size,
+followed by any version-specific header fields and then fixed-size little-endian records, so the records are read into
+numpy structured arrays in a single call, and aggregated with pandas
+"""
+
+
+def read_interop(filename):
+    """
+    Read the contents of an InterOp file, and split off the version and record size
+    :param filename: Name and path of the InterOp file
+    :return: version, record size, bytes of the remainder of the file
+    """
+    with open(filename, 'rb') as interop:
+        data = interop.read()
+    if len(data) < 2:
+        raise ValueError('{fn} is not a valid InterOp file'.format(fn=filename))
+    return data[0], data[1], data[2:]
+
+
+def records(data, dtype, filename):
+    """
+    Create a structured array from the records of an InterOp file
+    :param data: bytes of the records
+    :param dtype: numpy dtype of a single record
+    :param filename: Name of the InterOp file, used in error messages
+    :return: numpy structured array
+    """
+    dtype = np.dtype(dtype)
+    # Ignore any incomplete final record e.g. from a run that is still in progress
+    usable = len(data) - len(data) % dtype.itemsize
+    if not usable and data:
+        raise ValueError('Unexpected record size in {fn}'.format(fn=filename))
+    return np.frombuffer(data[:usable], dtype=dtype)
+
+
+def error_metrics(filename):
+    """
+    Read ErrorMetricsOut.bin (versions 3 and 4)
+    :param filename: Name and path of the file
+    :return: pandas DataFrame of the lane, tile, cycle, and error rate of each record
+    """
+    version, size, data = read_interop(filename)
+    if version == 3 and size == 30:
+        dtype = [('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('error_rate', '<f4'), ('errors', '<u4', 5)]
+    elif version == 4 and size == 12:
+        dtype = [('lane', '<u2'), ('tile', '<u4'), ('cycle', '<u2'), ('error_rate', '<f4')]
+    else:
+        raise ValueError('Unsupported ErrorMetricsOut version {v} with record size {s}'.format(v=version, s=size))
+    metrics = records(data, dtype, filename)
+    return pd.DataFrame({field: metrics[field] for field in ['lane', 'tile', 'cycle', 'error_rate']})
+
+
+def tile_metrics(filename):
+    """
+    Read TileMetricsOut.bin (versions 2 and 3)
+    :param filename: Name and path of the file
+    :return: pandas DataFrame of the lane, tile, cluster density, PF cluster density, cluster count, and PF cluster count
+    of each tile, pandas DataFrame of the lane, tile, read, and percent aligned to PhiX of each tile
+    """
+    version, size, data = read_interop(filename)
+    if version == 2 and size == 10:
+        metrics = records(data, [('lane', '<u2'), ('tile', '<u2'), ('code', '<u2'), ('value', '<f4')], filename)
+        table = pd.DataFrame({field: metrics[field] for field in ['lane', 'tile', 'code', 'value']})
+        # Codes 100-103 are the tile statistics, and codes 300 + (read - 1) are the percent aligned of each read
+        tiles = table[table['code'].isin([100, 101, 102, 103])] \
+            .pivot_table(index=['lane', 'tile'], columns='code', values='value', aggfunc='last') \
+            .reindex(columns=[100, 101, 102, 103])
+        tiles.columns = ['density', 'density_pf', 'clusters', 'clusters_pf']
+        aligned = table[(table['code'] >= 300) & (table['code'] < 400)]
+        aligned = pd.DataFrame({'lane': aligned['lane'],
+                                'tile': aligned['tile'],
+                                'read': aligned['code'] - 299,
+                                'aligned': aligned['value']})
+    elif version == 3 and size == 15:
+        # The version 3 header includes the area of a tile (mm2)
+        area = float(np.frombuffer(data[:4], dtype='<f4')[0])
+        data = data[4:]
+        counts = records(data, [('lane', '<u2'), ('tile', '<u4'), ('code', 'u1'), ('clusters', '<f4'),
+                                ('clusters_pf', '<f4')], filename)
+        reads = records(data, [('lane', '<u2'), ('tile', '<u4'), ('code', 'u1'), ('read', '<u4'),
+                               ('aligned', '<f4')], filename)
+        # Records with the 't' code contain the cluster counts, and records with the 'r' code the percent aligned
+        counts = counts[counts['code'] == ord('t')]
+        reads = reads[reads['code'] == ord('r')]
+        tiles = pd.DataFrame({'lane': counts['lane'],
+                              'tile': counts['tile'],
+                              'density': counts['clusters'] / area if area else np.nan,
+                              'density_pf': counts['clusters_pf'] / area if area else np.nan,
+                              'clusters': counts['clusters'],
+                              'clusters_pf': counts['clusters_pf']}).groupby(['lane', 'tile']).last()
+        aligned = pd.DataFrame({field: reads[field] for field in ['lane', 'tile', 'read', 'aligned']})
+    else:
+        raise ValueError('Unsupported TileMetricsOut version {v} with record size {s}'.format(v=version, s=size))
+    return tiles.reset_index(), aligned.reset_index(drop=True)
+
+
+def q_metrics(filename):
+    """
+    Read QMetricsOut.bin (versions 4 to 7), and reduce the quality score histogram of each record to the total number
+    of base calls, and the number of base calls with a quality score of at least 30
+    :param filename: Name and path of the file
+    :return: pandas DataFrame of the lane, tile, cycle, total base calls, and base calls >= Q30 of each record
+    """
+    version, size, data = read_interop(filename)
+    if version not in (4, 5, 6, 7):
+        raise ValueError('Unsupported QMetricsOut version {v}'.format(v=version))
+    # Quality score of each bin of the histogram - without binning, bin i is Q(i + 1)
+    qscores = np.arange(1, 51)
+    if version >= 5:
+        binned = data[0]
+        data = data[1:]
+        if binned:
+            bins = data[0]
+            # The lower bounds, upper bounds, and remapped quality scores of the bins
+            remapped = np.frombuffer(data[1 + 2 * bins:1 + 3 * bins], dtype='u1')
+            data = data[1 + 3 * bins:]
+            # Versions 6 and 7 only store the binned counts
+            if version >= 6:
+                qscores = remapped.astype(int)
+    # The size of the tile field is inferred from the record size
+    tile = '<u2' if size - 4 * len(qscores) == 6 else '<u4'
+    metrics = records(data, [('lane', '<u2'), ('tile', tile), ('cycle', '<u2'), ('histogram', '<u4', len(qscores))],
+                      filename)
+    histogram = metrics['histogram'].astype(np.int64)
+    return pd.DataFrame({'lane': metrics['lane'],
+                         'tile': metrics['tile'],
+                         'cycle': metrics['cycle'],
+                         'total': histogram.sum(axis=1),
+                         'q30': histogram[:, qscores >= 30].sum(axis=1)})
+
+
+def extraction_metrics(filename):
+    """
+    Read ExtractionMetricsOut.bin (versions 2 and 3)
+    :param filename: Name and path of the file
+    :return: pandas DataFrame of the lane, tile, cycle, and intensity of the first channel of each record
+    """
+    version, size, data = read_interop(filename)
+    if version == 2 and size == 38:
+        dtype = [('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('fwhm', '<f4', 4), ('intensity', '<u2', 4),
+                 ('datetime', '<u8')]
+    elif version == 3:
+        # The version 3 header includes the number and the names of the channels
+        channels = data[0]
+        offset = 1
+        for channel in range(channels):
+            offset += 2 + int(np.frombuffer(data[offset:offset + 2], dtype='<u2')[0])
+        data = data[offset:]
+        dtype = [('lane', '<u2'), ('tile', '<u4'), ('cycle', '<u2'), ('fwhm', '<f4', channels),
+                 ('intensity', '<u2', channels)]
+        if np.dtype(dtype).itemsize != size:
+            raise ValueError('Unexpected record size in {fn}'.format(fn=filename))
+    else:
+        raise ValueError('Unsupported ExtractionMetricsOut version {v} with record size {s}'.format(v=version, s=size))
+    metrics = records(data, dtype, filename)
+    return pd.DataFrame({'lane': metrics['lane'],
+                         'tile': metrics['tile'],
+                         'cycle': metrics['cycle'],
+                         'intensity_c1': metrics['intensity'][:, 0]})
+
+
+def run_info(path):
+    """
+    Read the structure of the reads from RunInfo.xml
+    :param path: Path of the run folder
+    :return: pandas DataFrame of the number, first cycle, last cycle, and whether the read is an index read, of each read
+    """
+    runinfo = os.path.join(path, 'RunInfo.xml')
+    reads = list()
+    if os.path.isfile(runinfo):
+        for read in ElementTree.parse(runinfo).getroot().iter('Read'):
+            reads.append((int(read.get('Number')), int(read.get('NumCycles')), read.get('IsIndexedRead') == 'Y'))
+    structure = pd.DataFrame(sorted(reads), columns=['read', 'cycles', 'indexed'])
+    structure['last'] = structure['cycles'].cumsum()
+    structure['first'] = structure['last'] - structure['cycles'] + 1
+    return structure
+
+
+def assign_reads(table, structure):
+    """
+    Add the number of the read to each cycle of a table of per-cycle metrics
+    :param table: pandas DataFrame with a cycle column
+    :param structure: pandas DataFrame of the structure of the reads from run_info
+    :return: the table with a read column
+    """
+    if structure.empty:
+        # Without RunInfo.xml, treat the run as a single read
+        return table.assign(read=1)
+    reads = np.searchsorted(structure['last'].values, table['cycle'].values)
+    table = table[reads < len(structure)]
+    return table.assign(read=structure['read'].values[reads[reads < len(structure)]])
+
+
+def summarise(path):
+    """
+    Calculate the run statistics from the InterOp files of a run
+    :param path: Path of the run folder containing the InterOp folder and RunInfo.xml
+    :return: pandas DataFrame of the statistics of each lane and read, dictionary of the statistics of the run
+    """
+    interop = os.path.join(path, 'InterOp')
+    structure = run_info(path)
+    summary = list()
+    lanes = list()
+    totals = dict()
+    # Yield and %>=Q30 from the quality score histograms
+    quality = os.path.join(interop, 'QMetricsOut.bin')
+    if os.path.isfile(quality):
+        q = assign_reads(q_metrics(quality), structure).groupby(['lane', 'read'])[['total', 'q30']].sum()
+        summary.append(pd.DataFrame({'yield': q['total'] / 1e9,
+                                     'over_q30': q['q30'] / q['total'].where(q['total'] > 0) * 100}))
+        totals['actual_yield'] = q['total'].sum() / 1e9
+        totals['over_q30'] = q['q30'].sum() / q['total'].sum() * 100 if q['total'].sum() else np.nan
+    # Error rate of the PhiX reads - the mean of the error rate of each tile
+    errors = os.path.join(interop, 'ErrorMetricsOut.bin')
+    if os.path.isfile(errors):
+        error = assign_reads(error_metrics(errors), structure)
+        error = error.groupby(['lane', 'read', 'tile'])['error_rate'].mean().groupby(['lane', 'read']).mean()
+        summary.append(error.to_frame())
+    # Cluster density and percent aligned to PhiX from the tile metrics
+    tilefile = os.path.join(interop, 'TileMetricsOut.bin')
+    if os.path.isfile(tilefile):
+        tiles, aligned = tile_metrics(tilefile)
+        lanes.append(tiles.groupby('lane').agg(cluster_density=('density', 'mean'),
+                                               cluster_density_pf=('density_pf', 'mean'),
+                                               clusters=('clusters', 'sum'),
+                                               clusters_pf=('clusters_pf', 'sum')))
+        summary.append(aligned.dropna().groupby(['lane', 'read'])['aligned'].mean().to_frame('phix_aligned'))
+        totals['cluster_density'] = tiles['density'].mean() / 1000
+        if not structure.empty:
+            totals['projected_yield'] = tiles['clusters_pf'].sum() * structure['cycles'].sum() / 1e9
+    # Intensity of the first channel at the first cycle
+    extraction = os.path.join(interop, 'ExtractionMetricsOut.bin')
+    if os.path.isfile(extraction):
+        intensities = extraction_metrics(extraction)
+        lanes.append(intensities[intensities['cycle'] == 1].groupby('lane')['intensity_c1'].mean().to_frame())
+    table = pd.concat(summary, axis=1) if summary else pd.DataFrame(index=pd.MultiIndex.from_arrays(
+        [[], []], names=['lane', 'read']))
+    if lanes:
+        table = table.join(pd.concat(lanes, axis=1), on='lane', how='outer') if summary \
+            else pd.concat(lanes, axis=1)
+    table = table.reset_index()
+    if 'cluster_density' in table:
+        # Report the densities in K/mm2
+        table['cluster_density'] /= 1000
+        table['cluster_density_pf'] /= 1000
+    # The PhiX statistics of the run are the means of the statistics of the non-index reads
+    if 'read' in table and not structure.empty:
+        table = table.merge(structure[['read', 'indexed']], on='read', how='left')
+        reads = table[~table['indexed'].fillna(False).astype(bool)]
+    else:
+        reads = table
+    for metric in ['error_rate', 'phix_aligned']:
+        if metric in reads:
+            totals[metric] = reads[metric].mean()
+    return table, {metric: float(value) for metric, value in totals.items()}
@@ -1,11 +1,9 @@
 #!/usr/bin/env python3
-from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject, run_subprocess, \
-    SetupLogging
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject, SetupLogging
+from genemethods.assemblypipeline.epcr import ElectronicPCR, epcr_search
 from Bio import SeqIO, Seq
 from argparse import ArgumentParser
 from itertools import product
-from threading import Thread
-from queue import Queue
 import multiprocessing
 from glob import glob
 import logging
@@ -167,14 +165,18 @@ class Vtyper(object):
 
     def epcr_threads(self, formattedprimers, ampliconsize=1500):
         """
-        Run ePCR in a multi-threaded fashion
+        Run the in-process ePCR on the assemblies in parallel. The primer file is hashed once, and the hashed primers
+        are shared by all the samples
         """
-        # Create the threads for the ePCR analysis
-        for _ in range(self.cpus):
-            threads = Thread(target=self.epcr, args=())
-            threads.setDaemon(True)
-            threads.start()
         logging.info('Running ePCR analyses')
+        # The in-process ePCR uses the same parameters as the previous re-PCR calls: -d 1-{ampsize} (amplicon size
+        # range for primers without an expected size), -n {mismatches} (max allowed mismatches per primer),
+        # -g 0 (max allowed indels per primer)
+        engine = ElectronicPCR(primerfile=formattedprimers,
+                               mismatches=self.mismatches,
+                               gaps=0,
+                               sizerange=(1, ampliconsize))
+        epcrsamples = list()
         for sample in self.metadata:
             if sample.general.bestassemblyfile != 'NA':
                 setattr(sample, self.analysistype, GenObject())
@@ -185,55 +187,16 @@ class Vtyper(object):
                                                                    self.analysistype)
                 make_path(sample[self.analysistype].reportdir)
                 outfile = os.path.join(sample[self.analysistype].reportdir, sample.name)
-                # Set the hashing and mapping commands
-                sample.commands.famap = '{famap} -b {outfile}.famap {fasta}'\
-                    .format(famap=os.path.join(self.homepath, 'ePCR', 'famap'),
-                            outfile=outfile,
-                            fasta=sample.general.bestassemblyfile)
-                sample.commands.fahash = '{fahash} -b {outfile}.hash {outfile}.famap'\
-                    .format(fahash=os.path.join(self.homepath, 'ePCR', 'fahash'),
-                            outfile=outfile)
-                # re-PCR uses the subtyping primers list to search the contigs file using the following parameters
-                # -S {hash file} (Perform STS lookup using hash-file), -r + (Enable/disable reverse STS lookup)
-                # -m 1500 (Set variability for STS size for lookup), this very large, as I don't necessarily know
-                # the size of the amplicon
-                # -n 1 (Set max allowed mismatches per primer pair for lookup)
-                # -g 0 (Set max allowed indels per primer pair for lookup),
-                # -G (Print alignments in comments)
-                # -o {output file}
-                sample.commands.epcr = \
-                    '{rePCR} -S {outfile}.hash -r + -d 1-{ampsize} -n {mismatches} -g 0 -G -q ' \
-                    '-o {outfile}.txt {primers}'\
-                    .format(rePCR=os.path.join(self.homepath, 'ePCR', 're-PCR'),
-                            outfile=outfile,
-                            ampsize=ampliconsize,
-                            mismatches=self.mismatches,
-                            primers=sample[self.analysistype].primers)
                 sample[self.analysistype].resultsfile = '{of}.txt'.format(of=outfile)
-                # Add the sample object and the output file to the queue
-                self.epcrqueue.put((sample, outfile))
-        # Join the threads
-        self.epcrqueue.join()
-
-    def epcr(self):
-        while True:
-            sample, linkfile = self.epcrqueue.get()
-            # Run the commands if the ePCR output file doesn't exist
-            if not os.path.isfile('{lf}.txt'.format(lf=linkfile)):
-                run_subprocess(sample.commands.famap)
-                run_subprocess(sample.commands.fahash)
-                run_subprocess(sample.commands.epcr)
-            # Clean up the temporary files
-            try:
-                os.remove('{lf}.famap'.format(lf=linkfile))
-            except FileNotFoundError:
-                pass
-            try:
-                os.remove('{lf}.hash'.format(lf=linkfile))
-            except FileNotFoundError:
-                pass
-            # Signal that the thread is complete
-            self.epcrqueue.task_done()
+                epcrsamples.append(sample)
+        p = multiprocessing.Pool(processes=self.cpus)
+        results = p.starmap(epcr_search,
+                            [(engine, sample.general.bestassemblyfile, sample[self.analysistype].resultsfile)
+                             for sample in epcrsamples])
+        p.close()
+        p.join()
+        for sample, epcrresults in zip(epcrsamples, results):
+            sample[self.analysistype].epcrresults = epcrresults
 
     def epcr_parse(self):
         """
@@ -282,8 +245,7 @@ class Vtyper(object):
         self.mismatches = mismatches
         make_path(self.reportpath)
         self.devnull = open(os.devnull, 'wb')
-        self.cpus = multiprocessing.cpu_count() - 1
-        self.epcrqueue = Queue()
+        self.cpus = max(multiprocessing.cpu_count() - 1, 1)
         # Extract the path of the current script from the full path + file name
         self.homepath = os.path.split(os.path.abspath(__file__))[0]
         self.formattedprimers = os.path.join(self.homepath, 'ssi_subtyping_primers.txt')
@@ -478,7 +440,6 @@ class Custom(object):
             pass
         make_path(self.reportpath)
         self.devnull = open(os.devnull, 'wb')
-        self.epcrqueue = Queue(maxsize=multiprocessing.cpu_count())
         self.export_amplicons = export_amplicons
         self.forward_dict = dict()
         self.reverse_dict = dict()
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
-from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject
-import json
+from genemethods.assemblypipeline.metadatastore import MetadataStore
 import os
 __author__ = 'adamkoziol'
 
@@ -9,36 +8,34 @@ class MetadataReader(object):
 
     def reader(self):
         for sample in self.metadata:
-            metadatafile = '{}{}/{}_metadata.json'.format(self.path, sample.name, sample.name)
-            if os.path.isfile(metadatafile):
-                size = os.stat(metadatafile).st_size
-                if size != 0:
-                    try:
-                        with open(metadatafile) as metadatareport:
-                            jsondata = json.load(metadatareport)
-                        # Create the metadata objects
-                        metadata = MetadataObject()
-                        # Initialise the metadata categories as GenObjects created using the appropriate key
-                        for attr in jsondata:
-                            if not isinstance(jsondata[attr], dict):
-                                setattr(metadata, attr, jsondata[attr])
-                            else:
-                                setattr(metadata, attr, GenObject(jsondata[attr]))
-                        # As files often need to be reanalysed after being moved, test to see if it possible to use the
-                        # metadata from the previous assembly
-                        jsonfile = '{}/{}_metadata.json'.format(metadata.general.outputdirectory, sample.name)
-                        try:
-                            # Open the metadata file to write
-                            with open(jsonfile, 'w') as metadatafile:
-                                # Write the json dump of the object dump to the metadata file
-                                json.dump(sample.dump(), metadatafile, sort_keys=True, indent=4, separators=(',', ': '))
-                            # Set the name
-                            metadata.name = sample.name
-                            self.samples.append(metadata)
-                        except IOError:
-                            self.samples.append(sample)
-                    except ValueError:
-                        self.samples.append(sample)
+            samplepath = '{}{}'.format(self.path, sample.name)
+            metadatafile = '{}/{}_metadata.json'.format(samplepath, sample.name)
+            # Only use non-empty .json files
+            if os.path.isfile(metadatafile) and os.stat(metadatafile).st_size == 0:
+                metadatafile = None
+            try:
+                # Open the line-delimited store of the metadata. It is created from the .json file if it does not exist,
+                # or if the .json file has since been updated
+                store = MetadataStore(samplepath, sample.name, metadatafile)
+            except (OSError, ValueError):
+                self.samples.append(sample)
+                continue
+            if not store.index:
+                self.samples.append(sample)
+                continue
+            # Create the metadata object. The categories are only read from the store when they are first accessed
+            metadata = store.load()
+            # As files often need to be reanalysed after being moved, test to see if it possible to use the
+            # metadata from the previous assembly
+            try:
+                outputdirectory = metadata.general.outputdirectory
+            except AttributeError:
+                self.samples.append(sample)
+                continue
+            if os.path.isdir(outputdirectory) and os.access(outputdirectory, os.W_OK):
+                # Set the name
+                metadata.name = sample.name
+                self.samples.append(metadata)
             else:
                 self.samples.append(sample)
 
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject
+import json
+import os
+
+__author__ = 'adamkoziol'
+
+
+def signature(filename):
+    """
+    Identify the version of a file by its size and modification time
+    :param filename: Name and path of the file
+    :return: list of the size and the modification time (ns) of the file
+    """
+    stat = os.stat(filename)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def save_metadata(samples):
+    """
+    Save the metadata of the samples to their stores. This is called after the .json metadata files are printed, so
+    that the stores are in sync with them, and are not converted again when the metadata is next read
+    :param samples: list of MetadataObjects
+    """
+    for sample in samples:
+        try:
+            path = sample.general.outputdirectory
+        except AttributeError:
+            continue
+        if not os.path.isdir(path):
+            continue
+        # Samples read from a store keep a reference to it
+        if isinstance(sample.datastore, LazyCategories):
+            store = sample.datastore.store
+        else:
+            store = MetadataStore(path, sample.name)
+        jsonfile = os.path.join(path, '{}_metadata.json'.format(sample.name))
+        store.save(sample, jsonfile if os.path.isfile(jsonfile) else None)
+
+
+class LazyCategories(dict):
+    """
+    Datastore for a MetadataObject backed by a MetadataStore. Categories are only read from the store when they are
+    first accessed, and are then kept in the dictionary
+    """
+
+    def __missing__(self, key):
+        if key not in self.store.index:
+            raise KeyError(key)
+        value = self.store.read(key)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.store.index
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        for key in self.store.index:
+            if not dict.__contains__(self, key):
+                yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def keys(self):
+        return list(iter(self))
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def loaded(self, key):
+        """
+        Determine whether a category has been read from the store, or created since the store was opened
+        :param key: Name of the category
+        :return: boolean of whether the category is in memory
+        """
+        return dict.__contains__(self, key)
+
+    def __init__(self, store):
+        super(LazyCategories, self).__init__()
+        self.store = store
+
+
+class MetadataStore(object):
+    """
+    Line-delimited store of the metadata of a sample. Each category e.g. general is stored as a single line of JSON, and
+    an index of the byte offset and length of each line allows categories to be read individually
+    """
+
+    def read(self, key):
+        """
+        Read a single category from the store
+        :param key: Name of the category
+        :return: GenObject of the category, or the value itself if the category is not a dictionary
+        """
+        with open(self.storefile, 'rb') as store:
+            store.seek(self.index[key][0])
+            return self.category(json.loads(store.read(self.index[key][1]))[key])
+
+    def raw(self, key):
+        """
+        Read the stored line of a category without decoding it
+        :param key: Name of the category
+        :return: bytes of the line
+        """
+        with open(self.storefile, 'rb') as store:
+            store.seek(self.index[key][0])
+            return store.read(self.index[key][1])
+
+    @staticmethod
+    def category(value):
+        """
+        Initialise the metadata categories as GenObjects created using the appropriate key
+        :param value: Decoded value of the category
+        :return: GenObject of the value if it is a dictionary, otherwise the value
+        """
+        return GenObject(value) if isinstance(value, dict) else value
+
+    @staticmethod
+    def encode(key, value):
+        """
+        Serialise a category to a line of the store. The MetadataObject dump method is used, so that nested GenObjects
+        are converted, and unwanted keys are removed, exactly as in the .json metadata files
+        :param key: Name of the category
+        :param value: Value of the category
+        :return: bytes of the line
+        """
+        probe = MetadataObject()
+        probe.datastore[key] = value
+        return (json.dumps({key: probe.dump()[key]}, sort_keys=True, separators=(',', ':')) + '\n').encode()
+
+    def load(self):
+        """
+        Create a MetadataObject with lazily loaded categories from the store
+        :return: MetadataObject
+        """
+        metadata = MetadataObject()
+        categories = LazyCategories(self)
+        # Keep any attributes set when the MetadataObject was initialised
+        for key, value in metadata.datastore.items():
+            if key not in self.index:
+                dict.__setitem__(categories, key, value)
+        object.__setattr__(metadata, 'datastore', categories)
+        return metadata
+
+    def save(self, metadata, jsonfile=None):
+        """
+        Write the categories of a MetadataObject to the store. Categories that were never loaded are copied from the
+        existing store without being decoded, and the store is only rewritten if a category was added or changed
+        :param metadata: MetadataObject
+        :param jsonfile: Optional .json metadata file that was written from the same MetadataObject. The store is
+        marked as in sync with this file, so that it is not converted again
+        :return: boolean of whether the store was rewritten
+        """
+        categories = metadata.datastore
+        lines = list()
+        dirty = set(self.index) - set(categories)
+        for key in sorted(categories):
+            if isinstance(categories, LazyCategories) and not categories.loaded(key):
+                lines.append((key, self.raw(key)))
+                continue
+            line = self.encode(key, categories[key])
+            if key not in self.index or self.raw(key) != line:
+                dirty.add(key)
+            lines.append((key, line))
+        source = signature(jsonfile) if jsonfile else self.source
+        if not dirty and os.path.isfile(self.storefile):
+            # Only the index needs to be updated to record the new .json file
+            if source != self.source:
+                self.source = source
+                self.write_index()
+            return False
+        self.write(lines, source)
+        return True
+
+    def write(self, lines, source=None):
+        """
+        Write the lines of the store and its index
+        :param lines: list of (category, bytes of the line)
+        :param source: Signature of the .json metadata file that the store is in sync with
+        """
+        index = dict()
+        offset = 0
+        with open(self.storefile + '.tmp', 'wb') as store:
+            for key, line in lines:
+                store.write(line)
+                index[key] = [offset, len(line)]
+                offset += len(line)
+        os.replace(self.storefile + '.tmp', self.storefile)
+        self.index = index
+        self.source = source
+        self.write_index()
+
+    def write_index(self):
+        """
+        Write the index of the store, and the signature of the .json metadata file that the store is in sync with
+        """
+        with open(self.indexfile + '.tmp', 'w') as indexfile:
+            json.dump({'categories': self.index, 'source': self.source}, indexfile, sort_keys=True)
+        os.replace(self.indexfile + '.tmp', self.indexfile)
+
+    def convert(self, jsonfile):
+        """
+        Create the store from a .json metadata file
+        :param jsonfile: Name and path of the .json metadata file
+        """
+        with open(jsonfile) as metadatareport:
+            jsondata = json.load(metadatareport)
+        self.write([(key, (json.dumps({key: jsondata[key]}, sort_keys=True, separators=(',', ':')) + '\n')
+                     .encode()) for key in sorted(jsondata)], signature(jsonfile))
+
+    def read_index(self):
+        """
+        Read the index of the store, or rebuild it from the store if it is missing or out of date
+        """
+        try:
+            if os.path.getmtime(self.indexfile) >= os.path.getmtime(self.storefile):
+                with open(self.indexfile) as indexfile:
+                    index = json.load(indexfile)
+                self.index = index['categories']
+                self.source = index['source']
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        # A rebuilt index is not known to be in sync with any .json file
+        self.source = None
+        self.index = dict()
+        offset = 0
+        with open(self.storefile, 'rb') as store:
+            for line in store:
+                # Each line is a dictionary with a single key - the name of the category
+                key = next(iter(json.loads(line)))
+                self.index[key] = [offset, len(line)]
+                offset += len(line)
+
+    def __init__(self, path, name, jsonfile=None):
+        """
+        :param path: Folder in which to keep the store
+        :param name: Name of the sample
+        :param jsonfile: Optional .json metadata file. The store is (re)created from this file if the store does not
+        exist, or if the .json file was written by something other than the store e.g. a metadata printer that did
+        not save the store
+        """
+        self.storefile = os.path.join(path, '{}_metadata.jsonl'.format(name))
+        self.indexfile = os.path.join(path, '{}_metadata.idx'.format(name))
+        self.index = dict()
+        # Signature of the .json metadata file that the store is in sync with
+        self.source = None
+        if os.path.isfile(self.storefile):
+            self.read_index()
+        if jsonfile and os.path.isfile(jsonfile) and \
+                (not os.path.isfile(self.storefile) or signature(jsonfile) != self.source):
+            self.convert(jsonfile)
@@ -3,9 +3,13 @@ from olctools.accessoryFunctions.accessoryFunctions import GenObject, run_subpro
     make_path, SetupLogging
 from argparse import ArgumentParser
 from click import progressbar
+from threading import Condition, Lock, Thread
+from queue import Queue
+from io import StringIO
 import multiprocessing
 import pandas as pd
 import logging
+import time
 import csv
 import os
 
@@ -28,40 +32,78 @@ class MobRecon(object):
         Prep
         """
         logging.info('Running MOB-recon on Assemblies')
+        jobs = list()
         with progressbar(self.metadata) as bar:
-            commands = list()
             for sample in bar:
                 # Create and populate the mob_recon genobject
                 setattr(sample, self.analysistype, GenObject())
                 sample[self.analysistype].outputdir = os.path.join(sample.general.outputdirectory, self.analysistype)
                 sample[self.analysistype].contig_report = os.path.join(sample[self.analysistype].outputdir,
                                                                        'contig_report.txt')
-                sample[self.analysistype].report_dict = dict()
                 sample[self.analysistype].logout = os.path.join(sample[self.analysistype].outputdir, 'out')
                 sample[self.analysistype].logerr = os.path.join(sample[self.analysistype].outputdir, 'err')
                 make_path(sample[self.analysistype].outputdir)
                 if sample.general.bestassemblyfile != 'NA':
-                    sample.commands.mobrecon = 'mob_recon -i {fasta} -o {outdir} --run_typer -n {threads} -d {db} ' \
-                                               '--force'\
-                        .format(fasta=sample.general.bestassemblyfile,
-                                outdir=sample[self.analysistype].outputdir,
-                                threads=self.threads,
-                                db=os.path.join(self.databasepath, 'mob_recon'))
-                    # Ensure that the report doesn't already exist
-                    if not os.path.isfile(sample[self.analysistype].contig_report):
-                        # Run the analyses
-                        commands.append(sample.commands.mobrecon)
-            p = multiprocessing.Pool(processes=self.threads)
-            out_err = p.map(MobRecon.run_cmd, commands)
-            p.close()
-            p.join()
-            # At this point, out_err has a list of tuples with out as index 0 in each tuple and
-            # err at index 1 in each tuple. These will be in the same order as the samples, so retrieve them by index.
-            index = 0
-            for sample in bar:
-                # Write the outputs to the log file
-                out = out_err[index][0]
-                err = out_err[index][1]
+                    # Ensure that the report doesn't already exist. Completed samples are skipped rather than queued,
+                    # so they never wait on the jobs that are still running
+                    if self.report_complete(sample[self.analysistype].contig_report):
+                        self.timings.append((sample.name, 0, 0, 0, 'skipped'))
+                        continue
+                    jobs.append(sample)
+        if not jobs:
+            return
+        # Run the largest assemblies first, so that the small ones fill in the remaining CPUs at the end of the run
+        sizes = {sample.name: self.assembly_length(sample.general.bestassemblyfile) for sample in jobs}
+        jobs.sort(key=lambda sample: sizes[sample.name], reverse=True)
+        # Split the CPU budget: run up to budget // minthreads jobs at once, and give each job a share of the CPUs
+        # proportional to the length of its assembly
+        concurrent = max(1, min(len(jobs), self.threads // self.minthreads))
+        share = self.threads / concurrent
+        meansize = sum(sizes.values()) / len(jobs) or 1
+        for sample in jobs:
+            threads = int(round(share * sizes[sample.name] / meansize))
+            sample[self.analysistype].threads = min(self.threads, max(1, threads))
+            sample.commands.mobrecon = 'mob_recon -i {fasta} -o {outdir} --run_typer -n {threads} -d {db} ' \
+                                       '--force'\
+                .format(fasta=sample.general.bestassemblyfile,
+                        outdir=sample[self.analysistype].outputdir,
+                        threads=sample[self.analysistype].threads,
+                        db=os.path.join(self.databasepath, 'mob_recon'))
+        for i in range(concurrent):
+            threads = Thread(target=self.reconthreads, args=())
+            threads.setDaemon(True)
+            threads.start()
+        for sample in jobs:
+            self.reconqueue.put((sample, sizes[sample.name]))
+        self.reconqueue.join()
+        self.write_timings()
+
+    def reconthreads(self):
+        while True:
+            sample, size = self.reconqueue.get()
+            threads = sample[self.analysistype].threads
+            # Wait until enough of the CPU budget is free to run this job
+            with self.budget:
+                self.budget.wait_for(lambda: self.available >= threads)
+                self.available -= threads
+            start = time.time()
+            try:
+                out, err = MobRecon.run_cmd(sample.commands.mobrecon)
+            finally:
+                # Return the CPUs to the budget
+                with self.budget:
+                    self.available += threads
+                    self.budget.notify_all()
+            sample[self.analysistype].walltime = time.time() - start
+            status = 'complete' if self.report_complete(sample[self.analysistype].contig_report) else 'failed'
+            logging.info('MOB-recon {status} for {sn} ({threads} threads, {wall:.1f} s)'
+                         .format(status=status,
+                                 sn=sample.name,
+                                 threads=threads,
+                                 wall=sample[self.analysistype].walltime))
+            # Write the outputs to the log file
+            with self.lock:
+                self.timings.append((sample.name, size, threads, sample[self.analysistype].walltime, status))
                 write_to_logfile(out=sample.commands.mobrecon,
                                  err=sample.commands.mobrecon,
                                  logfile=self.logfile,
@@ -76,75 +118,160 @@ class MobRecon(object):
                                  sampleerr=sample.general.logerr,
                                  analysislog=sample[self.analysistype].logout,
                                  analysiserr=sample[self.analysistype].logerr)
-                index += 1
+            self.reconqueue.task_done()
 
     @staticmethod
     def run_cmd(command):
         out, err = run_subprocess(command)
         return out, err
 
+    @staticmethod
+    def report_complete(contig_report):
+        """
+        Determine whether a MOB-recon contig report was completely written: the file must exist, start with the
+        header, and end with a newline
+        :param contig_report: Name and path of the contig_report.txt file
+        :return: Boolean of whether the report is complete
+        """
+        try:
+            with open(contig_report, 'rb') as report:
+                header = report.readline()
+                report.seek(-1, os.SEEK_END)
+                return b'contig_id' in header and report.read(1) == b'\n'
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def assembly_length(assembly):
+        """
+        Calculate the number of bases in an assembly
+        :param assembly: Name and path of the FASTA-formatted assembly
+        :return: Integer of the total length of the sequences in the assembly
+        """
+        length = 0
+        try:
+            with open(assembly, 'r') as fasta:
+                for line in fasta:
+                    if not line.startswith('>'):
+                        length += len(line.rstrip())
+        except (IOError, OSError):
+            pass
+        return length
+
+    def write_timings(self):
+        """
+        Write the assembly length, number of threads, and wall time of each MOB-recon job to file
+        """
+        with open(os.path.join(self.reportpath, 'mob_recon_timing.tsv'), 'w') as timing:
+            timing.write('Sample\tAssemblyLength\tThreads\tWallTime\tStatus\n')
+            for name, size, threads, walltime, status in sorted(self.timings):
+                timing.write('{sn}\t{size}\t{threads}\t{wall:.1f}\t{status}\n'
+                             .format(sn=name,
+                                     size=size,
+                                     threads=threads,
+                                     wall=walltime,
+                                     status=status))
+
     def read_tsv(self):
         """
-        Read in the .tsv contig report file with pandas, and create a dictionary of all the headers: values
+        Read the .tsv contig report of every sample into a single table with a row for each sample + contig
+        combination. The summaries are created with grouped queries on this table
         """
         logging.info('Parsing MOB-recon outputs')
+        # Reports with the same header are concatenated, and parsed with a single call to pandas. Each line is prefixed
+        # with the name of the sample
+        blocks = dict()
         for sample in self.metadata:
             if os.path.isfile(sample[self.analysistype].contig_report):
-                # Read in the .tsv file with pandas. Skip the comment lines
-                df = pd.read_csv(sample[self.analysistype].contig_report, delimiter='\t')
-                for header in df:
-                    # Remove any unwanted whitespace
-                    clean_header = header.lstrip().rstrip()
-                    # primary_key is the primary key, and value is the value of the cell for that key + header combo
-                    for primary_key, value in df[header].items():
-                        # Update the dictionary with the new data
-                        try:
-                            sample[self.analysistype].report_dict[primary_key].update({clean_header: value})
-                        # Create the nested dictionary if it hasn't been created yet
-                        except KeyError:
-                            sample[self.analysistype].report_dict[primary_key] = dict()
-                            sample[self.analysistype].report_dict[primary_key].update({clean_header: value})
+                with open(sample[self.analysistype].contig_report, 'r') as report:
+                    header = report.readline()
+                    prefix = sample.name + '\t'
+                    blocks.setdefault(header, list()).extend(prefix + line for line in report if line.strip())
+        frames = list()
+        for header, lines in blocks.items():
+            # The contig and cluster IDs are always treated as strings, other columns have their types inferred
+            headers = header.rstrip('\n').split('\t')
+            dtypes = {header: str for header in headers
+                      if header.strip() in ['contig_id', 'primary_cluster_id', 'cluster_id']}
+            dtypes['sample'] = str
+            df = pd.read_csv(StringIO('sample\t' + header + ''.join(lines)), delimiter='\t', dtype=dtypes)
+            # Remove any unwanted whitespace from the headers
+            df.columns = df.columns.str.strip()
+            frames.append(df)
+        self.reports = pd.concat(frames, ignore_index=True, sort=False) if frames \
+            else pd.DataFrame(columns=['sample', 'contig_id'])
+        # Order the table by sample as in the metadata, and then by the position of the contig in the report
+        self.reports['sample'] = pd.Categorical(self.reports['sample'],
+                                                categories=[sample.name for sample in self.metadata],
+                                                ordered=True)
+        self.reports['contig_id'] = self.reports['contig_id'].astype(str)
+        self.reports = self.reports.sort_values('sample', kind='stable')\
+            .set_index(['sample', 'contig_id'], drop=False)
+
+    @staticmethod
+    def clean(series):
+        """
+        Format a column for the summary reports: commas are replaced with semicolons, and empty cells become 'ND'
+        :param series: pandas Series to format
+        :return: formatted pandas Series of strings
+        """
+        return series.astype(str).str.replace(',', ';', regex=False).where(series.notna(), 'ND')
+
+    @staticmethod
+    def unicycler(contigs):
+        """
+        Unicycler gives contigs names such as: 3_length=187116_depth=1.60x_circular=true - set the name of any
+        unicycler-like contigs to the number only (in this case, 3)
+        :param contigs: pandas Series of contig names
+        :return: pandas Series of the renamed contigs
+        """
+        parts = contigs.str.split('_')
+        unicycler = parts.str[1].str.startswith('length').fillna(False).astype(bool)
+        return contigs.where(~unicycler, parts.str[0])
+
+    def incompatibility(self, reports, cluster, rep):
+        """
+        Find all the incompatibility types of the contigs in each predicted plasmid. As the inc type will only be
+        located on one of possibly several contigs associated with a predicted plasmid, it is nice to know details
+        about the plasmid
+        :param reports: pandas DataFrame of the MOB-recon reports
+        :param cluster: Name of the cluster ID column
+        :param rep: Name of the incompatibility type column
+        :return: pandas Series of the sorted, semicolon-joined incompatibility sets indexed by sample and cluster
+        """
+        incs = pd.DataFrame({'sample': reports['sample'].astype(str).values,
+                             'cluster': reports[cluster].astype(str).values,
+                             'inc': self.clean(reports[rep]).values})
+        return incs.groupby(['sample', 'cluster'])['inc'].agg(lambda values: ';'.join(sorted(set(values))))
 
     def summary_reporter(self):
         """
         Parse individual MOB Recon reports into a summary report
         """
         logging.info('Creating MOB-recon summary report')
+        columns = ['primary_cluster_id', 'contig_id', 'size', 'gc', 'rep_type(s)', 'rep_type_accession(s)',
+                   'relaxase_type(s)', 'mpf_type', 'orit_type(s)', 'predicted_mobility', 'mash_nearest_neighbor',
+                   'mash_neighbor_distance']
         with open(os.path.join(self.reportpath, 'mob_recon_summary.csv'), 'w') as summary:
             data = 'Strain,ClusterID,Contig,Size,PercentGC,Incompatibility,IncompatibilityAccession,RelaxaseType,' \
                    'MatingPairFormationType,OriginOfTransferType,PredictedMobility,MashNearestNeighbor,' \
                    'MashNeighborDistance\n'
+            # Initialise a dictionary to store results for the COWBAT final report
             for sample in self.metadata:
-                # Initialise a dictionary to store results for the COWBAT final report
                 sample[self.analysistype].pipelineresults = dict()
-                for primarykey, results in sample[self.analysistype].report_dict.items():
-                    # Extract the name of the contig
-                    contig = results['contig_id']
-                    # Only process results if they are not calculated to be chromosomal
-                    if results['molecule_type'] != 'chromosome':
-                        data += ','.join(str(result).replace(',', ';') if str(result) != 'nan' else 'ND'
-                                         for result in [
-                                             sample.name,
-                                             results['primary_cluster_id'],
-                                             contig,
-                                             results['size'],
-                                             results['gc'],
-                                             results['rep_type(s)'],
-                                             results['rep_type_accession(s)'],
-                                             results['relaxase_type(s)'],
-                                             results['mpf_type'],
-                                             results['orit_type(s)'],
-                                             results['predicted_mobility'],
-                                             results['mash_nearest_neighbor'],
-                                             results['mash_neighbor_distance']]
-                                         )
-                        data += '\n'
-                        # Add the calculated incompatibility to the pipeline results for use in the final COWBAT report
-                        sample[self.analysistype].pipelineresults[results['primary_cluster_id']] =  \
-                            ';'.join(str(result).replace(',', ';') if str(result) != 'nan' else 'ND'
-                                     for result in [
-                                         results['rep_type(s)']]
-                                     )
+            if all(column in self.reports for column in columns + ['molecule_type']):
+                # Only process results if they are not calculated to be chromosomal
+                plasmids = self.reports[self.reports['molecule_type'] != 'chromosome']
+                table = pd.DataFrame({column: self.clean(plasmids[column]).values for column in columns})
+                table.insert(0, 'sample', plasmids['sample'].astype(str).values)
+                if not table.empty:
+                    data += table.to_csv(header=False, index=False, quoting=csv.QUOTE_NONE, escapechar='\\')
+                # Add the calculated incompatibility to the pipeline results for use in the final COWBAT report
+                table['cluster'] = plasmids['primary_cluster_id'].values
+                samples = {sample.name: sample for sample in self.metadata}
+                for name, group in table.groupby('sample', sort=False):
+                    samples[name][self.analysistype].pipelineresults = dict(zip(group['cluster'],
+                                                                                group['rep_type(s)']))
             summary.write(data)
 
     def amrsummary(self):
@@ -154,58 +281,30 @@ class MobRecon(object):
         logging.info('Creating AMR summary table from ResFinder and MOB-recon outputs')
         with open(os.path.join(self.reportpath, 'amr_summary.csv'), 'w') as amr:
             data = 'Strain,Gene,Allele,Resistance,PercentIdentity,Contig,Location,PlasmidIncompatibilitySets\n'
-            for sample in self.metadata:
-                # Initialise a dictionary to store a set of all the incompatibility types listed for a contig.
-                # As the inc type will only be located on one of possibly several contigs associated with a predicted
-                # plasmid, it is nice to know details about the plasmid
-                inc_dict = dict()
-                for primarykey, results in sample[self.analysistype].report_dict.items():
-                    try:
-                        inc = results['primary_cluster_id']
-                        # Convert the rep_type field (predicted incompatibilities) into a more a consistent
-                        # format - pandas will call empty fields 'nan', which is a float
-                        rep = str(results['rep_type(s)']).replace(',', ';') if str(results['rep_type(s)']) != 'nan' \
-                            else 'ND'
-                        # Add the incompatibility to the set
-                        try:
-                            inc_dict[inc].add(rep)
-                        except KeyError:
-                            inc_dict[inc] = set()
-                            inc_dict[inc].add(rep)
-                    except KeyError:
-                        pass
-                # Iterate through the MOB suite results
-                for primarykey, results in sample[self.analysistype].report_dict.items():
-                    try:
-                        # Extract the name of the contig
-                        contig = results['contig_id']
-                        # Unicycler gives contigs names such as: 3_length=187116_depth=1.60x_circular=true - test
-                        # to see if the contig name looks unicycler-like, and set the name appropriately (in this
-                        # case, it would be 3)
-                        try:
-                            if contig.split('_')[1].startswith('length'):
-                                contig = contig.split('_')[0]
-                        except IndexError:
-                            pass
-                        # Use the list of results from the resfinder analyses
-                        for amr_result in sample.resfinder_assembled.sampledata:
-                            # Ensure that the current contig is the same as the one in the resfinder results. Ensure
-                            # that the slice of the amr result is treated as a string. Unicycler contigs seem to be
-                            # treated as integers
-                            if str(amr_result[5]) == contig or str(amr_result[5].split('_')[0]) == contig:
-                                # Add the resistance and MOB recon outputs for the strain
-                                data += '{sn},{amr},{mob}\n'\
-                                    .format(sn=sample.name,
-                                            amr=','.join(str(res) if str(res) != 'nan' else 'ND' for res in
-                                                         amr_result[0:4]),
-                                            mob=','.join(str(res) if str(res) != 'nan' else 'ND' for res in
-                                                         [contig, results['primary_cluster_id'],
-                                                          ';'.join(sorted(inc_dict[str(results['primary_cluster_id'])]))
-                                                          ]
-                                                         )
-                                            )
-                    except KeyError:
-                        pass
+            if all(column in self.reports for column in ['primary_cluster_id', 'rep_type(s)']):
+                mob = pd.DataFrame({'sample': self.reports['sample'].astype(str).values,
+                                    'contig': self.unicycler(self.reports['contig_id']).values,
+                                    'cluster': self.reports['primary_cluster_id'].astype(str).values})
+                mob['mobrow'] = range(len(mob))
+                # Use the list of results from the resfinder analyses. Results match a contig on either the whole
+                # contig name, or the portion of the name before the first underscore
+                resistance = pd.DataFrame([[sample.name, index] + [str(res) if str(res) != 'nan' else 'ND'
+                                                                   for res in amr_result[0:4]] + [str(amr_result[5])]
+                                           for sample in self.metadata
+                                           for index, amr_result in enumerate(sample.resfinder_assembled.sampledata)],
+                                          columns=['sample', 'amrrow', 'gene', 'allele', 'resistance', 'identity',
+                                                   'amrcontig'])
+                keys = pd.concat([resistance.assign(contig=resistance['amrcontig']),
+                                  resistance.assign(contig=resistance['amrcontig'].str.split('_').str[0])])\
+                    .drop_duplicates(['sample', 'amrrow', 'contig'])
+                merged = mob.merge(keys, on=['sample', 'contig'])\
+                    .merge(self.incompatibility(self.reports, 'primary_cluster_id', 'rep_type(s)').rename('inc'),
+                           left_on=['sample', 'cluster'], right_index=True)\
+                    .sort_values(['mobrow', 'amrrow'])
+                merged['cluster'] = merged['cluster'].where(merged['cluster'] != 'nan', 'ND')
+                table = merged[['sample', 'gene', 'allele', 'resistance', 'identity', 'contig', 'cluster', 'inc']]
+                if not table.empty:
+                    data += table.to_csv(header=False, index=False, quoting=csv.QUOTE_NONE, escapechar='\\')
             amr.write(data)
 
     def geneseekrsummary(self):
@@ -215,68 +314,40 @@ class MobRecon(object):
         logging.info('Creating predicted plasmid-borne gene summary table')
         with open(os.path.join(self.reportpath, 'plasmid_borne_summary.csv'), 'w') as pbs:
             data = 'Strain,Gene,PercentIdentity,Contig,Location,PlasmidIncompatibilitySets\n'
+            rows = pd.DataFrame(columns=['sample', 'line'])
+            if all(column in self.reports for column in ['cluster_id', 'rep_type']):
+                # MOB suite 2.0.0 has different output? Use the portion of the contig name following the '|'
+                contigs = self.reports['contig_id']
+                contigs = contigs.str.split('|').str[1].where(contigs.str.contains('|', regex=False), contigs)
+                mob = pd.DataFrame({'sample': self.reports['sample'].astype(str).values,
+                                    'contig': self.unicycler(contigs).values,
+                                    'cluster': self.reports['cluster_id'].astype(str).values})
+                mob['mobrow'] = range(len(mob))
+                genes = pd.DataFrame([[sample.name, index, gene, result_dict['query_id'],
+                                       result_dict['PercentIdentity']]
+                                      for sample in self.metadata
+                                      for index, (gene, result_dict) in
+                                      enumerate(sample.geneseekr_results.sampledata.items())
+                                      if 'query_id' in result_dict],
+                                     columns=['sample', 'generow', 'gene', 'contig', 'identity'])
+                merged = mob.merge(genes, on=['sample', 'contig'])\
+                    .merge(self.incompatibility(self.reports, 'cluster_id', 'rep_type').rename('inc'),
+                           left_on=['sample', 'cluster'], right_index=True)\
+                    .sort_values(['mobrow', 'generow'])
+                # Only report the genes with a percent identity greater than the cutoff. Genes with non-numeric
+                # percent identities are reported with the strain name only
+                identity = pd.to_numeric(merged['identity'], errors='coerce')
+                merged = merged[(identity >= self.cutoff) | identity.isna()]
+                merged['line'] = (merged['sample'] + ',' + merged['gene'] + ',' + merged['identity'].astype(str) + ','
+                                  + merged['contig'] + ',' + merged['cluster'] + ',' + merged['inc'])\
+                    .where(pd.to_numeric(merged['identity'], errors='coerce').notna(), merged['sample'])
+                rows = merged[['sample', 'line']]
+            # If there were no results associated with the strain, make the row the strain name only
+            lines = rows.groupby('sample')['line'].agg(list).to_dict()
             for sample in self.metadata:
-                # Create a flag to determine whether the strain name needs to be added to the data string if there
-                # were no results
-                result_bool = False
-                # Initialise a dictionary to store a set of all the incompatibility types listed for a contig.
-                # As the inc type will only be located on one of possibly several contigs associated with a predicted
-                # plasmid, it is nice to know details about the plasmid
-                inc_dict = dict()
-                # Iterate through all the MOB recon outputs to populate the incompatibility set
-                for primarykey, results in sample[self.analysistype].report_dict.items():
-                    try:
-                        inc = results['cluster_id']
-                        # Convert the rep_type field (predicted incompatibilities) into a more a consistent
-                        # format - pandas will call empty fields 'nan', which is a float
-                        rep = str(results['rep_type']).replace(',', ';') if str(results['rep_type']) != 'nan' else 'ND'
-                        # Add the incompatibility to the set
-                        try:
-                            inc_dict[inc].add(rep)
-                        except KeyError:
-                            inc_dict[inc] = set()
-                            inc_dict[inc].add(rep)
-                    except KeyError:
-                        pass
-                for primarykey, results in sample[self.analysistype].report_dict.items():
-                    try:
-                        # MOB suite 2.0.0 has different output?
-                        try:
-                            contig = results['contig_id'].split('|')[1]
-                        except IndexError:
-                            contig = results['contig_id']
-                        # Unicycler gives contigs names such as: 3_length=187116_depth=1.60x_circular=true - test
-                        # to see if the contig name looks unicycler-like, and set the name appropriately (in this
-                        # case, it would be 3)
-                        try:
-                            if contig.split('_')[1].startswith('length'):
-                                contig = contig.split('_')[0]
-                        except IndexError:
-                            pass
-                        for gene, result_dict in sample.geneseekr_results.sampledata.items():
-                            if contig == result_dict['query_id']:
-                                percent_identity = result_dict['PercentIdentity']
-                                # Set up the output string if the percent identity of the match is greater than the
-                                # cutoff
-                                try:
-                                    if float(result_dict['PercentIdentity']) >= self.cutoff:
-                                        # As there was at least a single gene passing the threshold, set the boolean
-                                        # to True
-                                        result_bool = True
-                                        data += '{sn},'.format(sn=sample.name)
-                                        data += '{gene},{pi},{contig},{cid},{inc}\n'\
-                                            .format(gene=gene,
-                                                    pi=percent_identity,
-                                                    contig=contig,
-                                                    cid=results['cluster_id'],
-                                                    inc=';'.join(sorted(inc_dict[str(results['cluster_id'])])))
-                                except ValueError:
-                                    data += '{sn}\n'.format(sn=sample.name)
-                    except KeyError:
-                        pass
-                # If there were no results associated with the strain, make the row the strain name only
-                if not result_bool:
-                    data += '{sn}\n'.format(sn=sample.name)
+                found = lines.get(sample.name, list())
+                data += ''.join('{line}\n'.format(line=line) for line in found) if any(',' in line for line in found) \
+                    else ''.join('{line}\n'.format(line=line) for line in found) + '{sn}\n'.format(sn=sample.name)
             # Write the string to the report
             pbs.write(data)
 
@@ -290,6 +361,15 @@ class MobRecon(object):
         self.reportpath = reportpath
         self.matchtype = matchtype
         self.cutoff = cutoff
+        # The total number of CPUs shared by the concurrent MOB-recon jobs, and the minimum number of threads per job
+        self.minthreads = min(2, self.threads)
+        self.available = self.threads
+        self.budget = Condition()
+        self.lock = Lock()
+        self.reconqueue = Queue()
+        self.timings = list()
+        # Table of the MOB-recon contig reports of all the samples
+        self.reports = pd.DataFrame(columns=['sample', 'contig_id'])
 
 
 if __name__ == '__main__':
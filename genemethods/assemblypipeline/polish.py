@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+from math import ceil
+import os
+
+__author__ = 'adamkoziol'
+
+
+def contig_lengths(fasta):
+    """
+    Find the length of every contig in an assembly without reading the sequences into memory
+    :param fasta: Name and path of the FASTA-formatted assembly
+    :return: dictionary of contig name: length, in the order of the assembly
+    """
+    lengths = dict()
+    contig = None
+    with open(fasta, 'r') as assembly:
+        for line in assembly:
+            if line.startswith('>'):
+                contig = line[1:].split()[0]
+                lengths[contig] = 0
+            elif contig is not None:
+                lengths[contig] += len(line.strip())
+    return lengths
+
+
+def balance(lengths, groupsize=1000000, maxgroups=16):
+    """
+    Split the contigs of an assembly into groups of similar total length. Contigs are assigned longest first to the
+    group with the smallest total length
+    :param lengths: dictionary of contig name: length
+    :param groupsize: Target total length of each group
+    :param maxgroups: Maximum number of groups
+    :return: list of lists of contig names, longest group first
+    """
+    total = sum(lengths.values())
+    count = max(1, min(len(lengths), maxgroups, ceil(total / groupsize)))
+    groups = [[0, list()] for i in range(count)]
+    for contig in sorted(lengths, key=lambda name: lengths[name], reverse=True):
+        group = min(groups, key=lambda entry: entry[0])
+        group[0] += lengths[contig]
+        group[1].append(contig)
+    return [contigs for length, contigs in sorted(groups, key=lambda entry: entry[0], reverse=True) if contigs]
+
+
+def heap_size(length, minimum=2, perbase=2e-6):
+    """
+    Estimate the Java heap required to polish a group of contigs
+    :param length: Total length of the contigs in the group
+    :param minimum: Minimum heap size in GB
+    :param perbase: Heap size in GB required per base of the group
+    :return: heap size in GB
+    """
+    return max(minimum, ceil(1 + length * perbase))
+
+
+def merge_pieces(pieces, order, fasta, changes):
+    """
+    Merge the polished contigs and the change logs of the groups of an assembly. Only the contigs targeted in each
+    group are taken from its output, and they are written in the order of the original assembly. The outputs of the
+    groups are indexed by byte offset rather than read into memory
+    :param pieces: list of (set of targeted contig names, prefix of the pilon outputs of the group), in group order
+    :param order: list of the names of the contigs in the original assembly
+    :param fasta: Name and path of the merged, polished assembly to create
+    :param changes: Name and path of the merged change log to create
+    """
+    # Dictionary of original contig name: (polished FASTA file, start offset, end offset)
+    locations = dict()
+    for targets, prefix in pieces:
+        contig = None
+        offset = 0
+        with open(prefix + '.fasta', 'rb') as piece:
+            for line in piece:
+                if line.startswith(b'>'):
+                    if contig is not None:
+                        locations[contig] = (prefix + '.fasta', locations[contig][1], offset)
+                    # Pilon appends _pilon to the name of every contig it outputs
+                    name = line[1:].split()[0].decode().split('_pilon')[0] if line[1:].strip() else str()
+                    contig = name if name in targets else None
+                    if contig is not None:
+                        locations[contig] = (prefix + '.fasta', offset, None)
+                offset += len(line)
+            if contig is not None:
+                locations[contig] = (prefix + '.fasta', locations[contig][1], offset)
+    handles = dict()
+    try:
+        with open(fasta + '.tmp', 'wb') as polished:
+            for contig in order:
+                if contig not in locations:
+                    continue
+                filename, start, end = locations[contig]
+                if filename not in handles:
+                    handles[filename] = open(filename, 'rb')
+                handles[filename].seek(start)
+                polished.write(handles[filename].read(end - start))
+    finally:
+        for handle in handles.values():
+            handle.close()
+    with open(changes, 'w') as log:
+        for targets, prefix in pieces:
+            if os.path.isfile(prefix + '.changes'):
+                with open(prefix + '.changes', 'r') as piece:
+                    for line in piece:
+                        log.write(line)
+    os.replace(fasta + '.tmp', fasta)
@@ -2,6 +2,7 @@
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject, run_subprocess, \
     SetupLogging
 from genemethods.assemblypipeline.legacy_vtyper import epcr_primers, Filer
+import genemethods.typingclasses.stx as stx
 from Bio.Blast.Applications import NcbiblastnCommandline
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
@@ -1139,7 +1140,7 @@ class VtyperIP(object):
                     else:
                         toxin_set.add(hit_dict['experiment'].split('_')[0] + '*')
                 # Create a string of the entries in the sorted list of toxins joined with ";"
-                sample[self.analysistype].toxinprofile = ";".join(sorted(list(toxin_set))) if toxin_set else 'ND'
+                sample[self.analysistype].toxinprofile = stx.profile(toxin_set)
 
     def vtyper_report(self):
         """
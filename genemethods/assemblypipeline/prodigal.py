@@ -1,13 +1,86 @@
 #!/usr/bin/env python3
-from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, run_subprocess, write_to_logfile
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, write_to_logfile
+from subprocess import PIPE, Popen
 from threading import Thread, Lock
+from tempfile import TemporaryFile
 from click import progressbar
 from queue import Queue
+import pandas as pd
 import logging
 import os
 __author__ = 'adamkoziol'
 
 threadlock = Lock()
+# Header of the per-sample ORF tables
+ORFCOLUMNS = ['contig', 'gene', 'start', 'end', 'strand', 'length']
+
+
+def parse_sco(lines, results=None, orfs=None):
+    """
+    Parse prodigal sco-formatted output in a single pass, optionally copying the output and writing an ORF table as the
+    lines are read
+    e.g. # Sequence Data: seqnum=1;seqlen=2958;seqhdr="contig1"
+         >1_337_2799_+
+    :param lines: Iterable of lines of the sco output e.g. the stdout of prodigal, or an open results file
+    :param results: Optional open file to which the sco lines are copied
+    :param orfs: Optional open file to which the tab-separated ORF table is written
+    :return: dictionary of the gene prediction statistics
+    """
+    stats = {'predictedgenestotal': 0,
+             'predictedgenesover3000bp': 0,
+             'predictedgenesover1000bp': 0,
+             'predictedgenesover500bp': 0,
+             'predictedgenesunder500bp': 0}
+    sequencelength = 0
+    codinglength = 0
+    contig = str()
+    if orfs:
+        orfs.write('\t'.join(ORFCOLUMNS) + '\n')
+    for line in lines:
+        if results:
+            results.write(line)
+        if line.startswith('>'):
+            gene, start, end, strand = line[1:].rstrip().split('_')
+            start, end = int(start), int(end)
+            length = end - start + 1
+            codinglength += length
+            stats['predictedgenestotal'] += 1
+            # The length categories use the start - end span of the gene
+            span = abs(start - end)
+            if span > 3000:
+                stats['predictedgenesover3000bp'] += 1
+            elif span > 1000:
+                stats['predictedgenesover1000bp'] += 1
+            elif span > 500:
+                stats['predictedgenesover500bp'] += 1
+            else:
+                stats['predictedgenesunder500bp'] += 1
+            if orfs:
+                orfs.write('{contig}\t{gene}\t{start}\t{end}\t{strand}\t{length}\n'
+                           .format(contig=contig,
+                                   gene=gene,
+                                   start=start,
+                                   end=end,
+                                   strand=strand,
+                                   length=length))
+        elif line.startswith('# Sequence Data:'):
+            # Extract the length and the name of the contig from the sequence data line
+            seqnum, seqlen, seqhdr = line.rstrip().split(': ', 1)[1].split(';', 2)
+            sequencelength += int(seqlen.split('=')[1])
+            contig = seqhdr.split('=', 1)[1].strip('"').split()[0]
+    # Coding density is the fraction of the assembly within predicted genes
+    stats['codingdensity'] = round(codinglength / sequencelength, 4) if sequencelength else 0
+    stats['meangenelength'] = round(codinglength / stats['predictedgenestotal']) if stats['predictedgenestotal'] else 0
+    return stats
+
+
+def read_orfs(orftable):
+    """
+    Read a per-sample ORF table created by the Prodigal class
+    :param orftable: Name and path of the ORF table
+    :return: pandas DataFrame of the contig, gene number, start, end, strand, and length of each predicted gene
+    """
+    return pd.read_csv(orftable, sep='\t', dtype={'contig': str, 'strand': str})
 
 
 class Prodigal(object):
@@ -26,6 +99,8 @@ class Prodigal(object):
                 sample.prodigal = GenObject()
                 if sample.general.bestassemblyfile != 'NA':
                     self.predictqueue.put(sample)
+                else:
+                    self.populate(sample, parse_sco(list()))
         self.predictqueue.join()
 
     def predict(self):
@@ -36,9 +111,10 @@ class Prodigal(object):
             sample.prodigal.results_file = os.path.join(sample.prodigal.reportdir,
                                                         '{}_prodigalresults.sco'.format(sample.name))
             sample.prodigal.results = sample.prodigal.results_file
-            sample.commands.prodigal = 'prodigal -i {in1} -o {out1} -f sco -d {genes}'\
+            sample.prodigal.orftable = os.path.join(sample.prodigal.reportdir, '{}_orfs.tsv'.format(sample.name))
+            # The sco output is written to stdout, and parsed as it is produced
+            sample.commands.prodigal = 'prodigal -i {in1} -f sco -d {genes}'\
                 .format(in1=sample.general.bestassemblyfile,
-                        out1=sample.prodigal.results_file,
                         genes=os.path.join(sample.prodigal.reportdir, '{}_genes.fa'.format(sample.name)))
             # Create the folder to store the reports
             make_path(sample.prodigal.reportdir)
@@ -47,46 +123,61 @@ class Prodigal(object):
             if os.path.isfile(sample.prodigal.results_file):
                 size = os.stat(sample.prodigal.results_file).st_size
             if not os.path.isfile(sample.prodigal.results_file) or size == 0:
-                # Run the command
-                out, err = run_subprocess(sample.commands.prodigal)
-                threadlock.acquire()
-                write_to_logfile(sample.commands.prodigal, sample.commands.prodigal, self.logfile,
-                                 sample.general.logout, sample.general.logerr, None,
-                                 None)
-                write_to_logfile(out, err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
-                threadlock.release()
+                stats = self.stream(sample)
+            else:
+                # Parse the existing report
+                with open(sample.prodigal.results_file, 'r') as results, open(sample.prodigal.orftable, 'w') as orfs:
+                    stats = parse_sco(results, orfs=orfs)
+            self.populate(sample, stats)
             self.predictqueue.task_done()
 
-    def prodigalparse(self):
-        logging.info('Parsing gene predictions')
-        for sample in self.metadata:
-            sample.prodigal.predictedgenestotal = 0
-            sample.prodigal.predictedgenesover3000bp = 0
-            sample.prodigal.predictedgenesover1000bp = 0
-            sample.prodigal.predictedgenesover500bp = 0
-            sample.prodigal.predictedgenesunder500bp = 0
-            if sample.general.bestassemblyfile != 'NA':
-                with open(sample.prodigal.results, 'r') as results:
-                    for line in results:
-                        if line.startswith('>'):
-                            start = int(line.split('_')[1])
-                            end = int(line.split('_')[2])
-                            length = abs(start - end)
-                            sample.prodigal.predictedgenestotal += 1
-                            if length > 3000:
-                                sample.prodigal.predictedgenesover3000bp += 1
-                            elif length > 1000:
-                                sample.prodigal.predictedgenesover1000bp += 1
-                            elif length > 500:
-                                sample.prodigal.predictedgenesover500bp += 1
-                            else:
-                                sample.prodigal.predictedgenesunder500bp += 1
+    def stream(self, sample):
+        """
+        Run prodigal, and parse the predictions from its stdout as they are produced. The output is copied to the
+        results file, which is only put in place once prodigal has finished, so interrupted predictions are re-run. If
+        prodigal fails, the partial outputs are removed, and no statistics are returned
+        :param sample: metadata object of the sample
+        :return: dictionary of the gene prediction statistics
+        """
+        partial = sample.prodigal.results_file + '.tmp'
+        with open(partial, 'w') as results, open(sample.prodigal.orftable, 'w') as orfs, \
+                TemporaryFile('w+') as errors:
+            # stderr is spooled to a temporary file, so that the progress messages cannot fill the pipe and block
+            process = Popen(sample.commands.prodigal, shell=True, stdout=PIPE, stderr=errors, universal_newlines=True)
+            stats = parse_sco(process.stdout, results=results, orfs=orfs)
+            process.stdout.close()
+            process.wait()
+            errors.seek(0)
+            err = errors.read()
+        with threadlock:
+            write_to_logfile(sample.commands.prodigal, sample.commands.prodigal, self.logfile,
+                             sample.general.logout, sample.general.logerr, None,
+                             None)
+            write_to_logfile(str(), err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
+        if process.returncode != 0:
+            logging.warning('prodigal exited with code {code} for {sn}'.format(code=process.returncode,
+                                                                               sn=sample.name))
+            # Do not report statistics parsed from the partial output; the attributes are left unset, and reported
+            # as ND
+            os.remove(partial)
+            os.remove(sample.prodigal.orftable)
+            return dict()
+        os.replace(partial, sample.prodigal.results_file)
+        return stats
+
+    @staticmethod
+    def populate(sample, stats):
+        """
+        Add the gene prediction statistics to the metadata object
+        :param sample: metadata object of the sample
+        :param stats: dictionary of the gene prediction statistics
+        """
+        for attribute, value in stats.items():
+            setattr(sample.prodigal, attribute, value)
 
     def __init__(self, inputobject):
         self.metadata = inputobject.runmetadata.samples
         self.start = inputobject.starttime
         self.logfile = inputobject.logfile
         self.predictqueue = Queue()
-        self.parsequeue = Queue()
         self.predictthreads()
-        self.prodigalparse()
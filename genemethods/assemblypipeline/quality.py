@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, run_subprocess, write_to_logfile
 import olctools.accessoryFunctions.metadataprinter as metadataprinter
+from genemethods.assemblypipeline.metadatastore import save_metadata
 from genewrappers.biotools import bbtools
 from Bio.SeqUtils import GC
 from Bio import SeqIO
@@ -119,8 +120,9 @@ class Quality(object):
                 else:
                     # Update metadata objects with error
                     self.error(sample, 'files_too_small')
-        # Print the metadata to file
+        # Print the metadata to file, and keep the metadata stores in sync with it
         metadataprinter.MetadataPrinter(self)
+        save_metadata(self.metadata)
 
     @staticmethod
     def error(sample, message):
@@ -291,6 +293,10 @@ class Quality(object):
                     # Initialise a variable to store the number of bases to automatically trim from the beginning of
                     # each read, as these bases tend to have lower quality scores. If trimming the reads will cause
                     trim_left = 0
+                    # Use the quality encoding detected when the read lengths were estimated, otherwise allow bbduk to
+                    # detect the encoding itself
+                    qin = 64 if GenObject.isattr(sample.run, 'qualityencoding') \
+                        and sample.run.qualityencoding == 'phred64' else 'auto'
                     # If, for some reason, only the reverse reads are present, use the appropriate output file name
                     try:
                         if 'R2' in fastqfiles[0]:
@@ -303,6 +309,7 @@ class Quality(object):
                                                                    trimq=10,
                                                                    minlength=min_len,
                                                                    forcetrimleft=trim_left,
+                                                                   qin=qin,
                                                                    returncmd=True)
                             else:
                                 bbdukcall = str()
@@ -317,6 +324,7 @@ class Quality(object):
                                                                        trimq=10,
                                                                        minlength=min_len,
                                                                        forcetrimleft=trim_left,
+                                                                       qin=qin,
                                                                        returncmd=True)
                             else:
                                 bbdukcall = str()
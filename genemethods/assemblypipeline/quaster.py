@@ -1,85 +1,161 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, printtime, run_subprocess, \
     write_to_logfile
-from threading import Thread
+from threading import Lock, Thread
+from functools import lru_cache, reduce
 from queue import Queue
-import threading
+import pandas as pd
+import hashlib
 import os
 __author__ = 'adamkoziol'
 
+# Tuples of strings to replace when parsing the results file
+REPLACEMENTS = ('>=', 'Over'), ('000 Bp', 'kbp'), ('#', 'Num'), \
+    ("'", ''), ('(', ''), (')', ''), (' ', ''), ('>', 'Less'), ('Gc%', 'GC%')
+
+
+@lru_cache(maxsize=None)
+def sanitise(entry):
+    """
+    Use headings in report as keys for the GenObject, and replace incrementally with reduce. The same headings are
+    present in every report, so each one is only sanitised once
+    :param entry: string of a heading or value from a Quast report
+    :return: sanitised string
+    """
+    return reduce(lambda a, kv: a.replace(*kv), REPLACEMENTS, entry.title())
+
 
 class Quast(object):
 
     def quast(self):
         printtime('Performing Quast analyses', self.start)
-        for i in range(len([sample.general for sample in self.metadata if sample.general.bestassemblyfile != 'NA'])):
-            # Send the threads to the merge method. :args is empty
-            threads = Thread(target=self.runquast, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
+        samples = list()
+        # Run as many concurrent jobs as the thread budget allows, and split the threads evenly between them
+        jobs = max(1, min(len([sample for sample in self.metadata if sample.general.bestassemblyfile != 'NA']),
+                          self.cpus // self.minthreads))
+        jobthreads = max(1, self.cpus // jobs)
         for sample in self.metadata:
             if sample.general.bestassemblyfile != 'NA':
                 # Create the quast output directory
                 quastoutputdirectory = '{}/quast_results/'.format(sample.general.outputdirectory)
                 make_path(quastoutputdirectory)
-                # Set the quast system call
-                quastcall = 'quast.py {} -o {}'.format(sample.general.filteredfile, quastoutputdirectory)
+                # Set the quast system call. Each job is allocated an equal share of the threads
+                quastcall = 'quast.py {} -o {} --threads {}'.format(sample.general.filteredfile,
+                                                                    quastoutputdirectory,
+                                                                    jobthreads)
                 # Add the command to the metadata
                 sample.commands.quast = quastcall
-                self.quastqueue.put((sample, quastoutputdirectory))
+                samples.append((sample, quastoutputdirectory))
             else:
                 sample.commands.quast = 'NA'
+        for i in range(jobs):
+            # Send the threads to the merge method. :args is empty
+            threads = Thread(target=self.runquast, args=())
+            # Set the daemon to true - something to do with thread management
+            threads.setDaemon(True)
+            # Start the threading
+            threads.start()
+        for sample, quastoutputdirectory in samples:
+            self.quastqueue.put((sample, quastoutputdirectory))
         self.quastqueue.join()
+        # Following the analyses, parse all the reports into the metadata objects
+        self.metaparse(samples)
 
     def runquast(self):
         while True:
             sample, quastoutputdirectory = self.quastqueue.get()
             make_path(quastoutputdirectory)
-            threadlock = threading.Lock()
-            # fnull = open(os.devnull, 'wb')
-            # Don't re-perform the analysis if the report file exists
-            if not os.path.isfile('{}/report.tsv'.format(quastoutputdirectory)):
+            report = os.path.join(quastoutputdirectory, 'report.tsv')
+            hashfile = os.path.join(quastoutputdirectory, 'assembly.sha1')
+            digest = self.digest(sample.general.filteredfile)
+            # Don't re-perform the analysis if the report file exists, and was created from this assembly
+            if not self.current(report, hashfile, digest):
                 out, err = run_subprocess(sample.commands.quast)
-                # call(sample.commands.quast, shell=True, stdout=fnull, stderr=fnull)
-                threadlock.acquire()
-                write_to_logfile(sample.commands.quast, sample.commands.quast, self.logfile,
-                                 sample.general.logout, sample.general.logerr, None, None)
-                write_to_logfile(out, err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
-                threadlock.release()
-            # Following the analysis, parse the report (if it exists) into the metadata object
-            if os.path.isfile('{}/report.tsv'.format(quastoutputdirectory)):
-                self.metaparse(sample, quastoutputdirectory)
+                with self.threadlock:
+                    write_to_logfile(sample.commands.quast, sample.commands.quast, self.logfile,
+                                     sample.general.logout, sample.general.logerr, None, None)
+                    write_to_logfile(out, err, self.logfile, sample.general.logout, sample.general.logerr, None, None)
+                if os.path.isfile(report):
+                    with open(hashfile, 'w') as assemblyhash:
+                        assemblyhash.write(digest)
             self.quastqueue.task_done()
 
-    def metaparse(self, sample, quastoutputdirectory):
-        import functools
-        # Tuples of strings to replace when parsing the results file
-        repls = ('>=', 'Over'), ('000 Bp', 'kbp'), ('#', 'Num'), \
-                ("'", ''), ('(', ''), (')', ''), (' ', ''), ('>', 'Less'), ('Gc%', 'GC%')
-        # Initialise the results dictionary
-        quast = dict()
-        # The results file is gage_report.tsv if that file exists, otherwise it is report.tsv
-        resfile = "{0:s}/gage_report.tsv".format(quastoutputdirectory) \
-            if os.path.isfile("{0:s}/gage_report.tsv".format(quastoutputdirectory)) \
-            else "{0:s}/report.tsv".format(quastoutputdirectory)
-        with open(resfile) as report:
-            for line in report:
-                # Use headings in report as keys for the GenObject supplied from generator and replace incrementally
-                # with reduce and lambda function below
-                k, v = [functools.reduce(lambda a, kv: a.replace(*kv), repls, s.title()) for s in
-                        line.rstrip().split('\t')]
-                quast[k] = v
-        # Create the quast metadata object
-        sample.quast = GenObject(quast)
-        sample.quast.outputdirectory = quastoutputdirectory
-        sample.quast.kmers = self.kmers
+    @staticmethod
+    def current(report, hashfile, digest):
+        """
+        Determine whether an existing Quast report was created from the current assembly
+        :param report: Name and path of the Quast report.tsv
+        :param hashfile: Name and path of the file storing the digest of the assembly used to create the report
+        :param digest: SHA-1 digest of the current assembly
+        :return: boolean of whether the report can be re-used
+        """
+        if not os.path.isfile(report):
+            return False
+        # Reports from before the assemblies were hashed are trusted, as they were previously, and stamped with the
+        # digest of the current assembly
+        if not os.path.isfile(hashfile):
+            with open(hashfile, 'w') as assemblyhash:
+                assemblyhash.write(digest)
+            return True
+        with open(hashfile, 'r') as assemblyhash:
+            return assemblyhash.read().strip() == digest
+
+    @staticmethod
+    def digest(filename):
+        """
+        Calculate the SHA-1 digest of the contents of a file
+        :param filename: Path of the file
+        :return: hexadecimal digest, or an empty string if the file does not exist
+        """
+        sha = hashlib.sha1()
+        try:
+            with open(filename, 'rb') as handle:
+                for block in iter(lambda: handle.read(65536), b''):
+                    sha.update(block)
+        except FileNotFoundError:
+            return str()
+        return sha.hexdigest()
+
+    def metaparse(self, samples):
+        """
+        Read the reports of all the samples into a single table, and populate the metadata objects with the
+        sanitised metrics
+        :param samples: list of (sample metadata object, quast output directory)
+        """
+        reports = list()
+        parsed = list()
+        for sample, quastoutputdirectory in samples:
+            # The results file is gage_report.tsv if that file exists, otherwise it is report.tsv
+            resfile = "{0:s}/gage_report.tsv".format(quastoutputdirectory) \
+                if os.path.isfile("{0:s}/gage_report.tsv".format(quastoutputdirectory)) \
+                else "{0:s}/report.tsv".format(quastoutputdirectory)
+            if not os.path.isfile(resfile):
+                continue
+            reports.append(pd.read_csv(resfile, sep='\t', header=None, names=['key', 'value'], dtype=str,
+                                       keep_default_na=False))
+            parsed.append((sample, quastoutputdirectory))
+        if not reports:
+            return
+        table = pd.concat(reports, keys=range(len(reports)), names=['report', 'line'])
+        # Sanitise the distinct headings and values once, rather than once per sample
+        table['key'] = table['key'].map(sanitise)
+        table['value'] = table['value'].map(sanitise)
+        metrics = {report: dict(zip(group['key'], group['value']))
+                   for report, group in table.groupby(level='report', sort=False)}
+        for report, (sample, quastoutputdirectory) in enumerate(parsed):
+            # Create the quast metadata object
+            sample.quast = GenObject(metrics[report])
+            sample.quast.outputdirectory = quastoutputdirectory
+            sample.quast.kmers = self.kmers
 
     def __init__(self, inputobject):
         self.metadata = inputobject.runmetadata.samples
         self.kmers = inputobject.kmers
         self.start = inputobject.starttime
         self.logfile = inputobject.logfile
+        self.cpus = inputobject.cpus
+        # Quast does not scale well beyond a few threads, so run several smaller jobs concurrently instead
+        self.minthreads = 4
+        self.threadlock = Lock()
         self.quastqueue = Queue()
         self.quast()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import GenObject, MetadataObject
-import copy
+from collections import ChainMap
+import re
 import os
 # Import ElementTree - try first to import the faster C version, if that doesn't
 # work, try to import the regular version
@@ -18,20 +19,11 @@ class Metadata(object):
         NA values are substituted"""
         # Check if the RunInfo.xml file is provided, otherwise, yield N/A
         try:
-            runinfo = ElementTree.ElementTree(file=self.runinfo)
-            # Get the run id from the
-            for elem in runinfo.iter():
-                for run in elem:
-                    try:
-                        self.runid = run.attrib['Id']
-                        self.runnumber = run.attrib['Number']
-                    except KeyError:
-                        break
-            # pull the text from flowcell and instrument values using the .iter(tag="X") function
-            for elem in runinfo.iter(tag="Flowcell"):
-                self.flowcell = elem.text
-            for elem in runinfo.iter(tag="Instrument"):
-                self.instrument = elem.text
+            runinfo = read_runinfo(self.runinfo)
+            self.runid = runinfo.get('runid', self.runid)
+            self.runnumber = runinfo.get('runnumber', self.runnumber)
+            self.flowcell = runinfo.get('flowcell', self.flowcell)
+            self.instrument = runinfo.get('instrument', self.instrument)
         except IOError:
             pass
         # Extract run statistics from either GenerateRunStatistics.xml or indexingQC.txt
@@ -40,62 +32,31 @@ class Metadata(object):
     def parsesamplesheet(self):
         """Parses the sample sheet (SampleSheet.csv) to determine certain values
         important for the creation of the assembly report"""
-        # Open the sample sheet
-        with open(self.samplesheet, "r") as samplesheet:
-            # Iterate through the sample sheet
-            samples, prev, header = False, 0, []
-            for count, line in enumerate(samplesheet):
-                # Remove new lines, and split on commas
-                # line = line.decode('utf-8')  # Turn from bytes to string, since python3 is finicky.
-                data = line.rstrip().split(",")
-                if any(data):
-                    if "[Settings]" in line:
-                        samples = False
-                    if not line.startswith("[") and not samples and not data == ['']:
-                        # Grab an data not in the [Data] Section
-                        setattr(self.header, data[0].replace(" ", ""), "".join(data[1:]))
-                    elif "[Data]" in line or "[Reads]" in line:
-                        samples = True
-                    elif samples and "Sample_ID" in line:
-                        header.extend([x.replace("_", "").replace(' ', "") for x in data])
-                        prev = count
-                    elif header:
-                        # Try and replicate the Illumina rules to create file names from "Sample_Name"
-                        samplename = samplenamer(data)
-                        # Create an object for storing nested static variables
-                        strainmetadata = MetadataObject()
-                        # Set the sample name in the object
-                        strainmetadata.name = samplename
-                        # Add the header object to strainmetadata
-                        # strainmetadata.__setattr__("run", GenObject(dict(self.header)))
-                        strainmetadata.run = GenObject(copy.copy(self.header.datastore))
-                        # Create the run object, so it will be easier to populate the object (eg run.SampleName = ...
-                        # instead of strainmetadata.run.SampleName = ...
-                        run = strainmetadata.run
-                        # Capture Sample_ID, Sample_Name, I7_Index_ID, index1, I5_Index_ID,	index2, Sample_Project
-                        for idx, item in enumerate(data):
-                            setattr(run, header[idx], item) if item else setattr(run, header[idx], "NA")
-                        # Add the sample number
-                        run.SampleNumber = count - prev
-                        # Create the 'General' category for strainmetadata
-                        strainmetadata.general = GenObject({'outputdirectory': os.path.join(self.path, samplename),
-                                                            'pipelinecommit': self.commit})
-                        strainmetadata.general.logout = os.path.join(self.path, samplename,
-                                                                     '{}_log_out.txt'.format(samplename))
-                        strainmetadata.general.logerr = os.path.join(self.path, samplename,
-                                                                     '{}_log_err.txt'.format(samplename))
-                        # Add the output directory to the general category
-                        # Append the strainmetadata object to a list
-                        self.samples.append(strainmetadata)
-                    elif samples:
-                        setattr(self.header, 'forwardlength', data[0]) \
-                            if 'forwardlength' not in self.header.datastore else \
-                            setattr(self.header, 'reverselength', data[0])
-                        self.totalreads += int(data[0])
+        header, records, self.totalreads = read_samplesheet(self.samplesheet)
+        # Check the samples for problems before any of the metadata objects are created
+        validate_samplesheet(records)
+        self.header.datastore.update(header)
+        if 'InvestigatorName' not in self.header.datastore:
+            self.header.InvestigatorName = 'NA'
+        for samplename, record in records:
+            # Create an object for storing nested static variables
+            strainmetadata = MetadataObject()
+            # Set the sample name in the object
+            strainmetadata.name = samplename
+            # The run object stores the values of the sample e.g. Sample_ID, Sample_Name, index, and index2, and
+            # falls back to the header values, which are shared by reference between all the samples. New values
+            # are only added to the sample
+            strainmetadata.run = GenObject(ChainMap(record, self.header.datastore))
+            # Create the 'General' category for strainmetadata
+            strainmetadata.general = GenObject({'outputdirectory': os.path.join(self.path, samplename),
+                                                'pipelinecommit': self.commit})
+            strainmetadata.general.logout = os.path.join(self.path, samplename,
+                                                         '{}_log_out.txt'.format(samplename))
+            strainmetadata.general.logerr = os.path.join(self.path, samplename,
+                                                         '{}_log_err.txt'.format(samplename))
+            # Append the strainmetadata object to a list
+            self.samples.append(strainmetadata)
         self.date = self.header.Date if "Date" in self.header.datastore else self.date
-        for sample in self.samples:
-            if 'InvestigatorName' not in sample.run.datastore:
-                sample.run.InvestigatorName = 'NA'
 
     def parserunstats(self):
         """Parses the XML run statistics file (GenerateFASTQRunStatistics.xml). In some cases, the file is not
@@ -189,3 +150,101 @@ def samplenamer(listofdata, indexposition=0):
     samplename = listofdata[indexposition].rstrip().replace(" ", "-").replace(".", "-").replace("=", "-")\
         .replace("+", "").replace("/", "-").replace("#", "").replace("---", "-").replace("--", "-")
     return samplename
+
+
+def read_samplesheet(samplesheet):
+    """
+    Read the header, the read lengths, and the samples of a sample sheet in a single pass
+    :param samplesheet: Name and path of SampleSheet.csv
+    :return: dictionary of the header values (including the forward and reverse read lengths), list of
+    (sample name, dictionary of the values of the sample), total number of cycles in the reads
+    """
+    header = dict()
+    records = list()
+    totalreads = 0
+    with open(samplesheet, "r") as sheet:
+        samples, prev, columns = False, 0, []
+        for count, line in enumerate(sheet):
+            # Remove new lines, and split on commas
+            data = line.rstrip().split(",")
+            if not any(data):
+                continue
+            if "[Settings]" in line:
+                samples = False
+            if not line.startswith("[") and not samples:
+                # Grab any data not in the [Data] or [Reads] sections
+                header[data[0].replace(" ", "")] = "".join(data[1:])
+            elif "[Data]" in line or "[Reads]" in line:
+                samples = True
+            elif samples and "Sample_ID" in line:
+                columns = [x.replace("_", "").replace(' ', "") for x in data]
+                prev = count
+            elif columns:
+                if len(data) > len(columns):
+                    raise ValueError('Line {line} of {sheet} has more values than the [Data] header'
+                                     .format(line=count + 1,
+                                             sheet=samplesheet))
+                # Capture Sample_ID, Sample_Name, I7_Index_ID, index1, I5_Index_ID, index2, Sample_Project
+                record = {column: item if item else "NA" for column, item in zip(columns, data)}
+                # Add the sample number
+                record['SampleNumber'] = count - prev
+                # Try and replicate the Illumina rules to create file names from "Sample_Name"
+                records.append((samplenamer(data), record))
+            elif samples:
+                header['forwardlength' if 'forwardlength' not in header else 'reverselength'] = data[0]
+                totalreads += int(data[0])
+    return header, records, totalreads
+
+
+def validate_samplesheet(records):
+    """
+    Check the samples of a sample sheet for duplicate sample IDs and names within a lane, index collisions, and
+    characters that cannot be used in file names. Samples sequenced on multiple lanes are listed once per lane
+    :param records: list of (sample name, dictionary of the values of the sample) from read_samplesheet
+    """
+    errors = list()
+    ids = set()
+    names = set()
+    indices = dict()
+    for samplename, record in records:
+        sampleid = record.get('SampleID', samplename)
+        lane = record.get('Lane', '1')
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', samplename):
+            errors.append('Sample {sample} contains characters that cannot be used in file names'
+                          .format(sample=sampleid))
+        if (lane, sampleid) in ids or (lane, samplename) in names:
+            errors.append('Sample {sample} is present more than once in lane {lane}'.format(sample=sampleid,
+                                                                                         lane=lane))
+        ids.add((lane, sampleid))
+        names.add((lane, samplename))
+        # Samples in the same lane must have a unique combination of indices
+        index = (lane, record.get('index', 'NA'), record.get('index2', 'NA'))
+        if index[1:] != ('NA', 'NA'):
+            if index in indices:
+                errors.append('Samples {first} and {second} have the same indices: {index}'
+                              .format(first=indices[index],
+                                      second=sampleid,
+                                      index='-'.join(i for i in index[1:] if i != 'NA')))
+            indices[index] = sampleid
+    if errors:
+        raise ValueError('Invalid sample sheet:\n{errors}'.format(errors='\n'.join(errors)))
+
+
+def read_runinfo(runinfo):
+    """
+    Read the run ID, run number, flowcell, and instrument from RunInfo.xml
+    :param runinfo: Name and path of RunInfo.xml
+    :return: dictionary of the values present in the file
+    """
+    run = ElementTree.parse(runinfo).getroot().find('Run')
+    values = dict()
+    if run is None:
+        return values
+    if 'Id' in run.attrib and 'Number' in run.attrib:
+        values['runid'] = run.attrib['Id']
+        values['runnumber'] = run.attrib['Number']
+    for key, tag in [('flowcell', 'Flowcell'), ('instrument', 'Instrument')]:
+        text = run.findtext(tag)
+        if text is not None:
+            values[key] = text
+    return values
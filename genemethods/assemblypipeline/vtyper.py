@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
-from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject, \
-    run_subprocess, SetupLogging, write_to_logfile
+from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path, MetadataObject, SetupLogging
 import olctools.accessoryFunctions.metadataprinter as metadataprinter
+from genemethods.assemblypipeline.metadatastore import save_metadata
+from genemethods.assemblypipeline.epcr import ElectronicPCR, epcr_search
 from click import progressbar
-from threading import Thread
-import threading
+import multiprocessing
 import logging
 import os
 
@@ -14,15 +14,9 @@ __author__ = 'adamkoziol'
 class Vtyper(object):
 
     def vtyper(self):
-        """Setup and create  threads for ePCR"""
+        """Hash the primers, and run the in-process ePCR on the assemblies"""
         logging.info('Running ePCR')
-        # Create the threads for the BLAST analysis
-        for sample in self.metadata:
-            if sample.general.bestassemblyfile != 'NA':
-                threads = Thread(target=self.epcr, args=())
-                threads.setDaemon(True)
-                threads.start()
-        # Create the system calls for famap, fahash, and ePCR
+        epcrsamples = list()
         with progressbar(self.metadata) as bar:
             for sample in bar:
                 if sample.general.bestassemblyfile != 'NA':
@@ -40,58 +34,33 @@ class Vtyper(object):
                                                                            self.analysistype)
                         make_path(sample[self.analysistype].reportdir)
                         outfile = sample[self.analysistype].reportdir + sample.name
-                        # Set the hashing and mapping commands
-                        sample.commands.famap = 'famap -b {}.famap {}.fasta'.format(outfile, sample.general.filenoext)
-                        sample.commands.fahash = 'fahash -b {}.hash {}.famap'.format(outfile, outfile)
-                        # re-PCR uses the subtyping primers list to search the file with the following parameters
-                        # -S {hash file} (Perform STS lookup using hash-file),
-                        # -r + (Enable/disable reverse STS lookup)
-                        # -m 10000 (Set variability for STS size for lookup),
-                        # -n 1 (Set max allowed mismatches per primer for lookup)
-                        # -g 0 (Set max allowed indels per primer for lookup),
-                        # -G (Print alignments in comments),
-                        # -q quiet
-                        # -o {output file},
-                        sample.commands.epcr = 're-PCR -S {}.hash -r + -m 10000 -n 1 -g 0 -G -q -o {}.txt {}'\
-                            .format(outfile, outfile, sample[self.analysistype].primers)
                         sample[self.analysistype].resultsfile = '{}.txt'.format(outfile)
-                        self.epcrqueue.put((sample, outfile))
-        self.epcrqueue.join()
+                        # Hash each primer file once. The in-process ePCR uses the same parameters as the previous
+                        # re-PCR calls: -m 10000 (variability of STS size), -n 1 (max allowed mismatches per primer),
+                        # -g 0 (max allowed indels per primer)
+                        if sample[self.analysistype].primers not in self.engines:
+                            self.engines[sample[self.analysistype].primers] = \
+                                ElectronicPCR(primerfile=sample[self.analysistype].primers,
+                                              mismatches=1,
+                                              gaps=0,
+                                              margin=10000)
+                        epcrsamples.append(sample)
+        self.epcr(epcrsamples)
         self.epcrparse()
 
-    def epcr(self):
-        while True:
-            # I think this should work for getting output from processes and writing to a logfile - but it's long
-            # and terrible - maybe possible to get it set up in accessoryFunctions so it's a bit less of a pain?
-            # Setup a threadlock for later so multiple processes don't all try to write their output at once.
-            threadlock = threading.Lock()
-            # Get our stdout and stderr strings set up.
-            outstr = ''
-            errstr = ''
-            sample, linkfile = self.epcrqueue.get()
-            if not os.path.isfile('{}.famap'.format(linkfile)):
-                # Run the subprocess, then get the stdout in outstr and stderr in errstr
-                out, err = run_subprocess(sample.commands.famap)
-                outstr += out
-                errstr += err
-            if not os.path.isfile('{}.hash'.format(linkfile)):
-                out, err = run_subprocess(sample.commands.fahash)
-                outstr += out
-                errstr += err
-            if not os.path.isfile('{}.txt'.format(linkfile)):
-                out, err = run_subprocess(sample.commands.epcr)
-                outstr += out
-                errstr += err
-            # Once processes are finished running, get the threadlock, because now it's output writing time.
-            threadlock.acquire()
-            # Write stuff to the logfile.
-            write_to_logfile(sample.commands.famap, sample.commands.famap, self.logfile)
-            write_to_logfile(sample.commands.fahash, sample.commands.fahash, self.logfile)
-            write_to_logfile(sample.commands.epcr, sample.commands.epcr, self.logfile)
-            write_to_logfile(outstr, errstr, self.logfile)
-            threadlock.release()
-            # Release the threadlock so that other processes can get on with it.
-            self.epcrqueue.task_done()
+    def epcr(self, epcrsamples):
+        """
+        Scan the assemblies for amplicons with the in-process ePCR
+        :param epcrsamples: list of metadata objects of the samples to process
+        """
+        p = multiprocessing.Pool(processes=self.cpus)
+        results = p.starmap(epcr_search,
+                            [(self.engines[sample[self.analysistype].primers], sample.general.bestassemblyfile,
+                              sample[self.analysistype].resultsfile) for sample in epcrsamples])
+        p.close()
+        p.join()
+        for sample, epcrresults in zip(epcrsamples, results):
+            sample[self.analysistype].epcrresults = epcrresults
 
     def epcrparse(self):
         """
@@ -131,8 +100,6 @@ class Vtyper(object):
                 sample[self.analysistype].toxinprofile = 'NA'
 
     def __init__(self, inputobject, analysistype):
-        from queue import Queue
-        import multiprocessing
         self.metadata = inputobject.runmetadata.samples
         self.analysistype = analysistype
         self.reffilepath = inputobject.reffilepath
@@ -143,7 +110,8 @@ class Vtyper(object):
         if not self.reffilepath:
             self.primerfile = inputobject.primerfile
         self.cpus = int(multiprocessing.cpu_count())
-        self.epcrqueue = Queue(maxsize=self.cpus)
+        # Dictionary of primer file: ElectronicPCR object with the hashed primers
+        self.engines = dict()
         self.logfile = inputobject.logfile
         self.vtyper()
 
@@ -231,4 +199,5 @@ if __name__ == '__main__':
             # Print the metadata to file
             logging.info('Printing metadata to file')
             metadataprinter.MetadataPrinter(self)
+            save_metadata(self.runmetadata.samples)
     Setup()
@@ -3,18 +3,79 @@ from olctools.accessoryFunctions.accessoryFunctions import GenObject, make_path,
     run_subprocess, write_to_logfile
 import olctools.accessoryFunctions.metadataprinter as metadataprinter
 import genemethods.assemblypipeline.createobject as createobject
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio import SeqIO
 from threading import Thread
 from queue import Queue
 from glob import glob
+import multiprocessing
 import threading
 import operator
+import pandas
 import os
 __author__ = 'adamkoziol'
 
 
+def parse_gff(gff):
+    """
+    Find the named genes of the CDS features in a prokka .gff file
+    e.g. 2013-SEQ-0123-2014_1	Prodigal:2.6	CDS	443	1741	.	+	0
+    ID=0279_00002;Parent=0279_00002_gene;gene=kgtP_1;
+    inference=ab initio prediction:Prodigal:2.6,similar to AA sequence:UniProtKB:P0AEX3;
+    locus_tag=0279_00002;product=Alpha-ketoglutarate permease
+    :param gff: Name and path of the .gff file
+    :return: dictionary of CDS name: gene name
+    """
+    genes = dict()
+    with open(gff, 'r') as features:
+        for feature in features:
+            # The sequences follow the features - stop parsing when they are reached
+            if feature.startswith('##FASTA'):
+                break
+            columns = feature.split('\t')
+            # Only interested in the sequence name if it is a CDS with a gene name
+            if len(columns) < 9 or columns[2] != 'CDS' or 'gene=' not in columns[8]:
+                continue
+            name = columns[8].split('ID=')[1].split(';')[0]
+            gene = columns[8].split('gene=')[1].split(';')[0].rstrip()
+            # Remove duplicate genes e.g. aceE_1 and aceE_2, as the numbers seem to be added arbitrarily
+            if '_' not in gene:
+                genes[name] = gene
+    return genes
+
+
+def extract_cds(ffn, cdsfile, cdsset, corenames):
+    """
+    Write the CDS records of a strain to its .cds file, and extract the sequences of its core genes. The .ffn file is
+    only read once. If the .cds file already exists, it is read instead
+    :param ffn: Name and path of the prokka .ffn file
+    :param cdsfile: Name and path of the .cds file
+    :param cdsset: Set of the names of the CDS features with named genes
+    :param corenames: Set of the names of the CDS features of core genes
+    :return: list of (CDS name, sequence) for the core genes, in file order
+    """
+    coresequences = list()
+    source = cdsfile if os.path.isfile(cdsfile) else ffn
+    cds = open(cdsfile, 'w') if source == ffn else None
+    try:
+        with open(source, 'r') as records:
+            for header, sequence in SimpleFastaParser(records):
+                name = header.split()[0] if header else str()
+                if cds and name in cdsset:
+                    # Write each record to the file containing the nucleotide CDSs
+                    cds.write('>{header}\n'.format(header=header))
+                    for i in range(0, len(sequence), 60):
+                        cds.write(sequence[i:i + 60] + '\n')
+                if name in corenames:
+                    coresequences.append((name, sequence))
+    finally:
+        if cds:
+            cds.close()
+    return coresequences
+
+
 class Annotate(object):
 
     def annotatethreads(self):
@@ -141,120 +202,55 @@ class Annotate(object):
 
     def codingthreads(self):
         """
-        Find CDS features in .gff files to filter out non-coding sequences from the analysis
+        Find CDS features in .gff files to filter out non-coding sequences from the analysis. Each .gff file is parsed
+        into a local set of genes in a process pool, and the sets are reduced into a presence matrix
         """
         printtime('Extracting CDS features', self.start)
-        # Create and start threads
-        for i in range(self.cpus):
-            # Send the threads to the appropriate destination function
-            threads = Thread(target=self.codingsequences, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.runmetadata.samples:
-            self.codingqueue.put(sample)
-        self.codingqueue.join()
+        samples = sorted(self.runmetadata.samples, key=lambda sample: sample.name)
+        p = multiprocessing.Pool(processes=self.cpus)
+        cdsgenes = p.map(parse_gff, [sample.prokka.gff for sample in samples])
+        p.close()
+        p.join()
+        for sample, genes in zip(samples, cdsgenes):
+            self.cdsset[sample.name] = set(genes)
+            self.genenames.update(genes)
+        # Count the number of times each gene is found in each strain
+        self.presence = pandas.DataFrame({sample.name: pandas.Series(list(genes.values()), dtype=object)
+                                         .value_counts() for sample, genes in zip(samples, cdsgenes)}) \
+            .fillna(0).astype(int).T.sort_index(axis=1)
+        self.genes = self.presence.sum().to_dict()
         # Create CDS files and determine gene presence/absence
         self.corethreads()
 
-    def codingsequences(self):
-        while True:
-            sample = self.codingqueue.get()
-            with open(sample.prokka.gff, 'r') as gff:
-                for feature in gff:
-                    # Only interested in the sequence name if it is a CDS
-                    if 'CDS' in feature:
-                        # Extract the sequence name from the string. Example below
-                        # 2013-SEQ-0123-2014_1	Prodigal:2.6	CDS	443	1741	.	+	0
-                        # ID=0279_00002;Parent=0279_00002_gene;gene=kgtP_1;
-                        # inference=ab initio prediction:Prodigal:2.6,similar to AA sequence:UniProtKB:P0AEX3;
-                        # locus_tag=0279_00002;product=Alpha-ketoglutarate permease
-                        name = feature.split('ID=')[1].split(';')[0]
-                        # Add number and names of genes to dictionaries
-                        try:
-                            gene = feature.split('gene=')[1].split(';')[0]
-                            # Remove duplicate genes e.g. aceE_1 and aceE_2, as the numbers seem to be added arbitrarily
-                            if '_' not in gene:
-                                try:
-                                    self.genenames[name] = gene
-                                    self.genes[gene] += 1
-                                except KeyError:
-                                    self.genes[gene] = 1
-                                try:
-                                    self.cdsset[sample.name].add(name)
-                                except KeyError:
-                                    self.cdsset[sample.name] = set()
-                                    self.cdsset[sample.name].add(name)
-                        except IndexError:
-                            pass
-            self.codingqueue.task_done()
-
     def corethreads(self):
         """
-        Create a .cds file consisting of fasta records of CDS features for each strain
+        Create a .cds file consisting of fasta records of CDS features for each strain, and extract the sequences of
+        the core genes with a single read of each .ffn file
         """
         printtime('Creating CDS files and finding core genes', self.start)
-        # Create and start threads
-        for i in range(self.cpus):
-            # Send the threads to the appropriate destination function
-            threads = Thread(target=self.coregroups, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.runmetadata.samples:
+        samples = sorted(self.runmetadata.samples, key=lambda sample: sample.name)
+        # Find genes that are present in all strains of interest - the number of times the gene is found is equal to
+        # the number of strains. Earlier parsing ensures that the same gene is not present in a strain more than once
+        coregenes = set(self.presence.columns[self.presence.sum() == len(self.runmetadata.samples)])
+        arguments = list()
+        for sample in samples:
             # Define the name of the file to store the CDS nucleotide sequences
             sample.prokka.cds = os.path.join(sample.prokka.outputdir, '{}.cds'.format(sample.name))
-            self.corequeue.put(sample)
-        self.corequeue.join()
+            arguments.append((sample.prokka.ffn, sample.prokka.cds, self.cdsset[sample.name],
+                              {name for name in self.cdsset[sample.name] if self.genenames[name] in coregenes}))
+        p = multiprocessing.Pool(processes=self.cpus)
+        coresequences = p.starmap(extract_cds, arguments)
+        p.close()
+        p.join()
+        # Reduce the core sequences in sample order, so that the allele numbering is deterministic
+        for sequences in coresequences:
+            for name, sequence in sequences:
+                # The alleles of each gene are stored in a dictionary to preserve their order
+                self.genesequence.setdefault(self.genenames[name], dict())[sequence] = None
+                self.coresequence.setdefault(sequence, set()).add(name)
         # Write the core .fasta files for each gene
         self.corewriter()
 
-    def coregroups(self):
-        while True:
-            sample = self.corequeue.get()
-            if not os.path.isfile(sample.prokka.cds):
-                with open(sample.prokka.cds, 'w') as cds:
-                    # Use BioPython to iterate through the records in the .ffn file
-                    for record in SeqIO.parse(open(sample.prokka.ffn, 'r'), 'fasta'):
-                        # Extract records present in the CDS set
-                        if record.id in self.cdsset[sample.name]:
-                            # Write each record to the file containing the nucleotide CDSs
-                            SeqIO.write(record, cds, 'fasta')
-                            # Parse each record
-                            self.cdsparse(record)
-            else:
-                for record in SeqIO.parse(open(sample.prokka.cds, 'r'), 'fasta'):
-                    #
-                    self.cdsparse(record)
-            self.corequeue.task_done()
-
-    def cdsparse(self, record):
-        """
-        Finds core genes, and records gene names and sequences in dictionaries
-        :param record: SeqIO record
-        """
-        try:
-            # Find genes that are present in all strains of interest - the number of times the gene is found is
-            # equal to the number of strains. Earlier parsing ensures that the same gene is not present in a strain
-            # more than once
-            if self.genes[self.genenames[record.id]] == len(self.runmetadata.samples):
-                # Add the gene names and sequences to the appropriate dictionaries
-                try:
-                    self.genesequence[self.genenames[record.id]].add(str(record.seq))
-                # Initialise the dictionary as required, then populate as above
-                except KeyError:
-                    self.genesequence[self.genenames[record.id]] = set()
-                    self.genesequence[self.genenames[record.id]].add(str(record.seq))
-                try:
-                    self.coresequence[str(record.seq)].add(record.id)
-                except KeyError:
-                    self.coresequence[str(record.seq)] = set()
-                    self.coresequence[str(record.seq)].add(record.id)
-        except KeyError:
-            pass
-
     def corewriter(self):
         """
         Creates .fasta files containing all alleles for each gene
@@ -401,13 +397,12 @@ class Annotate(object):
         self.genesequence = dict()
         self.cdsset = dict()
         self.coresequence = dict()
+        self.presence = pandas.DataFrame()
         self.geneset = set()
         self.corealleles = dict()
         self.coreset = set()
         self.profiles = dict()
         self.queue = Queue()
-        self.corequeue = Queue()
-        self.codingqueue = Queue()
         self.headerqueue = Queue()
         # self.devnull = open(os.devnull, 'wb')
         self.logfile = inputobject.logfile
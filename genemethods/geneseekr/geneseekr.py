@@ -1372,13 +1372,18 @@ class GeneSeekr(object):
         # Initialise list to store all the GDCS genes, and genera in the analysis
         gdcs = list()
         genera = list()
+        # Caches of the .fai files and target lengths shared by all the samples in the report
+        targetfiles = dict()
+        targetlengths = dict()
         for sample in metadata:
             sample[analysistype].faidict = dict()
             if sample.general.bestassemblyfile != 'NA':
                 if os.path.isdir(sample[analysistype].targetpath):
                     # Update the fai dict with all the genes in the analysis, rather than just those with baited hits
                     Reports.gdcs_fai(sample=sample,
-                                     analysistype=analysistype)
+                                     analysistype=analysistype,
+                                     targetfiles=targetfiles,
+                                     targetlengths=targetlengths)
                     sample[analysistype].createreport = True
                     # Determine which genera are present in the analysis
                     if sample.general.closestrefseqgenus not in genera:
@@ -115,6 +115,10 @@ class GeneSippr(object):
             self.copy = args.copy
         except AttributeError:
             self.copy = False
+        try:
+            self.keepindexcache = args.keepindexcache
+        except AttributeError:
+            self.keepindexcache = False
         self.runmetadata = args.runmetadata
         # Use the argument for the number of threads to use, or default to the number of cpus in the system
         try:
@@ -196,6 +200,11 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Normally, the program will create symbolic links of the files into the sequence path, '
                              'however, the are occasions when it is necessary to copy the files instead')
+    parser.add_argument('-k', '--keepindexcache',
+                        action='store_true',
+                        help='Keep the cached bowtie2 and faidx indices of the sample-specific bait files at the end '
+                             'of the run, so that they can be re-used when the samples are reanalysed. By default, '
+                             'the cache is removed')
     SetupLogging()
     # Get the arguments into an object
     arguments = parser.parse_args()
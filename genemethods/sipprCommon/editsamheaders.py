@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
+from argparse import ArgumentParser
+import subprocess
 import fileinput
+import time
 import sys
+import os
 
 __author__ = 'adamkoziol'
 
@@ -8,38 +12,125 @@ __author__ = 'adamkoziol'
 Uses logic from https://github.com/katholt/srst2/blob/master/scripts/srst2.py
 """
 
+# Size of the blocks of SAM data read from stdin
+BLOCKSIZE = 1 << 20
+# Look-up table of the FLAG values with the secondary alignment bit (256) set, and the value with the bit cleared.
+# Flags of 256 become 0, and flags of 272 become 16
+SECONDARY = {str(flag).encode(): str(flag - 256).encode() for flag in range(4096) if flag & 256}
+
+
+def clear_secondary(block):
+    """
+    Clear the secondary alignment bit from the FLAG column of every alignment in a block of SAM lines. Only the lines
+    with the bit set are edited, and only the FLAG column of those lines is rewritten
+    :param block: bytes of complete SAM lines
+    :return: bytes of the edited SAM lines
+    """
+    lines = block.split(b'\n')
+    for i, line in enumerate(lines):
+        # The FLAG is in the second column
+        start = line.find(b'\t') + 1
+        end = line.find(b'\t', start)
+        if end < 0:
+            end = len(line)
+        flag = line[start:end]
+        # Header lines start with '@', and are not edited
+        if flag in SECONDARY and start and not line.startswith(b'@'):
+            lines[i] = line[:start] + SECONDARY[flag] + line[end:]
+    return b'\n'.join(lines)
+
 
 def editheaders():
     """Edits the headers of SAM files to remove 'secondary alignments'"""
-    # Read stdin - this will be the output from samtools view
-    for line in fileinput.input():
+    # Read stdin in blocks - this will be the output from bowtie2
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    remainder = b''
+    try:
+        while True:
+            block = stdin.read(BLOCKSIZE)
+            if not block:
+                break
+            # Only edit complete lines - carry the partial final line over to the next block
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            stdout.write(clear_secondary(block[:end]))
+        # Write any final line without a trailing newline
+        if remainder:
+            stdout.write(clear_secondary(remainder))
+    # Don't fail on IOErrors e.g. a closed pipe
+    except IOError:
+        pass
+    # Try except statements to get rid of file closing errors
+    try:
+        sys.stdout.flush()
+        sys.stdout.close()
+    except:
+        pass
+    try:
+        sys.stderr.close()
+    except:
+        pass
+
+
+def editheaders_legacy():
+    """Line by line implementation of editheaders. Only retained as a baseline for benchmarking"""
+    for line in fileinput.input(files=('-',)):
         try:
-            # Get the flag value from the input
             columns = line.split('\t')
-            # The FLAG is in the second column
             flag = int(columns[1])
-            # Subtracts 256 from the flag if the & bitwise operator evaluates to true
-            # See http://www.tutorialspoint.com/python/bitwise_operators_example.htm
-            # For the test case, flags of 256 became 0, and flags of 272 became 16
             columns[1] = str((flag - 256) if (flag & 256) else flag)
-            # update = [columns[0], str(flag), columns[2:]]
             sys.stdout.write('\t'.join(columns))
-        # Don't fail on IOErrors, or ValueErrors, and still print line to stdout
         except (IOError, ValueError):
             sys.stdout.write(line)
-            pass
-    # Try except statements to get rid of file closing errors
     try:
         sys.stdout.flush()
         sys.stdout.close()
     except:
         pass
-    try:
-        sys.stderr.close()
-    except:
-        pass
+
+
+def benchmark(samfile, repeats=3):
+    """
+    Compare the throughput of the blocked and line by line implementations by piping a SAM file through each of them.
+    The outputs of both implementations must be identical
+    :param samfile: Path to the SAM file to use in the benchmark
+    :param repeats: Number of times to run each implementation. The fastest run is reported
+    """
+    size = os.path.getsize(samfile)
+    outputs = dict()
+    for method in ['legacy', 'blocked']:
+        command = [sys.executable, os.path.abspath(__file__)]
+        if method == 'legacy':
+            command.append('--legacy')
+        timings = list()
+        for i in range(repeats):
+            with open(samfile, 'rb') as sam:
+                start = time.time()
+                outputs[method] = subprocess.run(command, stdin=sam, stdout=subprocess.PIPE, check=True).stdout
+                timings.append(time.time() - start)
+        print('{method}\t{seconds:.2f} s\t{rate:.1f} MB/s'
+              .format(method=method,
+                      seconds=min(timings),
+                      rate=size / min(timings) / 1e6))
+    if outputs['legacy'] != outputs['blocked']:
+        print('WARNING: the outputs of the two implementations differ')
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description='Clear the secondary alignment flag from SAM records read from stdin')
+    parser.add_argument('--legacy',
+                        action='store_true',
+                        help='Use the line by line implementation')
+    parser.add_argument('--benchmark',
+                        metavar='SAMFILE',
+                        help='Compare the throughput of the blocked and line by line implementations on this SAM file')
+    arguments = parser.parse_args()
     # Run the script
-    editheaders()
+    if arguments.benchmark:
+        benchmark(arguments.benchmark)
+    elif arguments.legacy:
+        editheaders_legacy()
+    else:
+        editheaders()
@@ -11,14 +11,17 @@ from Bio import SeqIO
 import multiprocessing
 from collections import Counter
 from click import progressbar
-from threading import Thread
+from threading import Lock, Thread
 from io import StringIO
 from queue import Queue
 from glob import glob
 import tempfile
+import hashlib
 import logging
 import psutil
 import numpy
+import shutil
+import time
 import pysam
 import json
 import os
@@ -34,17 +37,8 @@ class Sippr(object):
         """
         # Find the target files
         self.targets()
-        # Use bbduk to bait the FASTQ reads matching the target sequences
-        self.bait()
-        # If desired, use bbduk to bait the target sequences with the previously baited FASTQ files
-        if self.revbait:
-            self.reversebait()
-        # Run the bowtie2 read mapping module
-        self.mapping()
-        # Use samtools to index the sorted bam file
-        self.indexing()
-        # Parse the results
-        self.parsebam()
+        # Bait, reverse bait, map, index, and parse each sample independently
+        self.pipelined()
         # Filter out any sequences with cigar features such as internal soft-clipping from the results
         # self.clipper()
 
@@ -142,53 +136,62 @@ class Sippr(object):
         :param k: keyword argument for length of kmers to use in the analyses
         """
         logging.info('Performing kmer baiting of fastq files with {at} targets'.format(at=self.analysistype))
+        with progressbar(self.runmetadata) as bar:
+            for sample in bar:
+                if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                    self.bait_sample(sample, maskmiddle=maskmiddle, k=k)
+
+    def bait_sample(self, sample, maskmiddle='f', k='19'):
+        """
+        Use bbduk to bait the FASTQ reads of a single sample
+        :param sample: metadata object of the sample
+        :param maskmiddle: boolean argument treat the middle base of a kmer as a wildcard
+        :param k: keyword argument for length of kmers to use in the analyses
+        """
         # There seems to be some sort of issue with java incorrectly calculating the total system memory on certain
         # computers. For now, calculate the memory, and feed it into the bbduk call
         if self.kmer_size is None:
             kmer = k
         else:
             kmer = self.kmer_size
-        with progressbar(self.runmetadata) as bar:
-            for sample in bar:
-                if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
-                    # Create the folder (if necessary)
-                    make_path(sample[self.analysistype].outputdir)
-                    # Make the system call
-                    if len(sample.general.fastqfiles) == 2:
-                        # Create the command to run the baiting - paired inputs and a single, zipped output
-                        sample[self.analysistype].bbdukcmd = \
-                            'bbduk.sh -Xmx{mem} ref={ref} in1={in1} in2={in2} k={kmer} maskmiddle={mm} ' \
-                            'threads={c} outm={om} fixjunk' \
-                            .format(mem=self.mem,
-                                    ref=sample[self.analysistype].baitfile,
-                                    in1=sample.general.trimmedcorrectedfastqfiles[0],
-                                    in2=sample.general.trimmedcorrectedfastqfiles[1],
-                                    kmer=kmer,
-                                    mm=maskmiddle,
-                                    c=str(self.cpus),
-                                    om=sample[self.analysistype].baitedfastq)
-                    else:
-                        sample[self.analysistype].bbdukcmd = \
-                            'bbduk.sh -Xmx{mem} ref={ref} in={in1} k={kmer} maskmiddle={mm} ' \
-                            'threads={cpus} outm={outm} fixjunk' \
-                            .format(mem=self.mem,
-                                    ref=sample[self.analysistype].baitfile,
-                                    in1=sample.general.trimmedcorrectedfastqfiles[0],
-                                    kmer=kmer,
-                                    mm=maskmiddle,
-                                    cpus=str(self.cpus),
-                                    outm=sample[self.analysistype].baitedfastq)
-                    # Run the system call (if necessary)
-                    if not os.path.isfile(sample[self.analysistype].baitedfastq):
-                        out, err = run_subprocess(sample[self.analysistype].bbdukcmd)
-                        write_to_logfile(sample[self.analysistype].bbdukcmd,
-                                         sample[self.analysistype].bbdukcmd,
-                                         self.logfile, sample.general.logout, sample.general.logerr,
-                                         sample[self.analysistype].logout, sample[self.analysistype].logerr)
-                        write_to_logfile(out,
-                                         err,
-                                         self.logfile, sample.general.logout, sample.general.logerr,
-                                         sample[self.analysistype].logout, sample[self.analysistype].logerr)
+        # Create the folder (if necessary)
+        make_path(sample[self.analysistype].outputdir)
+        # Make the system call
+        if len(sample.general.fastqfiles) == 2:
+            # Create the command to run the baiting - paired inputs and a single, zipped output
+            sample[self.analysistype].bbdukcmd = \
+                'bbduk.sh -Xmx{mem} ref={ref} in1={in1} in2={in2} k={kmer} maskmiddle={mm} ' \
+                'threads={c} outm={om} fixjunk' \
+                .format(mem=self.bbdukmem,
+                        ref=sample[self.analysistype].baitfile,
+                        in1=sample.general.trimmedcorrectedfastqfiles[0],
+                        in2=sample.general.trimmedcorrectedfastqfiles[1],
+                        kmer=kmer,
+                        mm=maskmiddle,
+                        c=str(self.bbdukthreads),
+                        om=sample[self.analysistype].baitedfastq)
+        else:
+            sample[self.analysistype].bbdukcmd = \
+                'bbduk.sh -Xmx{mem} ref={ref} in={in1} k={kmer} maskmiddle={mm} ' \
+                'threads={cpus} outm={outm} fixjunk' \
+                .format(mem=self.bbdukmem,
+                        ref=sample[self.analysistype].baitfile,
+                        in1=sample.general.trimmedcorrectedfastqfiles[0],
+                        kmer=kmer,
+                        mm=maskmiddle,
+                        cpus=str(self.bbdukthreads),
+                        outm=sample[self.analysistype].baitedfastq)
+        # Run the system call (if necessary)
+        if not os.path.isfile(sample[self.analysistype].baitedfastq):
+            out, err = run_subprocess(sample[self.analysistype].bbdukcmd)
+            write_to_logfile(sample[self.analysistype].bbdukcmd,
+                             sample[self.analysistype].bbdukcmd,
+                             self.logfile, sample.general.logout, sample.general.logerr,
+                             sample[self.analysistype].logout, sample[self.analysistype].logerr)
+            write_to_logfile(out,
+                             err,
+                             self.logfile, sample.general.logout, sample.general.logerr,
+                             sample[self.analysistype].logout, sample[self.analysistype].logerr)
 
     def reversebait(self, maskmiddle='f', k=19):
         """
@@ -196,38 +199,47 @@ class Sippr(object):
         number of possibly targets against which the baited reads must be aligned
         """
         logging.info('Performing reverse kmer baiting of targets with FASTQ files')
+        with progressbar(self.runmetadata) as bar:
+            for sample in bar:
+                if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
+                    self.reversebait_sample(sample, maskmiddle=maskmiddle, k=k)
+
+    def reversebait_sample(self, sample, maskmiddle='f', k=19):
+        """
+        Use the baited FASTQ file of a single sample to bait out sequence from the original target file
+        :param sample: metadata object of the sample
+        :param maskmiddle: boolean argument treat the middle base of a kmer as a wildcard
+        :param k: keyword argument for length of kmers to use in the analyses
+        """
         if self.kmer_size is None:
             kmer = k
         else:
             kmer = self.kmer_size
-        with progressbar(self.runmetadata) as bar:
-            for sample in bar:
-                if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
-                    outfile = os.path.join(sample[self.analysistype].outputdir, 'baitedtargets.fa')
-                    sample[self.analysistype].revbbdukcmd = \
-                        'bbduk.sh -Xmx{mem} ref={ref} in={in1} k={kmer} threads={cpus} mincovfraction={mcf} ' \
-                        'maskmiddle={mm} outm={outm}' \
-                        .format(mem=self.mem,
-                                ref=sample[self.analysistype].baitedfastq,
-                                in1=sample[self.analysistype].baitfile,
-                                kmer=kmer,
-                                cpus=str(self.cpus),
-                                mcf=self.cutoff,
-                                mm=maskmiddle,
-                                outm=outfile)
-                    # Run the system call (if necessary)
-                    if not os.path.isfile(outfile):
-                        out, err = run_subprocess(sample[self.analysistype].revbbdukcmd)
-                        write_to_logfile(sample[self.analysistype].bbdukcmd,
-                                         sample[self.analysistype].bbdukcmd,
-                                         self.logfile, sample.general.logout, sample.general.logerr,
-                                         sample[self.analysistype].logout, sample[self.analysistype].logerr)
-                        write_to_logfile(out,
-                                         err,
-                                         self.logfile, sample.general.logout, sample.general.logerr,
-                                         sample[self.analysistype].logout, sample[self.analysistype].logerr)
-                    # Set the baitfile to use in the mapping steps as the newly created outfile
-                    sample[self.analysistype].baitfile = outfile
+        outfile = os.path.join(sample[self.analysistype].outputdir, 'baitedtargets.fa')
+        sample[self.analysistype].revbbdukcmd = \
+            'bbduk.sh -Xmx{mem} ref={ref} in={in1} k={kmer} threads={cpus} mincovfraction={mcf} ' \
+            'maskmiddle={mm} outm={outm}' \
+            .format(mem=self.bbdukmem,
+                    ref=sample[self.analysistype].baitedfastq,
+                    in1=sample[self.analysistype].baitfile,
+                    kmer=kmer,
+                    cpus=str(self.bbdukthreads),
+                    mcf=self.cutoff,
+                    mm=maskmiddle,
+                    outm=outfile)
+        # Run the system call (if necessary)
+        if not os.path.isfile(outfile):
+            out, err = run_subprocess(sample[self.analysistype].revbbdukcmd)
+            write_to_logfile(sample[self.analysistype].bbdukcmd,
+                             sample[self.analysistype].bbdukcmd,
+                             self.logfile, sample.general.logout, sample.general.logerr,
+                             sample[self.analysistype].logout, sample[self.analysistype].logerr)
+            write_to_logfile(out,
+                             err,
+                             self.logfile, sample.general.logout, sample.general.logerr,
+                             sample[self.analysistype].logout, sample[self.analysistype].logerr)
+        # Set the baitfile to use in the mapping steps as the newly created outfile
+        sample[self.analysistype].baitfile = outfile
 
     def subsample_reads(self):
         """
@@ -274,113 +286,233 @@ class Sippr(object):
             threads.start()
         for sample in self.runmetadata:
             if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
-                # Set the path/name for the sorted bam file to be created
-                sample[self.analysistype].sortedbam = os.path.join(sample[self.analysistype].outputdir,
-                                                                   '{at}_sorted.bam'.format(at=self.analysistype))
-                # Remove the file extension of the bait file for use in the indexing command
-                sample[self.analysistype].baitfilenoext = sample[self.analysistype].baitfile.split('.fasta')[0]
-                # Use bowtie2 wrapper to create index the target file
-                bowtie2build = Bowtie2BuildCommandLine(reference=sample[self.analysistype].baitfile,
-                                                       bt2=sample[self.analysistype].baitfilenoext,
-                                                       **self.builddict)
-                # Use samtools wrapper to set up the bam sorting command
-                samsort = SamtoolsSortCommandline(input=sample[self.analysistype].sortedbam,
-                                                  o=True,
-                                                  out_prefix="-")
-                # Determine the location of the SAM header editing script
-                scriptlocation = genemethods.sipprCommon.editsamheaders.__file__
-                samtools = [
-                    # When bowtie2 maps reads to all possible locations rather than choosing a 'best' placement, the
-                    # SAM header for that read is set to 'secondary alignment', or 256. Please see:
-                    # http://davetang.org/muse/2014/03/06/understanding-bam-flags/ The script below reads in
-                    # the stdin and subtracts 256 from headers which include 256
-                    'python3 {sl}'.format(sl=scriptlocation),
-                    # Use samtools wrapper to set up the samtools view
-                    SamtoolsViewCommandline(b=True,
-                                            S=True,
-                                            h=True,
-                                            F=4,
-                                            input_file="-"),
-                    samsort]
-                # Add custom parameters to a dictionary to be used in the bowtie2 alignment wrapper
-                indict = {'--very-sensitive-local': True,
-                          '-U': sample[self.analysistype].baitedfastq,
-                          '-a': True,
-                          '--threads': self.threads,
-                          '--local': True}
+                self.mapqueue.put(sample)
+        self.mapqueue.join()
+        # Remove the shared indices created for the sample-specific bait files
+        self.clean_index_cache()
+
+    def map(self):
+        while True:
+            sample = self.mapqueue.get()
+            self.map_sample(sample)
+            self.mapqueue.task_done()
+
+    def map_sample(self, sample):
+        """
+        Index the bait file of a sample with bowtie2-build and samtools faidx, and map the baited reads to it with
+        bowtie2. The SAM output is piped through samtools to create a sorted BAM file
+        :param sample: metadata object of the sample
+        """
+        # Set the path/name for the sorted bam file to be created
+        sample[self.analysistype].sortedbam = os.path.join(sample[self.analysistype].outputdir,
+                                                           '{at}_sorted.bam'.format(at=self.analysistype))
+        # Remove the file extension of the bait file for use in the indexing command
+        sample[self.analysistype].baitfilenoext = sample[self.analysistype].baitfile.split('.fasta')[0]
+        # Use samtools wrapper to set up the bam sorting command
+        samsort = SamtoolsSortCommandline(input=sample[self.analysistype].sortedbam,
+                                          o=True,
+                                          out_prefix="-")
+        # Determine the location of the SAM header editing script
+        scriptlocation = genemethods.sipprCommon.editsamheaders.__file__
+        samtools = [
+            # When bowtie2 maps reads to all possible locations rather than choosing a 'best' placement, the
+            # SAM header for that read is set to 'secondary alignment', or 256. Please see:
+            # http://davetang.org/muse/2014/03/06/understanding-bam-flags/ The script below reads in
+            # the stdin and subtracts 256 from headers which include 256
+            'python3 {sl}'.format(sl=scriptlocation),
+            # Use samtools wrapper to set up the samtools view
+            SamtoolsViewCommandline(b=True,
+                                    S=True,
+                                    h=True,
+                                    F=4,
+                                    input_file="-"),
+            samsort]
+        # Add custom parameters to a dictionary to be used in the bowtie2 alignment wrapper
+        indict = {'--very-sensitive-local': True,
+                  '-U': sample[self.analysistype].baitedfastq,
+                  '-a': True,
+                  '--threads': self.threads,
+                  '--local': True}
+        # Set the name of the faidx index of the bait file, and add the command (as a string) to the metadata
+        sample[self.analysistype].faifile = sample[self.analysistype].baitfile + '.fai'
+        sample[self.analysistype].samindex = \
+            str(SamtoolsFaidxCommandline(reference=sample[self.analysistype].baitfile))
+        try:
+            # Only run the functions if the sorted bam file does not exist
+            if os.path.isfile(sample[self.analysistype].sortedbam):
+                # The faidx index of the bait file is still required to parse the existing sorted bam file
+                if not os.path.isfile(sample[self.analysistype].faifile):
+                    with self.target_lock(sample[self.analysistype].baitfile):
+                        self.faidx(sample, sample[self.analysistype].baitfile)
+            else:
+                # Find or create the bowtie2 and faidx indices of the bait file
+                prefix = self.index_targets(sample)
                 # Create the bowtie2 reference mapping command
-                bowtie2align = Bowtie2CommandLine(bt2=sample[self.analysistype].baitfilenoext,
+                bowtie2align = Bowtie2CommandLine(bt2=prefix,
                                                   threads=self.threads,
                                                   samtools=samtools,
                                                   **indict)
-                # Create the command to faidx index the bait file
-                sample[self.analysistype].faifile = sample[self.analysistype].baitfile + '.fai'
-                samindex = SamtoolsFaidxCommandline(reference=sample[self.analysistype].baitfile)
-                # Add the commands (as strings) to the metadata
-                sample[self.analysistype].samindex = str(samindex)
-                # Add the commands to the queue. Note that the commands would usually be set as attributes of
-                # the sample but there was an issue with their serialization when printing out the metadata
-                if not os.path.isfile(sample[self.analysistype].baitfilenoext + '.1' + self.bowtiebuildextension):
+                # Set stdout to a stringIO stream
+                stdout, stderr = map(StringIO, bowtie2align(cwd=sample[self.analysistype].outputdir))
+                if stderr:
                     try:
-                        stdoutbowtieindex, stderrbowtieindex = \
-                            map(StringIO, bowtie2build(cwd=sample[self.analysistype].targetpath))
-                        # Write any error to a log file
-                        if stderrbowtieindex:
-                            try:
-                                # Write the standard error to log, bowtie2 puts alignment summary here
-                                with open(os.path.join(sample[self.analysistype].targetpath,
-                                                       '{at}_bowtie_index.log'.format(at=self.analysistype)), 'w') \
-                                        as log:
-                                    log.writelines(logstr(bowtie2build, stderrbowtieindex.getvalue(),
-                                                          stdoutbowtieindex.getvalue()))
-                            except PermissionError:
-                                pass
-                        # Close the stdout and stderr streams
-                        stdoutbowtieindex.close()
-                        stderrbowtieindex.close()
-                    except ApplicationError:
+                        # Write the standard error to log, bowtie2 puts alignment summary here
+                        with open(os.path.join(sample[self.analysistype].outputdir,
+                                               '{at}_bowtie_samtools.log'.format(at=self.analysistype)), 'a+') \
+                                as log:
+                            log.writelines(logstr([bowtie2align], stderr.getvalue(), stdout.getvalue()))
+                    except PermissionError:
                         pass
-                self.mapqueue.put((sample, bowtie2build, bowtie2align, samindex))
-        self.mapqueue.join()
+                stdout.close()
+                stderr.close()
+        except ApplicationError:
+            pass
+        finally:
+            # The cached bowtie2 indices are no longer required by this sample
+            self.release_index(sample)
 
-    def map(self):
-        while True:
-            try:
-                # Get the necessary values from the queue
-                sample, bowtie2build, bowtie2align, samindex = self.mapqueue.get()
-                # Use samtools faidx to index the bait file - this will be used in the sample parsing
+    def index_targets(self, sample):
+        """
+        Find or create the bowtie2 and faidx indices of the bait file of a sample. Bait files in the targets folder are
+        indexed in place. Sample-specific bait files (e.g. from reverse baiting) are hashed, and samples with
+        identical bait files share a single set of indices in the index cache
+        :param sample: metadata object of the sample
+        :return: prefix of the bowtie2 index to use in the mapping
+        """
+        baitfile = sample[self.analysistype].baitfile
+        prefix = sample[self.analysistype].baitfilenoext
+        # Use any existing indices of the bait file, and index bait files that are not specific to this sample in place
+        if os.path.isfile(prefix + '.1' + self.bowtiebuildextension) or \
+                os.path.dirname(os.path.abspath(baitfile)) != os.path.abspath(sample[self.analysistype].outputdir):
+            # Samples may share a bait file, so ensure that only one thread builds the indices for any bait file
+            with self.target_lock(baitfile):
+                if not os.path.isfile(prefix + '.1' + self.bowtiebuildextension):
+                    self.build_index(sample, baitfile, prefix)
                 if not os.path.isfile(sample[self.analysistype].faifile):
-                    stdoutindex, stderrindex = map(StringIO, samindex(cwd=sample[self.analysistype].targetpath))
-                    # Write any error to a log file
-                    if stderrindex:
-                        # Write the standard error to log, bowtie2 puts alignment summary here
-                        try:
-                            with open(os.path.join(sample[self.analysistype].targetpath,
-                                                   '{at}_samtools_index.log'.format(at=self.analysistype)), 'w') as log:
-                                log.writelines(logstr(samindex, stderrindex.getvalue(), stdoutindex.getvalue()))
-                        except PermissionError:
-                            pass
-                    # Close the stdout and stderr streams
-                    stdoutindex.close()
-                    stderrindex.close()
-                # Only run the functions if the sorted bam files and the indexed bait file do not exist
-                if not os.path.isfile(sample[self.analysistype].sortedbam):
-                    # Set stdout to a stringIO stream
-                    stdout, stderr = map(StringIO, bowtie2align(cwd=sample[self.analysistype].outputdir))
-                    if stderr:
-                        try:
-                            # Write the standard error to log, bowtie2 puts alignment summary here
-                            with open(os.path.join(sample[self.analysistype].outputdir,
-                                                   '{at}_bowtie_samtools.log'.format(at=self.analysistype)), 'a+') \
-                                    as log:
-                                log.writelines(logstr([bowtie2align], stderr.getvalue(), stdout.getvalue()))
-                        except PermissionError:
-                            pass
-                    stdout.close()
-                    stderr.close()
-            except ApplicationError:
+                    self.faidx(sample, baitfile)
+            return prefix
+        # Find the cache entry for the contents of the bait file, and add this sample to its reference count
+        digest = self.digest(baitfile)
+        with self.lock:
+            entry = self.indexcache.setdefault(digest, {'refs': 0, 'lock': Lock()})
+            entry['refs'] += 1
+        sample[self.analysistype].indexdigest = digest
+        cachedir = os.path.join(self.indexcachepath, digest)
+        reference = os.path.join(cachedir, 'targets.fa')
+        prefix = os.path.join(cachedir, 'targets')
+        # Only the first sample with these targets builds the indices - the others wait, and then re-use them
+        with entry['lock']:
+            if not os.path.isfile(prefix + '.1' + self.bowtiebuildextension):
+                make_path(cachedir)
+                shutil.copyfile(baitfile, reference)
+                self.build_index(sample, reference, prefix)
+            if not os.path.isfile(reference + '.fai'):
+                self.faidx(sample, reference)
+        # The bait file is identical to the cached reference, so their faidx indices are also identical
+        if not os.path.isfile(sample[self.analysistype].faifile) and os.path.isfile(reference + '.fai'):
+            shutil.copyfile(reference + '.fai', sample[self.analysistype].faifile)
+        return prefix
+
+    def build_index(self, sample, reference, prefix):
+        """
+        Use bowtie2-build to index a FASTA file
+        :param sample: metadata object of the sample
+        :param reference: FASTA file to index
+        :param prefix: prefix of the bowtie2 index files
+        """
+        # Use bowtie2 wrapper to create index the target file
+        bowtie2build = Bowtie2BuildCommandLine(reference=reference,
+                                               bt2=prefix,
+                                               **self.builddict)
+        stdoutbowtieindex, stderrbowtieindex = map(StringIO, bowtie2build(cwd=sample[self.analysistype].targetpath))
+        # Write any error to a log file
+        if stderrbowtieindex:
+            try:
+                # Write the standard error to log, bowtie2 puts alignment summary here
+                with open(os.path.join(sample[self.analysistype].targetpath,
+                                       '{at}_bowtie_index.log'.format(at=self.analysistype)), 'w') as log:
+                    log.writelines(logstr(bowtie2build, stderrbowtieindex.getvalue(), stdoutbowtieindex.getvalue()))
+            except PermissionError:
+                pass
+        # Close the stdout and stderr streams
+        stdoutbowtieindex.close()
+        stderrbowtieindex.close()
+
+    def faidx(self, sample, reference):
+        """
+        Use samtools faidx to index a FASTA file - this will be used in the sample parsing
+        :param sample: metadata object of the sample
+        :param reference: FASTA file to index
+        """
+        samindex = SamtoolsFaidxCommandline(reference=reference)
+        stdoutindex, stderrindex = map(StringIO, samindex(cwd=sample[self.analysistype].targetpath))
+        # Write any error to a log file
+        if stderrindex:
+            try:
+                with open(os.path.join(sample[self.analysistype].targetpath,
+                                       '{at}_samtools_index.log'.format(at=self.analysistype)), 'w') as log:
+                    log.writelines(logstr(samindex, stderrindex.getvalue(), stdoutindex.getvalue()))
+            except PermissionError:
+                pass
+        # Close the stdout and stderr streams
+        stdoutindex.close()
+        stderrindex.close()
+
+    @staticmethod
+    def digest(filename):
+        """
+        Calculate the SHA-1 digest of the contents of a file
+        :param filename: Path of the file
+        :return: hexadecimal digest
+        """
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as handle:
+            for block in iter(lambda: handle.read(65536), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def release_index(self, sample):
+        """
+        Remove a sample from the reference count of the cached indices that it used
+        :param sample: metadata object of the sample
+        """
+        try:
+            digest = sample[self.analysistype].indexdigest
+        except AttributeError:
+            return
+        with self.lock:
+            entry = self.indexcache.get(digest)
+            if entry and entry['refs']:
+                entry['refs'] -= 1
+
+    def clean_index_cache(self):
+        """
+        At the end of the run, remove the cached indices that are no longer referenced by any sample. If
+        self.keepindexcache is set, the cache is kept, so that reanalyses can re-use the indices
+        """
+        if self.keepindexcache:
+            return
+        with self.lock:
+            for digest, entry in list(self.indexcache.items()):
+                if entry['refs']:
+                    continue
+                shutil.rmtree(os.path.join(self.indexcachepath, digest), ignore_errors=True)
+                del self.indexcache[digest]
+            # Remove the cache folders if they are now empty
+            try:
+                os.rmdir(self.indexcachepath)
+                os.rmdir(os.path.dirname(self.indexcachepath))
+            except OSError:
                 pass
-            self.mapqueue.task_done()
+
+    def target_lock(self, target):
+        """
+        Return the lock used to serialise the indexing of a target file
+        :param target: Path of the target file
+        :return: threading.Lock specific to the target file
+        """
+        with self.lock:
+            return self.targetlocks.setdefault(target, Lock())
 
     def indexing(self):
         logging.info('Indexing sorted BAM files')
@@ -393,33 +525,40 @@ class Sippr(object):
             threads.start()
         for sample in self.runmetadata:
             if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis:
-                sample[self.analysistype].sortedbai = sample[self.analysistype].sortedbam + '.bai'
                 self.indexqueue.put(sample)
         self.indexqueue.join()
 
     def index(self):
         while True:
-            try:
-                sample = self.indexqueue.get()
-                bamindex = SamtoolsIndexCommandline(input=sample[self.analysistype].sortedbam)
-                sample[self.analysistype].bamindex = str(bamindex)
-                # Only make the call if the .bai file doesn't already exist
-                if not os.path.isfile(sample[self.analysistype].sortedbai):
-                    # Use cStringIO streams to handle bowtie output
-                    stdout, stderr = map(StringIO, bamindex(cwd=sample[self.analysistype].outputdir))
-                    if stderr:
-                        try:
-                            # Write the standard error to log
-                            with open(os.path.join(sample[self.analysistype].outputdir, '{at}_samtools_bam_index.log'
-                                      .format(at=self.analysistype)), 'a+') as log:
-                                log.writelines(logstr(bamindex, stderr.getvalue(), stdout.getvalue()))
-                        except PermissionError:
-                            pass
-                    stderr.close()
-            except ApplicationError:
-                pass
+            sample = self.indexqueue.get()
+            self.index_sample(sample)
             self.indexqueue.task_done()
 
+    def index_sample(self, sample):
+        """
+        Use samtools to index the sorted BAM file of a sample
+        :param sample: metadata object of the sample
+        """
+        sample[self.analysistype].sortedbai = sample[self.analysistype].sortedbam + '.bai'
+        try:
+            bamindex = SamtoolsIndexCommandline(input=sample[self.analysistype].sortedbam)
+            sample[self.analysistype].bamindex = str(bamindex)
+            # Only make the call if the .bai file doesn't already exist
+            if not os.path.isfile(sample[self.analysistype].sortedbai):
+                # Use cStringIO streams to handle bowtie output
+                stdout, stderr = map(StringIO, bamindex(cwd=sample[self.analysistype].outputdir))
+                if stderr:
+                    try:
+                        # Write the standard error to log
+                        with open(os.path.join(sample[self.analysistype].outputdir, '{at}_samtools_bam_index.log'
+                                  .format(at=self.analysistype)), 'a+') as log:
+                            log.writelines(logstr(bamindex, stderr.getvalue(), stdout.getvalue()))
+                    except PermissionError:
+                        pass
+                stderr.close()
+        except ApplicationError:
+            pass
+
     @staticmethod
     def parse_one_sample(json_file, sample_name, best_assembly_file, analysistype, iupac, cutoff,
                          desired_average_depth, allow_soft_clips):
@@ -726,6 +865,14 @@ class Sippr(object):
             p.close()
             p.join()
         # Since we had to json-ize the sample objects, we now need to update the metadata for everything.
+        self.populate_results(sample_results)
+        logging.info('Done parsing BAM files')
+
+    def populate_results(self, sample_results):
+        """
+        Update the metadata objects of all the samples with the parsed results
+        :param sample_results: list of dictionaries of parsed results returned by parse_one_sample
+        """
         for sample in self.runmetadata:
                 sample[self.analysistype].faidict = dict()
                 sample[self.analysistype].results = dict()
@@ -752,8 +899,134 @@ class Sippr(object):
                         sample[self.analysistype].maxcoverage = sample_result['maxcoverage']
                         sample[self.analysistype].mincoverage = sample_result['mincoverage']
                         sample[self.analysistype].standarddev = sample_result['standarddev']
+
+    def pipelined(self):
+        """
+        Run the baiting, reverse baiting, mapping, indexing, and parsing stages on each sample independently, so a
+        sample does not have to wait for every other sample to finish a stage before starting the next one. The
+        number of samples processed concurrently is limited to self.slots, or to the number of samples to analyse if
+        there are fewer. The start and end times of each stage are written to a timing trace in the report folder.
+        The memory and threads of the bbduk calls are divided between the concurrent samples. Samples that could not be analysed are flagged, and summarised in a warning
+        once the remaining samples have finished
+        """
+        logging.info('Baiting, mapping, and parsing {at} samples'.format(at=self.analysistype))
+        self.pipelinestart = time.time()
+        sample_results = list()
+        failures = list()
+        samples = [sample for sample in self.runmetadata
+                   if sample.general.bestassemblyfile != 'NA' and sample[self.analysistype].runanalysis]
+        # Only divide the resources between the samples that can actually run concurrently
+        slots = max(1, min(self.slots, len(samples)))
+        self.bbdukmem = self.mem // slots
+        self.bbdukthreads = max(1, self.cpus // slots)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Create the pool of processes used to parse the BAM files before starting any threads
+            p = multiprocessing.Pool(processes=self.cpus)
+            for i in range(slots):
+                # Send the threads to the appropriate destination function
+                threads = Thread(target=self.flow, args=(tmpdir, p, sample_results, failures))
+                # Set the daemon to true - something to do with thread management
+                threads.setDaemon(True)
+                # Start the threading
+                threads.start()
+            for sample in samples:
+                self.flowqueue.put(sample)
+            self.flowqueue.join()
+            p.close()
+            p.join()
+        # Restore the resources of the bbduk calls for the non-pipelined analyses
+        self.bbdukmem = self.mem
+        self.bbdukthreads = self.cpus
+        # Remove the shared indices created for the sample-specific bait files
+        self.clean_index_cache()
+        self.populate_results(sample_results)
+        self.write_trace()
+        if failures:
+            logging.warning('Could not complete the {at} analyses of the following samples: {sn}'
+                            .format(at=self.analysistype,
+                                    sn=', '.join(sorted(failures))))
         logging.info('Done parsing BAM files')
 
+    def flow(self, tmpdir, pool, sample_results, failures):
+        while True:
+            sample = self.flowqueue.get()
+            try:
+                self.timed(sample, 'bait', self.bait_sample, sample)
+                # If desired, use bbduk to bait the target sequences with the previously baited FASTQ files
+                if self.revbait:
+                    self.timed(sample, 'reversebait', self.reversebait_sample, sample)
+                self.timed(sample, 'mapping', self.map_sample, sample)
+                self.timed(sample, 'indexing', self.index_sample, sample)
+                sample_result = self.timed(sample, 'parsebam', self.parse_sample, sample, tmpdir, pool)
+                with self.lock:
+                    sample_results.append(sample_result)
+            except Exception as exc:
+                logging.exception('Could not complete the {at} analyses of {sn}'
+                                  .format(at=self.analysistype,
+                                          sn=sample.name))
+                # Record the failure on the sample, so that it is reported once all the samples have been processed
+                sample[self.analysistype].failed = True
+                sample[self.analysistype].error = '{et}: {ex}'.format(et=type(exc).__name__,
+                                                                      ex=exc)
+                with self.lock:
+                    failures.append(sample.name)
+            self.flowqueue.task_done()
+
+    def timed(self, sample, stage, function, *args):
+        """
+        Run a stage of the analyses on a sample, and record its start and end times in the timing trace
+        :param sample: metadata object of the sample
+        :param stage: name of the stage
+        :param function: method to call
+        :param args: arguments to pass to the method
+        :return: the value returned by the method
+        """
+        start = time.time()
+        result = function(*args)
+        with self.lock:
+            self.trace.append((sample.name, stage, start - self.pipelinestart, time.time() - self.pipelinestart))
+        return result
+
+    def parse_sample(self, sample, tmpdir, pool):
+        """
+        Parse the sorted BAM file of a sample in the process pool. The sample object is too big to get pickled, so it
+        is dumped to JSON first
+        :param sample: metadata object of the sample
+        :param tmpdir: temporary folder in which the JSON file is created
+        :param pool: multiprocessing.Pool used to parse the BAM file
+        :return: dictionary of the parsed results
+        """
+        json_name = os.path.join(tmpdir, '{sn}.json'.format(sn=sample.name))
+        with open(json_name, 'w') as f:
+            json.dump(sample[self.analysistype].dump(), f, sort_keys=True, indent=4)
+        return pool.apply(Sippr.parse_one_sample,
+                          (json_name, sample.name, sample.general.bestassemblyfile, self.analysistype, self.iupac,
+                           self.cutoff, self.averagedepth, self.allow_soft_clips))
+
+    def write_trace(self):
+        """
+        Write the start and end times of every stage of every sample to a Gantt-style, tab-delimited timing trace
+        """
+        if not self.trace:
+            return
+        make_path(self.reportpath)
+        tracefile = os.path.join(self.reportpath, '{at}_timing.tsv'.format(at=self.analysistype))
+        # Scale the bars of the chart to the total run time
+        total = max(end for name, stage, start, end in self.trace) or 1
+        width = 60
+        with open(tracefile, 'w') as trace:
+            trace.write('Sample\tStage\tStart\tEnd\tDuration\tTimeline\n')
+            for name, stage, start, end in sorted(self.trace, key=lambda x: (x[0], x[2])):
+                offset = int(start / total * width)
+                length = max(1, int((end - start) / total * width))
+                trace.write('{name}\t{stage}\t{start:.2f}\t{end:.2f}\t{duration:.2f}\t{bar}\n'
+                            .format(name=name,
+                                    stage=stage,
+                                    start=start,
+                                    end=end,
+                                    duration=end - start,
+                                    bar=' ' * offset + '#' * length))
+
     def clipper(self):
         """
         Filter out results based on the presence of cigar features such as internal soft-clipping
@@ -818,6 +1091,9 @@ class Sippr(object):
             self.portallog = ''
         self.cutoff = cutoff
         self.mem = int(0.85 * float(psutil.virtual_memory().total))
+        # Memory and threads of each bbduk call. These are divided between the samples in the pipelined analyses
+        self.bbdukmem = self.mem
+        self.bbdukthreads = self.cpus
         self.builddict = dict()
         self.bowtiebuildextension = '.bt2'
         try:
@@ -833,6 +1109,20 @@ class Sippr(object):
         self.mapqueue = Queue(maxsize=self.cpus)
         self.indexqueue = Queue(maxsize=self.cpus)
         self.parsequeue = Queue(maxsize=self.cpus)
+        self.flowqueue = Queue()
+        # Number of samples to process concurrently in the pipelined analyses
+        self.slots = max(1, self.cpus // max(1, self.threads))
+        self.lock = Lock()
+        self.targetlocks = dict()
+        # Content-addressed cache of the indices of sample-specific bait files
+        self.indexcache = dict()
+        self.indexcachepath = os.path.join(self.path, 'indexcache', self.analysistype)
+        try:
+            self.keepindexcache = inputobject.keepindexcache
+        except AttributeError:
+            self.keepindexcache = False
+        self.trace = list()
+        self.pipelinestart = float()
         self.iupac = {
             'R': ['A', 'G'],
             'Y': ['C', 'T'],
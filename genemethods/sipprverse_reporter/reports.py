@@ -1,10 +1,8 @@
 #!/usr/bin/env python3
 from olctools.accessoryFunctions.accessoryFunctions import make_path, MetadataObject
-from Bio.Sequencing.Applications import SamtoolsFaidxCommandline
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from Bio import SeqIO
-from io import StringIO
 import seaborn as sns
 from glob import glob
 import pandas as pd
@@ -35,14 +33,10 @@ class Reports(object):
                 targetpath = sample[analysistype].targetpath
         for organismfile in glob(os.path.join(targetpath, '*.tfa')):
             organism = os.path.splitext(os.path.basename(organismfile))[0]
-            # Use BioPython to extract all the gene names from the file
-            for record in SeqIO.parse(open(organismfile), 'fasta'):
-                # Append the gene names to the genus-specific list
-                try:
-                    genusgenes[organism].add(record.id.split('_')[0])
-                except (KeyError, IndexError):
-                    genusgenes[organism] = set()
-                    genusgenes[organism].add(record.id.split('_')[0])
+            # Extract all the gene names from the cached target lengths of the file
+            genes = {target.split('_')[0] for target in target_lengths(organismfile, self.targetlengths)}
+            if genes:
+                genusgenes.setdefault(organism, set()).update(genes)
         # Determine from which genera the gene hits were sourced
         for sample in self.runmetadata.samples:
             # Initialise the list to store the genera
@@ -166,7 +160,10 @@ class Reports(object):
             if sample.general.bestassemblyfile != 'NA':
                 if os.path.isdir(sample[analysistype].targetpath):
                     # Update the fai dict with all the genes in the analysis, rather than just those with baited hits
-                    self.gdcs_fai(sample)
+                    self.gdcs_fai(sample=sample,
+                                  analysistype=analysistype,
+                                  targetfiles=self.targetfiles,
+                                  targetlengths=self.targetlengths)
                     sample[analysistype].createreport = True
                     # Determine which genera are present in the analysis
                     if sample.general.closestrefseqgenus not in genera:
@@ -259,33 +256,41 @@ class Reports(object):
             report.write(data)
 
     @staticmethod
-    def gdcs_fai(sample, analysistype='GDCS'):
+    def gdcs_fai(sample, analysistype='GDCS', targetfiles=None, targetlengths=None):
         """
         GDCS analyses need to use the .fai file supplied in the targets folder rather than the one created following
-        reverse baiting
+        reverse baiting. The lengths of the targets are shared by reference between all the samples using the same
+        caches
         :param sample: sample object
         :param analysistype: current analysis being performed
+        :param targetfiles: Optional dictionary of target path: .fai file, shared between the samples of a report
+        :param targetlengths: Optional dictionary of (.fai file, modification time): dictionary of target name: length,
+        shared between the samples of a report
         """
+        targetfiles = targetfiles if targetfiles is not None else dict()
+        targetpath = sample[analysistype].targetpath
+        if targetpath not in targetfiles:
+            # Find the .fai file in the target path. If there isn't one, index the FASTA file of the targets
+            faifiles = glob(os.path.join(targetpath, '*.fai'))
+            if faifiles:
+                targetfiles[targetpath] = faifiles[0]
+            else:
+                fastafiles = glob(os.path.join(targetpath, '*.fasta'))
+                targetfiles[targetpath] = faidx(fastafiles[0]) if fastafiles else None
+        if targetfiles[targetpath] is None:
+            return
+        sample[analysistype].faifile = targetfiles[targetpath]
+        lengths = target_lengths(sample[analysistype].faifile, targetlengths)
+        # Update the fai dict with the lengths of all the targets. Only samples with baited hits that are absent from
+        # the targets need their own copy
         try:
-            # Find the .fai file in the target path
-            sample[analysistype].faifile = glob(os.path.join(sample[analysistype].targetpath, '*.fai'))[0]
-        except IndexError:
-            target_file = glob(os.path.join(sample[analysistype].targetpath, '*.fasta'))[0]
-            samindex = SamtoolsFaidxCommandline(reference=target_file)
-            map(StringIO, samindex(cwd=sample[analysistype].targetpath))
-            sample[analysistype].faifile = glob(os.path.join(sample[analysistype].targetpath, '*.fai'))[0]
-        # Get the fai file into a dictionary to be used in parsing results
-        try:
-            with open(sample[analysistype].faifile, 'r') as faifile:
-                for line in faifile:
-                    data = line.split('\t')
-                    try:
-                        sample[analysistype].faidict[data[0]] = int(data[1])
-                    except KeyError:
-                        sample[analysistype].faidict = dict()
-                        sample[analysistype].faidict[data[0]] = int(data[1])
-        except FileNotFoundError:
-            pass
+            faidict = sample[analysistype].faidict
+        except AttributeError:
+            faidict = dict()
+        if all(gene in lengths for gene in faidict):
+            sample[analysistype].faidict = lengths
+        else:
+            sample[analysistype].faidict = {**faidict, **lengths}
 
     def sixteensreporter(self, analysistype='sixteens_full'):
         """
@@ -409,6 +414,78 @@ class Reports(object):
                          'Bacillus': self.genelist[35:36],
                          'Cronobacter': self.genelist[36:]
                          }
+        # Dictionaries of target path: .fai file of the targets, and (target file, modification time):
+        # dictionary of target name: length. Shared by all the samples in the report run
+        self.targetfiles = dict()
+        self.targetlengths = dict()
+
+
+def target_lengths(targetfile, targetlengths=None):
+    """
+    Get the lengths of the targets in a .fai or FASTA file. With a cache, the lengths are read once per report run,
+    and are re-read if the file has been modified
+    :param targetfile: Name and path of the .fai or FASTA file
+    :param targetlengths: Optional dictionary of (target file, modification time): dictionary of target name: length
+    :return: dictionary of target name: length
+    """
+    if targetlengths is None:
+        return read_lengths(targetfile)
+    key = (targetfile, os.path.getmtime(targetfile))
+    if key not in targetlengths:
+        targetlengths[key] = read_lengths(targetfile)
+    return targetlengths[key]
+
+
+def read_lengths(targetfile):
+    """
+    Read the lengths of the targets from a .fai file, or by streaming a FASTA file
+    :param targetfile: Name and path of the .fai or FASTA file
+    :return: dictionary of target name: length
+    """
+    lengths = dict()
+    with open(targetfile, 'r') as targets:
+        if targetfile.endswith('.fai'):
+            for line in targets:
+                data = line.split('\t')
+                if len(data) > 1:
+                    lengths[data[0]] = int(data[1])
+            return lengths
+        target = None
+        for line in targets:
+            if line.startswith('>'):
+                target = line[1:].split()[0] if line[1:].strip() else str()
+                lengths[target] = 0
+            elif target is not None:
+                lengths[target] += len(line.strip())
+    return lengths
+
+
+def faidx(fasta):
+    """
+    Create a samtools-compatible .fai index of a FASTA file by streaming it once
+    :param fasta: Name and path of the FASTA file
+    :return: Name and path of the .fai file
+    """
+    faifile = fasta + '.fai'
+    entries = list()
+    offset = 0
+    with open(fasta, 'rb') as sequences:
+        for line in sequences:
+            offset += len(line)
+            if line.startswith(b'>'):
+                # Name, length, offset of the first base, bases per line, bytes per line
+                entries.append([line[1:].split()[0].decode() if line[1:].strip() else str(), 0, offset, 0, 0])
+            elif entries and line.strip():
+                entry = entries[-1]
+                if not entry[3]:
+                    entry[3] = len(line.rstrip(b'\r\n'))
+                    entry[4] = len(line)
+                entry[1] += len(line.rstrip(b'\r\n'))
+    with open(faifile + '.tmp', 'w') as index:
+        for entry in entries:
+            index.write('\t'.join(str(value) for value in entry) + '\n')
+    os.replace(faifile + '.tmp', faifile)
+    return faifile
 
 
 class ReportImage(object):
@@ -13,9 +13,10 @@ from click import progressbar
 from subprocess import Popen
 from threading import Thread
 from subprocess import PIPE
-from csv import DictReader
+from functools import lru_cache
 from queue import Queue
 import multiprocessing
+import pandas as pd
 from glob import glob
 import operator
 import logging
@@ -25,6 +26,51 @@ import os
 __author__ = 'adamkoziol'
 
 
+def reference_index(fasta):
+    """
+    Create (or load) an index of the headers of a 16S reference FASTA file. The index is stored beside the FASTA file,
+    and is only rebuilt if the FASTA file changes. Within a run, each index is only loaded once, and is shared across
+    samples
+    :param fasta: Name and path of the reference FASTA file
+    :return: pandas DataFrame of description, genus, and species indexed by accession (the record id)
+    """
+    stat = os.stat(fasta)
+    return _reference_index(os.path.abspath(fasta), stat.st_size, stat.st_mtime)
+
+
+@lru_cache(maxsize=None)
+def _reference_index(fasta, size, mtime):
+    """
+    Cached implementation of reference_index. The size and modification time of the file are part of the cache key,
+    so a modified reference file is re-indexed
+    """
+    indexfile = fasta + '.headers.tsv'
+    if os.path.isfile(indexfile) and os.path.getmtime(indexfile) >= mtime:
+        return pd.read_csv(indexfile, sep='\t', index_col='accession', dtype=str, keep_default_na=False)
+    records = list()
+    with open(fasta, 'r') as reference:
+        for line in reference:
+            # Only the header lines are parsed e.g. >gi|1018196593|ref|NR_136472.1| Escherichia marmotae strain
+            # HT073016 16S ribosomal RNA, partial sequence
+            if line.startswith('>'):
+                description = line[1:].rstrip()
+                # The genus is the first word following the final pipe e.g. Escherichia, and the species is the second
+                # word of the description preceding '16S' e.g. marmotae
+                words = description.split('|')[-1].split()
+                species = description.split(' 16S')[0].split('|')[-1].split()
+                records.append((description.split()[0] if description else description,
+                                description,
+                                words[0] if words else str(),
+                                species[1] if len(species) > 1 else str()))
+    index = pd.DataFrame.from_records(records, columns=['accession', 'description', 'genus', 'species'])\
+        .drop_duplicates('accession').set_index('accession')
+    try:
+        index.to_csv(indexfile, sep='\t')
+    except (IOError, PermissionError):
+        pass
+    return index
+
+
 class SixteenSBait(Sippr):
 
     def main(self):
@@ -73,16 +119,8 @@ class SixteenSSipper(Sippr):
         Run the required methods in the appropriate order
         """
         self.targets()
-        self.bait()
-        # If desired, use bbduk to bait the target sequences with the previously baited FASTQ files
-        if self.revbait:
-            self.reversebait()
-        # Run the bowtie2 read mapping module
-        self.mapping()
-        # Use samtools to index the sorted bam file
-        self.indexing()
-        # Parse the results
-        self.parsebam()
+        # Bait, reverse bait, map, index, and parse each sample independently
+        self.pipelined()
 
     def targets(self):
         """
@@ -323,37 +361,26 @@ class SixteenS(object):
         Parse the blast results, and store necessary data in dictionaries in sample object
         """
         logging.info('Parsing BLAST results')
-        # Load the NCBI 16S reference database as a dictionary
+        # Load the index of the headers of the complete NCBI 16S reference database once. The baited targets of every
+        # sample are a subset of its records
+        dbrecords = reference_index(self.referencefile)
         for sample in self.runmetadata.samples:
             if sample.general.bestassemblyfile != 'NA':
-                # Load the NCBI 16S reference database as a dictionary
-                dbrecords = SeqIO.to_dict(SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'))
                 # Allow for no BLAST results
                 if os.path.isfile(sample[self.analysistype].blastreport):
                     # Initialise a dictionary to store the number of times a genus is the best hit
                     sample[self.analysistype].frequency = dict()
-                    # Open the sequence profile file as a dictionary
-                    blastdict = DictReader(open(sample[self.analysistype].blastreport),
-                                           fieldnames=self.fieldnames, dialect='excel-tab')
-                    recorddict = dict()
-                    for record in blastdict:
-                        # Create the subject id. It will look like this: gi|1018196593|ref|NR_136472.1|
-                        subject = record['subject_id']
-                        # Extract the genus name. Use the subject id as a key in the dictionary of the reference db.
-                        # It will return the full record e.g. gi|1018196593|ref|NR_136472.1| Escherichia marmotae
-                        # strain HT073016 16S ribosomal RNA, partial sequence
-                        # This full description can be manipulated to extract the genus e.g. Escherichia
-                        genus = dbrecords[subject].description.split('|')[-1].split()[0]
-                        # Increment the number of times this genus was found, or initialise the dictionary with this
-                        # genus the first time it is seen
-                        try:
-                            sample[self.analysistype].frequency[genus] += 1
-                        except KeyError:
-                            sample[self.analysistype].frequency[genus] = 1
-                        try:
-                            recorddict[dbrecords[subject].description] += 1
-                        except KeyError:
-                            recorddict[dbrecords[subject].description] = 1
+                    try:
+                        # Only the subject id column is required e.g. gi|1018196593|ref|NR_136472.1|
+                        subjects = pd.read_csv(sample[self.analysistype].blastreport, sep='\t', header=None,
+                                               usecols=[self.fieldnames.index('subject_id')], dtype=str).iloc[:, 0]
+                        # Look up the genus of every subject in the index, and count the number of times each genus
+                        # was found. The genera are kept in the order in which they were first seen
+                        genera = subjects.map(dbrecords['genus']).dropna()
+                        sample[self.analysistype].frequency = \
+                            {genus: int(count) for genus, count in genera.value_counts(sort=False).items()}
+                    except pd.errors.EmptyDataError:
+                        pass
                     # Sort the dictionary based on the number of times a genus is seen
                     sample[self.analysistype].sortedgenera = sorted(sample[self.analysistype].frequency.items(),
                                                                     key=operator.itemgetter(1), reverse=True)
@@ -385,6 +412,8 @@ class SixteenS(object):
         # Initialise the header and data strings
         header = 'Strain,Gene,PercentIdentity,Genus,FoldCoverage\n'
         data = ''
+        # Use the header index of the complete reference database to pull out the descriptions of the hits
+        records = reference_index(self.referencefile)
         with open(self.sixteens_report, 'w') as report:
             with open(os.path.join(self.reportpath, self.analysistype + '_sequences.fa'), 'w') as sequences:
                 for sample in self.runmetadata.samples:
@@ -396,16 +425,19 @@ class SixteenS(object):
                         # fewest number of SNPs rather than the highest percent identity
                         sample[self.analysistype].besthit = sorted(sample[self.analysistype].resultssnp.items(),
                                                                    key=operator.itemgetter(1))[0][0]
-                        # Parse the baited FASTA file to pull out the the description of the hit
-                        for record in SeqIO.parse(sample[self.analysistype].baitfile, 'fasta'):
-                            # If the best hit e.g. gi|631251361|ref|NR_112558.1| is present in the current record,
-                            # gi|631251361|ref|NR_112558.1| Escherichia coli strain JCM 1649 16S ribosomal RNA ...,
-                            # extract the match and the species
-                            if sample[self.analysistype].besthit in record.id:
-                                # Set the best match and species from the records
-                                sample[self.analysistype].sixteens_match = record.description.split(' 16S')[0]
-                                sample[self.analysistype].species = \
-                                    sample[self.analysistype].sixteens_match.split('|')[-1].split()[1]
+                        besthit = sample[self.analysistype].besthit
+                        # The best hit e.g. gi|631251361|ref|NR_112558.1| is usually the id of a record. Otherwise,
+                        # find the record with an id that contains the best hit
+                        if besthit not in records.index:
+                            matches = [accession for accession in records.index if besthit in accession]
+                            besthit = matches[-1] if matches else None
+                        if besthit is not None:
+                            # Set the best match and species from the record e.g.
+                            # gi|631251361|ref|NR_112558.1| Escherichia coli strain JCM 1649 16S ribosomal RNA ...
+                            sample[self.analysistype].sixteens_match = \
+                                records.at[besthit, 'description'].split(' 16S')[0]
+                            if records.at[besthit, 'species']:
+                                sample[self.analysistype].species = records.at[besthit, 'species']
                         # Add the sample name to the data string
                         data += sample.name + ','
                         # Find the record that matches the best hit, and extract the necessary values to be place in the
@@ -562,6 +594,9 @@ class SixteenS(object):
         self.fastaqueue = Queue(maxsize=self.cpus)
         self.blastqueue = Queue(maxsize=self.cpus)
         self.baitfile = str()
+        # The complete reference file of the targets, from which the header index is built
+        referencefiles = glob(os.path.join(self.targetpath, 'bait', '*.fa'))
+        self.referencefile = referencefiles[0] if referencefiles else str()
         self.taxonomy = {'Escherichia': 'coli', 'Listeria': 'monocytogenes', 'Salmonella': 'enterica'}
         # Fields used for custom outfmt 6 BLAST output:
         self.fieldnames = ['query_id', 'subject_id', 'positives', 'mismatches', 'gaps',
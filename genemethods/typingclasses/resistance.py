@@ -1,11 +1,101 @@
 #!/usr/bin/env python3
-from Bio import SeqIO
 from glob import glob
+import time
 import os
+import re
 
 __author__ = 'adamkoziol'
 
 
+def fields(count):
+    """
+    Create the regular expression for a header with a number of underscore-separated fields
+    :param count: Number of fields
+    :return: compiled regular expression with a group for each field
+    """
+    return re.compile('^' + '_'.join(['([^_]*)'] * count) + '$')
+
+
+# The grammar of the ResFinder FASTA headers. Each production is: the family of gene names (a header is in the first
+# family that it matches), the branch within the family, and the alternative layouts of the fields of the header in
+# the order in which they are tried. Each layout has templates for the gname, genename, accession, and allele, filled
+# with the fields of the header
+HEADER_GRAMMAR = [
+    # >ant(3'')_Ih_aac(6')_IId_1_AF453998 yields gname, genename: ant(3'')-Ih-aac(6')-IId, allele: 1,
+    # accession: AF453998
+    (r"Van|mcr|aph|ddlA|ant|aadE_Cc", "^" + re.escape("ant(3'')_Ih_aac(6')_IId_1_AF453998") + "$",
+     [(fields(6), ('{0}-{1}-{2}-{3}', '{0}-{1}-{2}-{3}', '{5}', '{4}'))]),
+    # >mcr_3.3_1_NG055492 yields gname, genename: mcr-3, allele: 1, accession: NG055492. VanC_2_DQ022190 yields gname,
+    # genename: VanC, allele: 2, accession: DQ022190
+    (r"Van|mcr|aph|ddlA|ant|aadE_Cc", r"mcr_3|mcr_2|mcr_1\.10",
+     [(re.compile(r'^([^_]*)_([^_.]*)[^_]*_([^_]*)_([^_]*)$'), ('{0}-{1}', '{0}-{1}', '{3}', '{2}')),
+      (fields(3), ('{0}', '{0}', '{2}', '{1}'))]),
+    # Allow for an additional part to the gene name aph(3'')_Ib_5_AF321551 yields gname, genename: aph(3'')-Ib,
+    # allele: 5, accession AF321551. Allow for underscores in the accession: aac(2')_Ie_1_NC_011896 yields gname: aac(2'),
+    # genename: aac(2')-Ie, allele: 1, accession NC_011896
+    (r"Van|mcr|aph|ddlA|ant|aadE_Cc", None,
+     [(fields(4), ('{0}-{1}', '{0}-{1}', '{3}', '{2}')),
+      (fields(5), ('{0}', '{0}-{1}', '{3}_{4}', '{2}')),
+      (fields(3), ('{0}', '{0}', '{2}', '{1}'))]),
+    # >blaOKP_B_11_1_AM051161 yields gname, genename: blaOKP-B-11, allele: 1, accession: AM051161
+    (r"bla|aac|ARR|POM", r"OKP|CTX|OXY",
+     [(fields(5), ('{0}-{1}-{2}', '{0}-{1}-{2}', '{4}', '{3}'))]),
+    # >blaCMY_12_1_Y16785 yields gname, genename: blaCMY, allele: 12. blaCMY_59_1_NG_048854
+    (r"bla|aac|ARR|POM", r"CMY",
+     [(fields(4), ('{0}', '{0}', '{3}', '{1}')),
+      (fields(5), ('{0}', '{0}', '{3}_{4}', '{1}'))]),
+    # >aac(3)_Ib_aac(6')_Ib_1_AF355189 yields gname, genename: aac(3)-Ib-aac(6')-Ib, allele:1, accession: AF355189
+    (r"bla|aac|ARR|POM", "^" + re.escape("aac(3)_Ib_aac(6')_Ib_1_AF355189") + "$",
+     [(fields(6), ('{0}-{1}-{2}-{3}', '{0}-{1}-{2}-{3}', '{5}', '{4}'))]),
+    # >blaSHV_5a_alias_blaSHV_9_1_S82452 yields gname, genename: blaSHV-5a, allele: 1, accession: S82452
+    (r"bla|aac|ARR|POM", r"alias",
+     [(fields(7), ('{0}-{1}', '{0}-{1}', '{6}', '{5}'))]),
+    # ARR-2_1_HQ141279 yields gname, genename: ARR-2, allele: 1, accession: HQ141279. >blaACC_1_2_AM939420 yields
+    # gname: blaACC-1, genename: blaACC, allele: 2, accession: AM939420. >aac(2')_Ie_1_NC_011896 yields gname, genename:
+    # aac(2')-Ie, allele: 1, accession: NC_011896
+    (r"bla|aac|ARR|POM", None,
+     [(fields(3), ('{0}', '{0}', '{2}', '{1}')),
+      (fields(4), ('{0}-{1}', '{0}', '{3}', '{2}')),
+      (fields(5), ('{0}-{1}', '{0}-{1}', '{3}_{4}', '{2}'))]),
+    # ARR-2_1_HQ141279 yields gname, genename: ARR-2, allele: 1, accession: HQ141279. tet(44)_1_NZ_ABDU01000081 yields
+    # gname, genename: tet(44), allele: 1, accession: NZ_ABDU01000081
+    (None, None,
+     [(fields(3), ('{0}', '{0}', '{2}', '{1}')),
+      (fields(4), ('{0}', '{0}', '{2}_{3}', '{1}'))]),
+]
+# Cache of the parsed headers, and the dictionary of database path: header table
+PARSED_HEADERS = dict()
+HEADER_TABLES = dict()
+# Compile the family and branch patterns. Productions in the same family share a single compiled pattern
+FAMILIES = {family: re.compile(family) for family, branch, layouts in HEADER_GRAMMAR if family}
+HEADER_GRAMMAR = [(FAMILIES.get(family), re.compile(branch) if branch else None, layouts)
+                  for family, branch, layouts in HEADER_GRAMMAR]
+
+
+def parse_header(name):
+    """
+    Parse a ResFinder FASTA header with the header grammar
+    :param name: FASTA header
+    :return: gname, genename, accession, allele
+    """
+    family = None
+    for pattern, branch, layouts in HEADER_GRAMMAR:
+        # Headers are only parsed with the productions of the first family that they match
+        if pattern is not None and not pattern.search(name):
+            continue
+        if family is not None and pattern is not family:
+            break
+        family = pattern
+        if branch is not None and not branch.search(name):
+            continue
+        for layout, templates in layouts:
+            match = layout.match(name)
+            if match:
+                return tuple(template.format(*match.groups()) for template in templates)
+        break
+    raise ValueError('Cannot parse the FASTA header: {name}'.format(name=name))
+
+
 class ResistanceNotes(object):
 
     @staticmethod
@@ -17,27 +107,62 @@ class ResistanceNotes(object):
         """
         # Initialise dictionary to store results
         resistance_dict = dict()
-        # Find all the .tfa files in the folder
-        resistance_files = sorted(glob(os.path.join(targetpath, '*.tfa')))
-        # Iterate through each file
-        for fasta in resistance_files:
-            # Extract the resistance class from the file name and path
-            resistance_class = os.path.splitext(os.path.basename(fasta))[0]
-            # Initialise the resistance class as a set in the dictionary
-            resistance_dict[resistance_class] = set()
-            # Open the file
-            with open(fasta) as resistance:
-                # Iterate through the FASTA records
-                for record in SeqIO.parse(resistance, 'fasta'):
-                    # Replace dashes with underscores
-                    record.id = record.id.replace('-', '_')
-                    # Add the gene name to the set
-                    resistance_dict[resistance_class].add(record.id)
+        for name, (gname, genename, accession, allele, resistance_class) in \
+                ResistanceNotes.header_table(targetpath).items():
+            for resistance in resistance_class.split(','):
+                resistance_dict.setdefault(resistance, set()).add(name)
         return resistance_dict
 
+    @staticmethod
+    def header_table(targetpath):
+        """
+        Parse the headers of all the .tfa files in the ResFinder database once. The table is cached, and the parsed
+        headers are added to the cache used by gene_name
+        :param targetpath: Path to database files
+        :return: Dictionary of header: (gname, genename, accession, allele, comma-separated resistance classes)
+        """
+        targetpath = os.path.abspath(targetpath)
+        if targetpath not in HEADER_TABLES:
+            classes = dict()
+            # Find all the .tfa files in the folder
+            for fasta in sorted(glob(os.path.join(targetpath, '*.tfa'))):
+                # Extract the resistance class from the file name and path
+                resistance_class = os.path.splitext(os.path.basename(fasta))[0]
+                with open(fasta) as resistance:
+                    for line in resistance:
+                        if line.startswith('>'):
+                            # Use the record id with dashes replaced with underscores
+                            name = line[1:].split(maxsplit=1)[0].replace('-', '_') if line[1:].strip() else str()
+                            classes.setdefault(name, list()).append(resistance_class)
+            table = dict()
+            for name, resistance_classes in classes.items():
+                try:
+                    table[name] = ResistanceNotes.gene_name(name) + (','.join(sorted(set(resistance_classes))),)
+                except ValueError:
+                    table[name] = (name, name, str(), str(), ','.join(sorted(set(resistance_classes))))
+            HEADER_TABLES[targetpath] = table
+        return HEADER_TABLES[targetpath]
+
     @staticmethod
     def gene_name(name):
         """
+        Split the FASTA header string into its components, including gene name, allele, and accession. Headers are
+        parsed with the header grammar, and cached
+        :param name: FASTA header
+        :return: gname, genename, accession, allele: name of gene. Often the same as genename, but for certain entries
+        it is longer, full gene name, accession, and allele extracted from the FASTA header
+        """
+        try:
+            return PARSED_HEADERS[name]
+        except KeyError:
+            PARSED_HEADERS[name] = parse_header(name)
+            return PARSED_HEADERS[name]
+
+    @staticmethod
+    def gene_name_legacy(name):
+        """
+        Original implementation of gene_name. Only retained as a baseline for testing and benchmarking the header
+        grammar
         Split the FASTA header string into its components, including gene name, allele, and accession
         :param name: FASTA header
         :return: gname, genename, accession, allele: name of gene. Often the same as genename, but for certain entries
@@ -180,3 +305,48 @@ class ResistanceNotes(object):
         resistance = ','.join(sorted(resistance_list))
         # Return the calculated resistance class
         return resistance
+
+
+def benchmark(targetpath, repeats=3):
+    """
+    Parse every header in the ResFinder database with the original implementation, the header grammar, and the cached
+    lookup, and report the time taken by each. The outputs of the original implementation and the grammar must be
+    identical
+    :param targetpath: Path to the ResFinder database files
+    :param repeats: Number of times to run each implementation. The fastest run is reported
+    """
+    names = list(ResistanceNotes.header_table(targetpath))
+    outputs = dict()
+    for method, function in [('legacy', ResistanceNotes.gene_name_legacy),
+                             ('grammar', parse_header),
+                             ('cached', ResistanceNotes.gene_name)]:
+        timings = list()
+        for i in range(repeats):
+            outputs[method] = list()
+            start = time.time()
+            for name in names:
+                try:
+                    outputs[method].append(function(name))
+                except ValueError:
+                    outputs[method].append(None)
+            timings.append(time.time() - start)
+        print('{method}\t{seconds:.4f} s\t{rate:.0f} headers/s'
+              .format(method=method,
+                      seconds=min(timings),
+                      rate=len(names) / max(min(timings), 1e-9)))
+    # Report any headers that are parsed differently by the grammar
+    for name, legacy, grammar in zip(names, outputs['legacy'], outputs['grammar']):
+        if legacy != grammar:
+            print('MISMATCH\t{name}\t{legacy}\t{grammar}'.format(name=name,
+                                                                  legacy=legacy,
+                                                                  grammar=grammar))
+    print('{count} headers parsed'.format(count=len(names)))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Test and benchmark the ResFinder header grammar against the original parser')
+    parser.add_argument('targetpath',
+                        help='Path to the folder containing the ResFinder .tfa files')
+    arguments = parser.parse_args()
+    benchmark(arguments.targetpath)
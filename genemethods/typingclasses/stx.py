@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import pandas as pd
+
+__author__ = 'adamkoziol'
+
+# Columns of the stx allele table
+COLUMNS = ['gene', 'subunit', 'subtype', 'accession', 'allele']
+# The three categories of verotoxin genes: vtx1 and vtx2 with A and B subunits, and vtx2 without a subunit
+SUBUNITS = [('1A', '1B'), ('2A', '2B'), ('2', None)]
+# Dictionary of stx allele name: parsed allele. Each name is only parsed once
+PARSED_ALLELES = dict()
+
+
+def parse_allele(name):
+    """
+    Parse the name of an allele in the stx database into its components
+    :param name: Allele name e.g. stx2A:3:AB048227:c or stx2A_AB048227_c
+    :return: tuple of gene e.g. stx2A, subunit e.g. 2A, subtype e.g. c, accession, and allele (if present), or None if
+    the name is not an stx allele, or lacks a subtype
+    """
+    try:
+        return PARSED_ALLELES[name]
+    except KeyError:
+        pass
+    parsed = None
+    if 'stx' in name:
+        try:
+            if ':' in name:
+                gene, allele, accession, subtype = name.split(':')
+            else:
+                gene, accession, subtype = name.split('_')
+                allele = str()
+            # Split off the 'stx' from the name
+            parsed = (gene, gene.split('stx')[-1], subtype, accession, allele)
+        # Ignore entries without a subtype
+        except ValueError:
+            pass
+    PARSED_ALLELES[name] = parsed
+    return parsed
+
+
+def allele_table(names):
+    """
+    Create a table of the parsed stx alleles
+    :param names: Iterable of allele names
+    :return: pandas DataFrame of gene, subunit, subtype, accession, and allele indexed by allele name
+    """
+    records = list()
+    for name in set(names):
+        parsed = parse_allele(name)
+        if parsed:
+            records.append((name,) + parsed)
+    return pd.DataFrame.from_records(records, columns=['name'] + COLUMNS).set_index('name')
+
+
+def subtype(results):
+    """
+    Determine the verotoxin subtypes of samples from the percent identities of their stx allele matches. The best
+    identity of each subunit + subtype combination is found, and the A and B subunits of each subtype are paired with a
+    single grouped join across all the samples
+    :param results: Dictionary of sample name: dictionary of allele name: percent identity
+    :return: Dictionary of sample name: (dictionary of verotoxin gene e.g. vtx2a: tuple of subunit identities,
+    dictionary of subunit: subtype: best identity)
+    """
+    hits = pd.DataFrame([(sample, name, identity) for sample, matches in results.items()
+                         for name, identity in matches.items()],
+                        columns=['sample', 'name', 'identity'])
+    subtypes = {sample: (dict(), dict()) for sample in results}
+    if hits.empty:
+        return subtypes
+    # Join the hits to the allele table, and find the best identity for each subunit + subtype of each sample
+    hits = hits.join(allele_table(hits['name']), on='name', how='inner')
+    best = hits.groupby(['sample', 'subunit', 'subtype'], sort=True)['identity'].max()
+    for (sample, subunit, sub), identity in best.items():
+        subtypes[sample][1].setdefault(subunit, dict())[sub] = identity
+    # Pair the A and B subunits: one row per sample + subtype, with a column for each subunit
+    table = best.unstack('subunit')
+    for a_subunit, b_subunit in SUBUNITS:
+        if a_subunit not in table:
+            continue
+        # Determine whether the verotoxin gene is vtx1 or vtx2
+        verotoxin_gene = a_subunit[0]
+        a_hits = table[a_subunit].dropna()
+        b_hits = table[b_subunit].reindex(a_hits.index) if b_subunit in table \
+            else pd.Series(float('nan'), index=a_hits.index)
+        for ((sample, sub), a_identity), b_identity in zip(a_hits.items(), b_hits):
+            # Create a string to with the desired output name of the gene/subtype
+            vtx_gene = 'vtx{gene}{subtype}'.format(gene=verotoxin_gene,
+                                                   subtype=sub)
+            if b_subunit:
+                # Populate the dictionary with the verotoxin gene: (subunit A %ID, subunit B %ID) e.g. vtx2A: (100, 100)
+                if not pd.isna(b_identity):
+                    subtypes[sample][0][vtx_gene] = (a_identity, b_identity)
+                # There are no 2B genes present in the database for subtype vtx2b, allow a match for this subtype if
+                # only the '2A' gene is present
+                elif a_subunit == '2A' and sub == 'b':
+                    subtypes[sample][0][vtx_gene] = (a_identity,)
+            # Only add the results from the subunit-less gene if it is the only match for that subtype e.g. if vtx2b
+            # is already present in the dictionary, do not look at the hits for it again
+            elif vtx_gene not in subtypes[sample][0]:
+                subtypes[sample][0][vtx_gene] = (a_identity,)
+    return subtypes
+
+
+def profile(verotoxin_subtypes):
+    """
+    Create a string summarizing the verotoxin subtypes present
+    :param verotoxin_subtypes: Iterable of verotoxin genes e.g. vtx1a
+    :return: semi-colon-separated string of the sorted subtypes e.g. vtx1a;vtx2a;vtx2c, or 'ND' if there are none
+    """
+    return ';'.join(sorted(set(verotoxin_subtypes))) if verotoxin_subtypes else 'ND'
@@ -3,6 +3,7 @@ from olctools.accessoryFunctions.accessoryFunctions import combinetargets, filer
     make_path, run_subprocess, write_to_logfile
 from olctools.accessoryFunctions.metadataprinter import MetadataPrinter
 from genemethods.typingclasses.resistance import ResistanceNotes
+import genemethods.typingclasses.stx as stx
 from genemethods.assemblypipeline.GeneSeekr import GeneSeekr
 from genemethods.sipprCommon.objectprep import Objectprep
 from genemethods.sipprCommon.sippingmethods import Sippr
@@ -18,12 +19,19 @@ import xlsxwriter
 import threading
 import logging
 import pandas
+import numpy
 import shutil
 import os
 import re
 
 __author__ = 'adamkoziol'
 
+# States of the alleles in the GDCS allele matrix: no result, absent in both the strain and the profile, missing in the
+# strain but present in the profile, and present
+ABSENT = 1
+MISSING = 2
+PRESENT = 3
+
 
 class GDCS(object):
 
@@ -43,57 +51,77 @@ class GDCS(object):
     def gene_tally(self):
         """
         Tally the number of core genes present out of the total number of expected core genes for MLST, rMLST, and
-        cgMLST analyses
+        cgMLST analyses. For each analysis, the typing results are loaded into a sample x locus matrix of allele states,
+        and the tallies are calculated with reductions over the loci
         """
-        for sample in self.runmetadata.samples:
-            genes_present = 0
-            genes_total = 0
-            # Create the GenObject with the necessary attributes
-            setattr(sample, self.analysistype, GenObject())
-            for analysistype in self.analyses:
-                sample[self.analysistype]['{at}_genes_present'.format(at=analysistype)] = 0
-                sample[self.analysistype]['{at}_genes_total'.format(at=analysistype)] = 0
+        samples = self.runmetadata.samples
+        for analysistype in self.analyses:
+            # The total number of genes in the database of the current analysis type for each sample
+            genes = numpy.zeros(len(samples), dtype=int)
+            # Lists of the row, column, and state of each allele, and the dictionary of locus: column
+            rows, columns, states, loci = list(), list(), list(), dict()
+            for row, sample in enumerate(samples):
                 try:
-                    # Add the total number of genes in the database of the current analysis type
-                    sample[self.analysistype]['{at}_genes_present'.format(at=analysistype)] \
-                        += len(sample[analysistype].combined_metadata_results)
-                    sample[self.analysistype]['{at}_genes_total'.format(at=analysistype)] \
-                        += len(sample[analysistype].combined_metadata_results)
+                    genes[row] = len(sample[analysistype].combined_metadata_results)
                     # A gene can be present multiple times in the list of the mismatches to sequence type attribute.
                     # Only consider each gene once
-                    counted_genes = list()
-                    # Subtract genes that are not present in the strain
+                    counted_genes = set()
                     for mismatch in sample[analysistype].mismatchestosequencetype:
                         for gene, allele in mismatch.items():
                             if gene not in counted_genes:
-                                counted_genes.append(gene)
-                                # If the gene is not present in the strain, and the profile, subtract the gene from
-                                # both the genes present and genes total
-                                if allele == 'NA (N)':
-                                    sample[self.analysistype]['{at}_genes_present'.format(at=analysistype)] -= 1
-                                    sample[self.analysistype]['{at}_genes_total'.format(at=analysistype)] -= 1
-                                # If the gene is missing in the strain, but present in the profile, only subtract
-                                # the gene from the genes present
-                                elif 'NA (' in allele:
-                                    sample[self.analysistype]['{at}_genes_present'.format(at=analysistype)] -= 1
-
+                                counted_genes.add(gene)
+                                rows.append(row)
+                                columns.append(loci.setdefault(gene, len(loci)))
+                                states.append(self.allele_state(allele))
                 except AttributeError:
                     pass
-                # Add the MLST and rMLST genes to the running totals
-                if analysistype != 'cgmlst':
-                    # Increment the genes present and total variables with the results from the current analysis
-                    genes_present += sample[self.analysistype]['{at}_genes_present'.format(at=analysistype)]
-                    genes_total += sample[self.analysistype]['{at}_genes_total'.format(at=analysistype)]
+            # Fill the matrix of allele states. Loci without a result for a sample are left as 0
+            matrix = numpy.zeros((len(samples), len(loci)), dtype=numpy.int8)
+            if states:
+                matrix[rows, columns] = states
+            self.matrices[analysistype] = (list(loci), matrix)
+            # Genes that are absent in both the strain and the profile are subtracted from both the genes present and
+            # the genes total. Genes that are missing in the strain, but present in the profile are only subtracted
+            # from the genes present
+            absent = (matrix == ABSENT).sum(axis=1)
+            missing = (matrix == MISSING).sum(axis=1)
+            self.tally['{at}_genes_present'.format(at=analysistype)] = genes - absent - missing
+            self.tally['{at}_genes_total'.format(at=analysistype)] = genes - absent
+        # Add the MLST and rMLST genes to the running totals
+        core = [analysistype for analysistype in self.analyses if analysistype != 'cgmlst']
+        self.tally['core_present'] = self.tally[['{at}_genes_present'.format(at=at) for at in core]].sum(axis=1)
+        self.tally['core_total'] = self.tally[['{at}_genes_total'.format(at=at) for at in core]].sum(axis=1)
+        # Populate the metadata with the tallies
+        for row, sample in enumerate(samples):
+            # Create the GenObject with the necessary attributes
+            setattr(sample, self.analysistype, GenObject())
+            for column in self.tally:
+                if column.endswith(('_genes_present', '_genes_total')):
+                    sample[self.analysistype][column] = int(self.tally.at[row, column])
             # Calculate the total core results
-            sample[self.analysistype].coreresults = '{pres}/{total}'.format(pres=genes_present,
-                                                                            total=genes_total)
+            sample[self.analysistype].coreresults = '{pres}/{total}'.format(pres=self.tally.at[row, 'core_present'],
+                                                                            total=self.tally.at[row, 'core_total'])
+
+    @staticmethod
+    def allele_state(allele):
+        """
+        Encode an allele from the mismatches to sequence type attribute as a state for the allele matrix
+        :param allele: String of the allele e.g. 'NA (N)', 'NA (12)', or '12'
+        :return: ABSENT if the gene is absent in both the strain and the profile, MISSING if the gene is missing in the
+        strain but present in the profile, or PRESENT
+        """
+        if allele == 'NA (N)':
+            return ABSENT
+        elif 'NA (' in allele:
+            return MISSING
+        return PRESENT
 
     def reporter(self):
         """
         Create a report of the core genes present / total genes for each strain
         """
         data = 'Strain,Genus,TotalCore,MLST_genes,rMLST_genes,cgMLST_genes,\n'
-        for sample in self.runmetadata.samples:
+        for row, sample in enumerate(self.runmetadata.samples):
             # Extract the closest reference genus
             try:
                 genus = sample.general.closestrefseqgenus
@@ -105,11 +133,9 @@ class GDCS(object):
             data += '{sn},{genus},{total},'.format(sn=sample.name,
                                                    genus=genus,
                                                    total=sample[self.analysistype].coreresults)
-            for analysis in self.analyses:
-                data += '{present}/{total},'.format(present=sample[self.analysistype]['{at}_genes_present'
-                                                    .format(at=analysis)],
-                                                    total=sample[self.analysistype]['{at}_genes_total'
-                                                    .format(at=analysis)])
+            data += ''.join('{present}/{total},'.format(present=self.tally.at[row, '{at}_genes_present'.format(at=at)],
+                                                        total=self.tally.at[row, '{at}_genes_total'.format(at=at)])
+                            for at in self.analyses)
             data += '\n'
         with open(self.gdcs_report, 'w') as report:
             report.write(data)
@@ -185,6 +211,9 @@ class GDCS(object):
         self.logfile = inputobject.logfile
         self.analyses = ['mlst', 'rmlst', 'cgmlst']
         self.gdcs_report = os.path.join(self.reportpath, '{at}.csv'.format(at=self.analysistype))
+        # Table of the tallies, and dictionary of analysis type: (loci, sample x locus allele state matrix)
+        self.tally = pandas.DataFrame(index=range(len(self.runmetadata.samples)))
+        self.matrices = dict()
 
 
 class Plasmids(GeneSippr):
@@ -1021,87 +1050,16 @@ class Verotoxin(KMA):
         Use the virulence results to perform verotoxin subtyping analyses
         """
         logging.info('Performing verotoxin subtyping')
+        # Subtype all the samples with results at once
+        subtypes = stx.subtype({sample.name: sample[self.analysistype].kmaresults
+                                for sample in self.runmetadata.samples if sample[self.analysistype].kmaresults})
         for sample in self.runmetadata.samples:
-            sample[self.analysistype].verotoxin_subtypes = dict()
-            sample[self.analysistype].verotoxin_subtypes_set = set()
-            sample[self.analysistype].verotoxindict = dict()
-            if sample[self.analysistype].kmaresults:
-                # If there are many results for a sample, don't write the sample name in each line of the report
-                for name, identity in sorted(sample[self.analysistype].kmaresults.items()):
-                    if 'stx' in name:
-                        try:
-                            if ':' in name:
-                                gene, allele, accession, subtype = name.split(':')
-                            else:
-                                gene, accession, subtype = name.split('_')
-                            # Split off the 'stx' from the name
-                            gene_type = gene.split('stx')[-1]
-                            self.dictionary_populate(sample=sample,
-                                                     gene_type=gene_type,
-                                                     subtype=subtype,
-                                                     identity=identity)
-                        # Ignore entries without a subtype
-                        except ValueError:
-                            pass
-                # Perform subtyping - iterate through the three categories of verotoxin genes: vtx1 and vtx2 with
-                # subunits, and vtx2 without a subunit
-                for a_subunit in ['1A', '2A', '2']:
-                    # Use the subunit name to set the name of the B subunit
-                    b_subunit = a_subunit.replace('A', 'B')
-                    # Determine whether the verotoxin gene is vtx1 or vtx2
-                    verotoxin_gene = a_subunit[0]
-                    # If the sample lacks a particular verotoxin subunit, a KeyError will occur. This is fine. Not
-                    # all samples have any/all verotoxin subunits
-                    try:
-                        for subtype, percent_id in sorted(sample[self.analysistype].verotoxindict[a_subunit].items()):
-                            # Create a string to with the desired output name of the gene/subtype
-                            vtx_gene = 'vtx{gene}{subtype}'.format(gene=verotoxin_gene,
-                                                                   subtype=subtype)
-                            # The subunit-less '2' verotoxin gene needs special treatment
-                            if a_subunit != '2':
-                                try:
-                                    # Populate the dictionary with the verotoxin gene: (subunit A %ID, subunit B %ID)
-                                    # e.g. vtx2A: (100.0, 100.0)
-                                    sample[self.analysistype].verotoxin_subtypes[vtx_gene] = \
-                                        (percent_id,
-                                         sample[self.analysistype].verotoxindict[b_subunit][subtype])
-                                    # Add the verotoxin gene to the set of sample subtypes
-                                    sample[self.analysistype].verotoxin_subtypes_set.add(vtx_gene)
-                                except KeyError:
-                                    # There are no 2B genes present in the database for subtype vtx2b, allow a match
-                                    # for this subtype if only the '2A' gene is present
-                                    if a_subunit == '2A' and subtype == 'b':
-                                        sample[self.analysistype].verotoxin_subtypes[vtx_gene] = (percent_id,)
-                                        sample[self.analysistype].verotoxin_subtypes_set.add(vtx_gene)
-                            else:
-                                # Only add the results from the subunit-less gene if it is the only match for that
-                                # subtype. e.g. if vtx2b already is present in the dictionary, do not look at the hits
-                                # for it again
-                                if vtx_gene not in sample[self.analysistype].verotoxin_subtypes:
-                                    sample[self.analysistype].verotoxin_subtypes[vtx_gene] = (percent_id,)
-                                    sample[self.analysistype].verotoxin_subtypes_set.add(vtx_gene)
-                    except KeyError:
-                        pass
-                # Create a string summarizing the verotoxin subtypes present. Create a semi-colon-separated list of the
-                # sorted subtypes e.g. vtx1a;vtx2a;vtx2c if there were subtypes detected. Otherwise, set the subtype
-                # to 'ND'
-                sample[self.analysistype].verotoxin_subtypes_set = \
-                    ';'.join(sorted(sample[self.analysistype].verotoxin_subtypes_set)) \
-                    if sample[self.analysistype].verotoxin_subtypes_set else 'ND'
-            # If there are no results, set the profile to 'ND'
-            else:
-                sample[self.analysistype].verotoxin_subtypes_set = 'ND'
-
-    def dictionary_populate(self, sample, gene_type, subtype, identity):
-        """
-        Populate the supplied nested dictionary with the necessary values. Initialise the dictionary as required
-        """
-        if gene_type not in sample[self.analysistype].verotoxindict:
-            sample[self.analysistype].verotoxindict[gene_type] = dict()
-        if subtype not in sample[self.analysistype].verotoxindict[gene_type]:
-            sample[self.analysistype].verotoxindict[gene_type].update({subtype: identity})
-        if identity > sample[self.analysistype].verotoxindict[gene_type][subtype]:
-            sample[self.analysistype].verotoxindict[gene_type][subtype] = identity
+            sample[self.analysistype].verotoxin_subtypes, sample[self.analysistype].verotoxindict = \
+                subtypes.get(sample.name, (dict(), dict()))
+            # Create a string summarizing the verotoxin subtypes present e.g. vtx1a;vtx2a;vtx2c. If there are no
+            # results, set the profile to 'ND'
+            sample[self.analysistype].verotoxin_subtypes_set = \
+                stx.profile(sample[self.analysistype].verotoxin_subtypes)
 
     def reporter(self):
         """